@@ -21,12 +21,15 @@
 # Thomas Perl <thp@gpodder.org>; 2012-08-16
 
 
+import collections
 import glob
 import logging
 import os
+import threading
+import time
 
 import gpodder
-from gpodder import util
+from gpodder import filecache, resolver, util
 
 logger = logging.getLogger(__name__)
 
@@ -48,51 +51,164 @@ def clean_up_downloads(delete_partial=False):
 def find_partial_downloads(channels, start_progress_callback, progress_callback, finish_progress_callback):
     """Find partial downloads and match them with episodes
 
+    Unfinished downloads are looked up in the download queue journal
+    of the database and cross-checked with the partial files on disk,
+    so only podcasts that have unfinished downloads are looked at.
+
     channels - A list of all model.PodcastChannel objects
     start_progress_callback - A callback(count) when partial files are searched
     progress_callback - A callback(title, progress) when an episode was found
     finish_progress_callback - A callback(resumable_episodes) when finished
     """
     # Look for partial file downloads
-    partial_files = glob.glob(os.path.join(gpodder.downloads, '*', '*.partial'))
-    count = len(partial_files)
+    partial_files = set(glob.glob(os.path.join(gpodder.downloads, '*', '*.partial')))
+
+    journal = []
+    if channels:
+        try:
+            journal = channels[0].db.load_download_queue()
+        except Exception as e:
+            logger.warn('Cannot load download queue journal: %s', e)
+    queued_ids = {entry['episode_id']: index for index, entry in enumerate(journal)}
+    podcast_ids = set(entry['podcast_id'] for entry in journal)
+    partial_dirs = set(os.path.dirname(f) for f in partial_files)
+
+    # Match episodes in a single pass over the podcasts that have
+    # journal entries or partial files in their download folder
+    candidates = []
+    for channel in channels:
+        if (channel.id not in podcast_ids and
+                os.path.join(gpodder.downloads, channel.download_folder) not in partial_dirs):
+            continue
+
+        for episode in channel.get_all_episodes():
+            filename = episode.local_filename(create=False, check_only=True)
+            in_journal = episode.id in queued_ids
+            if filename is not None and filename + '.partial' in partial_files:
+                partial_files.discard(filename + '.partial')
+                candidates.append((episode, filename, True))
+            elif in_journal and filename is not None:
+                candidates.append((episode, filename, False))
+
+    count = len(candidates)
     resumable_episodes = []
     if count:
         start_progress_callback(count)
-        candidates = [f[:-len('.partial')] for f in partial_files]
-        found = 0
-
-        for channel in channels:
-            for episode in channel.get_all_episodes():
-                filename = episode.local_filename(create=False, check_only=True)
-                if filename in candidates:
-                    found += 1
-                    progress_callback(episode.title, found / count)
-                    candidates.remove(filename)
-                    partial_files.remove(filename + '.partial')
-
-                    if os.path.exists(filename):
-                        # The file has already been downloaded;
-                        # remove the leftover partial file
-                        util.delete_file(filename + '.partial')
-                    else:
-                        resumable_episodes.append(episode)
-
-                if not candidates:
-                    break
-
-            if not candidates:
-                break
-
-        for f in partial_files:
-            logger.warn('Partial file without episode: %s', f)
-            util.delete_file(f)
 
+        # Restore in the order of the journal, untracked partial files last
+        candidates.sort(key=lambda c: queued_ids.get(c[0].id, count + len(queued_ids)))
+
+        for found, (episode, filename, partial) in enumerate(candidates, 1):
+            progress_callback(episode.title, found / count)
+            queued_ids.pop(episode.id, None)
+
+            if filecache.exists(filename):
+                # The file has already been downloaded;
+                # remove the leftover partial file
+                if partial:
+                    util.delete_file(filename + '.partial')
+                episode.db.delete_download_task(episode.id)
+            else:
+                resumable_episodes.append(episode)
+
+    for f in partial_files:
+        logger.warn('Partial file without episode: %s', f)
+        util.delete_file(f)
+
+    # Remove stale journal entries (e.g. episodes that have been removed)
+    for episode_id in queued_ids:
+        channels[0].db.delete_download_task(episode_id)
+
+    if count:
         finish_progress_callback(resumable_episodes)
     else:
         clean_up_downloads(True)
 
 
+GENERIC_MIME_TYPES = ('', 'application/octet-stream', 'binary/octet-stream')
+
+
+def needs_preflight(episode):
+    """Returns True if size or type of an episode are not known"""
+    return ((episode.file_size <= 0 or episode.mime_type in GENERIC_MIME_TYPES) and
+            episode.state != gpodder.STATE_DOWNLOADED and
+            not resolver.is_video_link(episode.url))
+
+
+def preflight_episodes(episodes, max_workers=4, max_rate=10., batch_size=50):
+    """Fill in unknown sizes and MIME types of episodes
+
+    Episodes for which needs_preflight() is True are checked with HEAD
+    requests (see gpodder.resolver) by up to "max_workers" threads, at
+    most "max_rate" requests per second. Updated episodes are saved to
+    the database in batches of "batch_size".
+
+    This blocks until all episodes have been checked; the result is
+    the list of updated episodes.
+    """
+    todo = collections.deque(e for e in episodes if needs_preflight(e))
+    if not todo:
+        return []
+
+    logger.info('Preflight for %d episodes', len(todo))
+    lock = threading.Lock()
+    next_request = [time.time()]
+    pending = []
+    updated = []
+
+    def save_episodes(batch):
+        for episode in batch:
+            episode.save()
+        batch[0].db.commit()
+
+    def worker_proc():
+        while True:
+            with lock:
+                if not todo:
+                    return
+                episode = todo.popleft()
+                now = time.time()
+                delay = next_request[0] - now
+                next_request[0] = max(now, next_request[0]) + 1. / max_rate
+
+            if delay > 0:
+                time.sleep(delay)
+
+            resolved = resolver.resolve(episode.channel.authenticate_url(episode.url))
+            changed = False
+            if episode.file_size <= 0 and resolved.size > 0:
+                episode.file_size = resolved.size
+                changed = True
+            if (episode.mime_type in GENERIC_MIME_TYPES and
+                    resolved.mime_type not in GENERIC_MIME_TYPES + (None,) and
+                    not resolved.mime_type.startswith('text/')):
+                episode.mime_type = resolved.mime_type
+                changed = True
+
+            batch = None
+            with lock:
+                if changed:
+                    updated.append(episode)
+                    pending.append(episode)
+                if len(pending) >= batch_size:
+                    batch = pending[:]
+                    del pending[:]
+
+            if batch:
+                save_episodes(batch)
+
+    workers = [util.run_in_background(worker_proc, True)
+               for i in range(min(max(1, max_workers), len(todo)))]
+    for worker in workers:
+        worker.join()
+
+    if pending:
+        save_episodes(pending)
+
+    logger.info('Preflight updated %d episodes', len(updated))
+    return updated
+
+
 def get_expired_episodes(channels, config):
     for channel in channels:
         for index, episode in enumerate(channel.get_episodes(gpodder.STATE_DOWNLOADED)):
@@ -48,6 +48,7 @@ defaults = {
         'server': 'gpodder.net',
         'username': '',
         'password': '',
+        'compact_actions': True,  # Merge redundant episode actions before uploading
         'device': {
             'uid': util.get_hostname(),
             'type': 'desktop',
@@ -66,12 +67,63 @@ defaults = {
             'concurrent': 1,
             'concurrent_max': 16,
         },
+        'postprocessing': {
+            'concurrent': 1,  # extensions run after downloads at the same time
+        },
+        'preflight': {
+            'concurrent': 4,  # HEAD requests at the same time
+            'rate': 10.0,  # maximum HEAD requests per second
+        },
+        'prefetch': {
+            'episodes': 3,  # max episodes per feed update
+            'size': 500,  # max MiB per feed update
+            'daily': 2000,  # max MiB per 24 hours
+        },
         'episodes': 200,  # max episodes per feed
     },
 
     # Behavior of downloads
     'downloads': {
         'chronological_order': True,  # download older episodes first
+
+        # Reserve disk space for the whole file (from Content-Length) when a
+        # download starts. This avoids fragmentation of large files on
+        # spinning disks and NAS mounts and fails early if the disk is full.
+        # Only supported on Linux; ignored elsewhere.
+        'preallocate': False,
+
+        # When to force downloaded data to disk (fsync):
+        #  'never'    - leave it to the OS; fastest, but a crash or power
+        #               loss can leave a finished episode truncated/empty
+        #  'finish'   - once before a finished download is renamed into
+        #               place; costs one flush per episode, usually
+        #               negligible compared to the transfer itself
+        #  'periodic' - additionally every 'fsync_interval' MiB, so that
+        #               resuming after a crash never loses more than that;
+        #               small intervals throttle throughput on slow disks
+        'fsync': 'finish',
+        'fsync_interval': 16,  # MiB (for the 'periodic' policy)
+
+        # Queued downloads only start if the rest of the file still fits
+        # into the free space of the download folder, leaving this many
+        # MiB free; others wait until running downloads are finished
+        # or space has been freed. 0 to only check that the file fits.
+        'min_free_space': 200,
+
+        # Instead of downloading a file that has already been downloaded for
+        # another podcast (same enclosure URL, ignoring analytics prefixes),
+        # make it a reflink or (if not supported) a hard link of that file.
+        # Off by default: Extensions that modify downloaded files in place
+        # (e.g. tag editors) also change the other copy if a hard link is used.
+        'deduplicate': False,
+
+        # After feed updates, look up the size and type of new episodes
+        # whose feed entry has none (or a generic one) with HEAD requests
+        'preflight': True,
+
+        # Play episodes that are being downloaded through a local HTTP
+        # proxy that serves (and waits for) the partial file
+        'stream_proxy': True,
     },
 
     # Automatic feed updates, download removal and retry on download timeout
@@ -133,7 +185,7 @@ defaults = {
             },
 
             'toolbar': False,
-            'new_episodes': 'show',  # ignore, show, queue, download
+            'new_episodes': 'show',  # ignore, show, queue, download, prefetch
             'live_search_delay': 200,
 
             'podcast_list': {
@@ -161,6 +213,9 @@ defaults = {
     'device_sync': {
         'device_type': 'none',  # Possible values: 'none', 'filesystem', 'ipod'
         'device_folder': '/media',
+        # More folders of MP3 players (for 'filesystem'), synchronized at the
+        # same time as 'device_folder', reading each episode file only once
+        'targets': [],
 
         'one_folder_per_podcast': True,
         'skip_played_episodes': True,
@@ -171,6 +226,14 @@ defaults = {
         'custom_sync_name': '{episode.sortdate}_{episode.title}',
         'custom_sync_name_enabled': False,
 
+        # If not all episodes fit on the device, sync the 'newest' or 'oldest'
+        'priority': 'newest',
+        # Only show what a sync would do, without changing the device
+        'dry_run': False,
+        # Compare a few blocks of files that are already on the device
+        # (in addition to size and modification time) before skipping them
+        'compare_samples': False,
+
         'after_sync': {
             'mark_episodes_played': False,
             'delete_episodes': False,
@@ -22,7 +22,7 @@
 
 
 import gpodder
-from gpodder import config, dbsqlite, extensions, model, util
+from gpodder import config, dbsqlite, download, extensions, model, util
 
 
 class Core(object):
@@ -51,5 +51,8 @@ class Core(object):
         # Notify all extensions that we are being shut down
         gpodder.user_extensions.shutdown()
 
+        # Write outstanding changes of the download queue journal
+        download.flush_journal()
+
         # Close the database and store outstanding changes
         self.db.close()
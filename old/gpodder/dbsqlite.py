@@ -38,9 +38,23 @@ _ = gpodder.gettext
 logger = logging.getLogger(__name__)
 
 
+def regexp(pattern, value):
+    # SQLite evaluates "value REGEXP pattern" as regexp(pattern, value)
+    if pattern is None or value is None:
+        return None
+    return re.search(pattern, value) is not None
+
+
+def unicode_lower(value):
+    if value is None:
+        return None
+    return value.lower()
+
+
 class Database(object):
     TABLE_PODCAST = 'podcast'
     TABLE_EPISODE = 'episode'
+    TABLE_DOWNLOAD_QUEUE = 'download_queue'
 
     def __init__(self, filename):
         self.database_file = filename
@@ -86,6 +100,10 @@ class Database(object):
         if self._db is None:
             self._db = sqlite.connect(self.database_file, check_same_thread=False)
 
+            # Functions needed by queries from query.EQL.get_sql()
+            self._db.create_function('REGEXP', 2, regexp)
+            self._db.create_function('UNICODE_LOWER', 1, unicode_lower)
+
             # Check schema version, upgrade if necessary
             schema.upgrade(self._db, self.database_file)
 
@@ -182,6 +200,26 @@ class Database(object):
 
         return result
 
+    def get_episode_ids(self, where='1', params=(), podcast_id=None):
+        """
+        Returns the IDs of the episodes matching an SQL WHERE
+        clause (see query.EQL.get_sql()), newest first.
+        """
+        sql = 'SELECT id FROM %s WHERE (%s)' % (self.TABLE_EPISODE, where)
+        params = list(params)
+        if podcast_id is not None:
+            sql += ' AND podcast_id = ?'
+            params.append(podcast_id)
+        sql += ' ORDER BY published DESC'
+
+        with self.lock:
+            cur = self.cursor()
+            cur.execute(sql, params)
+            result = [id for (id,) in cur]
+            cur.close()
+
+        return result
+
     def delete_podcast(self, podcast):
         assert podcast.id
 
@@ -281,3 +319,72 @@ class Database(object):
             cur = self.cursor()
             cur.execute('DELETE FROM %s WHERE podcast_id = ? AND guid = ?' %
                     self.TABLE_EPISODE, (podcast_id, guid))
+
+    def load_download_queue(self):
+        """
+        Returns the download queue journal as a list of dicts,
+        sorted by priority (highest first) and queueing order.
+        """
+        sql = 'SELECT * FROM %s ORDER BY priority DESC, rowid ASC' % self.TABLE_DOWNLOAD_QUEUE
+
+        with self.lock:
+            cur = self.cursor()
+            cur.execute(sql)
+
+            keys = [desc[0] for desc in cur.description]
+            result = [dict(list(zip(keys, row))) for row in cur]
+            cur.close()
+
+        return result
+
+    def load_download_task(self, episode_id):
+        """
+        Returns the journal entry (a dict) for an episode or None.
+        """
+        sql = 'SELECT * FROM %s WHERE episode_id = ?' % self.TABLE_DOWNLOAD_QUEUE
+
+        with self.lock:
+            cur = self.cursor()
+            cur.execute(sql, (episode_id,))
+
+            keys = [desc[0] for desc in cur.description]
+            row = cur.fetchone()
+            cur.close()
+
+        if row is None:
+            return None
+        else:
+            return dict(list(zip(keys, row)))
+
+    def save_download_task(self, entry):
+        """
+        Creates or updates the journal entry for a download.
+
+        Existing entries are updated in place, so that they keep
+        their position in the queue.
+        """
+        columns = schema.DownloadQueueColumns
+        values = [util.convert_bytes(entry[name]) for name in columns]
+
+        with self.lock:
+            cur = self.cursor()
+            qmarks = ', '.join('%s = ?' % name for name in columns[1:])
+            sql = 'UPDATE %s SET %s WHERE episode_id = ?' % (self.TABLE_DOWNLOAD_QUEUE, qmarks)
+            cur.execute(sql, values[1:] + values[:1])
+
+            if cur.rowcount == 0:
+                qmarks = ', '.join('?' * len(columns))
+                sql = 'INSERT INTO %s (%s) VALUES (%s)' % (self.TABLE_DOWNLOAD_QUEUE, ', '.join(columns), qmarks)
+                cur.execute(sql, values)
+
+            cur.close()
+
+    def delete_download_task(self, episode_id):
+        """
+        Removes the journal entry of a finished or cancelled download.
+        """
+        with self.lock:
+            cur = self.cursor()
+            cur.execute('DELETE FROM %s WHERE episode_id = ?' %
+                    self.TABLE_DOWNLOAD_QUEUE, (episode_id,))
+            cur.close()
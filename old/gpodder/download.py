@@ -31,6 +31,7 @@ import logging
 import mimetypes
 import os
 import os.path
+import random
 import shutil
 import socket
 import threading
@@ -41,7 +42,7 @@ import urllib.request
 from email.header import decode_header
 
 import gpodder
-from gpodder import escapist_videos, util, vimeo, youtube
+from gpodder import filecache, resolver, util, youtube
 
 logger = logging.getLogger(__name__)
 
@@ -72,6 +73,115 @@ def get_header_param(headers, param, header_name):
     return value
 
 
+def get_resume_validator(headers):
+    """Get a validator for conditional resuming from response headers
+
+    Returns the ETag, or the Last-Modified date if the server
+    only sends a weak ETag (which must not be used with If-Range),
+    or None if the response cannot be validated at all.
+    """
+    etag = headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+
+    return headers.get('last-modified')
+
+
+def get_retry_delay(retry, base, maximum):
+    """Exponential backoff with "full jitter" for download retries
+
+    Returns a random delay (in seconds) between zero and the
+    exponentially growing backoff for the given retry (1, 2, ..),
+    capped at "maximum", so that many downloads failing at the
+    same time do not hammer the server in lock-step.
+
+    >>> 0 <= get_retry_delay(1, 1., 60.) <= 1.
+    True
+    >>> 0 <= get_retry_delay(10, 1., 60.) <= 60.
+    True
+    """
+    return random.uniform(0, min(maximum, base * 2 ** (retry - 1)))
+
+
+class ThroughputEstimator(object):
+    """Speed and ETA estimation for downloads and device syncs
+
+    The transferred byte count is sampled at most every SAMPLE_INTERVAL
+    seconds. The speed is an exponentially weighted moving average of
+    the sampled rates, where older samples lose half of their weight
+    every HALF_LIFE seconds, so it follows stalls and speed-ups quickly.
+
+    The last HISTORY_SIZE samples are kept in "history" as tuples of
+    (timestamp, bytes transferred, rate) for diagnosing slow transfers.
+
+    >>> estimator = ThroughputEstimator()
+    >>> estimator.reset(now=0)
+    >>> estimator.update(1000, now=0)
+    0.0
+    >>> estimator.update(11000, now=1)
+    10000.0
+    >>> estimator.get_eta(50000)
+    5.0
+    >>> estimator.update(11000, now=4) < 10000.
+    True
+    >>> len(estimator.history)
+    2
+    """
+    SAMPLE_INTERVAL = .5
+    HALF_LIFE = 3.
+    HISTORY_SIZE = 120
+
+    def __init__(self):
+        self.history = collections.deque(maxlen=self.HISTORY_SIZE)
+        self.reset()
+
+    def reset(self, now=None):
+        """Start a new measurement (e.g. when a task is (re-)started)"""
+        self.speed = 0.0
+        self._last_time = time.time() if now is None else now
+        self._last_position = None
+        self._samples = 0
+
+    def update(self, position, now=None):
+        """Report the number of bytes transferred so far
+
+        Returns the current speed estimation in bytes per second.
+        """
+        if now is None:
+            now = time.time()
+
+        if self._last_position is None:
+            # The first report (e.g. the size of a resumed
+            # download) is only used as the starting point
+            self._last_time = now
+            self._last_position = position
+            return self.speed
+
+        elapsed = now - self._last_time
+        if elapsed < self.SAMPLE_INTERVAL:
+            return self.speed
+
+        rate = max(0, position - self._last_position) / elapsed
+        if self._samples == 0:
+            self.speed = rate
+        else:
+            weight = 1. - 0.5 ** (elapsed / self.HALF_LIFE)
+            self.speed += weight * (rate - self.speed)
+
+        self._samples += 1
+        self.history.append((now, position, rate))
+        self._last_time = now
+        self._last_position = position
+        return self.speed
+
+    def get_eta(self, remaining):
+        """Seconds until "remaining" bytes are transferred (or None)"""
+        if self.speed <= 0 or remaining < 0:
+            return None
+
+        return remaining / self.speed
+
+
 class ContentRange(object):
     # Based on:
     # http://svn.pythonpaste.org/Paste/WebOb/trunk/webob/byterange.py
@@ -255,22 +365,48 @@ class DownloadURLOpener(urllib.request.FancyURLopener):
         # method, at the end after the line "if errcode == 200:"
         return urllib.addinfourl(fp, headers, 'http:' + url)
 
-    def retrieve_resume(self, url, filename, reporthook=None, data=None):
+    def set_header(self, name, value):
+        """Replace (or remove, if value is None) a request header
+
+        Unlike addheader(), this makes sure that headers from a
+        previous attempt (e.g. "Range") do not leak into retries.
+        """
+        self.addheaders = [(k, v) for k, v in self.addheaders
+                if k.lower() != name.lower()]
+        if value is not None:
+            self.addheaders.append((name, value))
+
+    def retrieve_resume(self, url, filename, reporthook=None, data=None,
+            validator=None, preallocate=False, fsync_interval=0):
         """Download files from an URL; return (headers, real_url)
 
         Resumes a download if the local filename exists and
         the server supports download resuming.
+
+        If "validator" (an ETag or Last-Modified value from an
+        earlier attempt) is given, the resume request is made
+        conditional using "If-Range", so that a changed file on
+        the server is re-downloaded as a whole instead of being
+        appended to stale data. The validator of the current
+        response is available as "last_validator" afterwards, and
+        the number of bytes that had to be thrown away because the
+        server did not resume where we asked is in "redownloaded".
+
+        If "preallocate" is True, disk space for the rest of the file
+        is reserved up front (see util.preallocate_file). If
+        "fsync_interval" is positive, the data is forced to disk
+        every "fsync_interval" bytes.
         """
+        self.last_validator = None
+        self.redownloaded = 0
 
         current_size = 0
         tfp = None
         if os.path.exists(filename):
             try:
                 current_size = os.path.getsize(filename)
-                tfp = open(filename, 'ab')
-                # If the file exists, then only download the remainder
-                if current_size > 0:
-                    self.addheader('Range', 'bytes=%s-' % (current_size))
+                tfp = open(filename, 'r+b')
+                tfp.seek(current_size)
             except:
                 logger.warn('Cannot resume download: %s', filename, exc_info=True)
                 tfp = None
@@ -279,24 +415,56 @@ class DownloadURLOpener(urllib.request.FancyURLopener):
         if tfp is None:
             tfp = open(filename, 'wb')
 
+        # If the file exists, then only download the remainder
+        if current_size > 0:
+            self.set_header('Range', 'bytes=%s-' % (current_size))
+            self.set_header('If-Range', validator)
+        else:
+            self.set_header('Range', None)
+            self.set_header('If-Range', None)
+
         # Fix a problem with bad URLs that are not encoded correctly (bug 549)
         url = url.translate(self.ESCAPE_CHARS)
 
-        fp = self.open(url, data)
+        try:
+            fp = self.open(url, data)
+        except:
+            tfp.close()
+            raise
         headers = fp.info()
+        self.last_validator = get_resume_validator(headers)
 
         if current_size > 0:
             # We told the server to resume - see if she agrees
-            # See RFC2616 (206 Partial Content + Section 14.16)
-            # XXX check status code here, too...
+            # See RFC7233 (206 Partial Content + Section 4.2)
             range = ContentRange.parse(headers.get('content-range', ''))
-            if range is None or range.start != current_size:
-                # Ok, that did not work. Reset the download
-                # TODO: seek and truncate if content-range differs from request
+            if fp.getcode() != 206 or range is None:
+                # The server sends the whole file (e.g. because the
+                # If-Range validator did not match) - start from zero
+                logger.warn('Cannot resume: Server sent complete file.')
+                start = 0
+            elif range.start > current_size:
+                # We cannot fill the gap - retry without the Range header
+                logger.warn('Cannot resume: Content-Range starts at %d, '
+                        'but we have only %d bytes.', range.start, current_size)
+                fp.close()
+                tfp.truncate(0)
                 tfp.close()
-                tfp = open(filename, 'wb')
-                current_size = 0
-                logger.warn('Cannot resume: Invalid Content-Range (RFC2616).')
+                result = self.retrieve_resume(url, filename, reporthook, data,
+                        None, preallocate, fsync_interval)
+                self.redownloaded += current_size
+                return result
+            else:
+                start = range.start
+
+            if start != current_size:
+                # Drop only the bytes the server is going to send again
+                logger.info('Resuming at byte %d instead of %d.', start,
+                        current_size)
+                self.redownloaded = current_size - start
+                tfp.seek(start)
+                tfp.truncate()
+                current_size = start
 
         result = headers, fp.geturl()
         bs = 1024 * 8
@@ -307,20 +475,31 @@ class DownloadURLOpener(urllib.request.FancyURLopener):
             if "content-length" in headers:
                 size = int(headers['Content-Length']) + current_size
             reporthook(blocknum, bs, size)
-        while read < size or size == -1:
-            if size == -1:
-                block = fp.read(bs)
-            else:
-                block = fp.read(min(size - read, bs))
-            if len(block) == 0:
-                break
-            read += len(block)
-            tfp.write(block)
-            blocknum += 1
-            if reporthook:
-                reporthook(blocknum, bs, size)
-        fp.close()
-        tfp.close()
+        synced = read
+        try:
+            if preallocate and "content-length" in headers:
+                # Raises IOError (ENOSPC) if the file would not fit on disk
+                if util.preallocate_file(tfp, current_size, int(headers['Content-Length'])):
+                    logger.debug('Preallocated %s bytes for %s',
+                            headers['Content-Length'], filename)
+            while read < size or size == -1:
+                if size == -1:
+                    block = fp.read(bs)
+                else:
+                    block = fp.read(min(size - read, bs))
+                if len(block) == 0:
+                    break
+                read += len(block)
+                tfp.write(block)
+                if fsync_interval > 0 and read - synced >= fsync_interval:
+                    util.fsync_file(tfp)
+                    synced = read
+                blocknum += 1
+                if reporthook:
+                    reporthook(blocknum, bs, size)
+        finally:
+            fp.close()
+            tfp.close()
         del fp
         del tfp
 
@@ -347,11 +526,214 @@ class DownloadURLOpener(urllib.request.FancyURLopener):
         return (None, None)
 
 
+class DownloadJournal(object):
+    """Writes the download queue journal in batches
+
+    Changes of download tasks are collected and written to the database
+    (with one commit) in a background thread FLUSH_DELAY seconds after
+    the first change, so that queueing many tasks (e.g. on the UI
+    thread) does not write each of them right away. flush() writes the
+    collected changes immediately.
+    """
+    FLUSH_DELAY = 1.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # Episode ID -> (database, entry or None to delete it)
+        self._pending = collections.OrderedDict()
+        self._flush_scheduled = False
+
+    def update(self, db, episode_id, entry):
+        """Save (or with entry=None, remove) the entry of an episode"""
+        with self._lock:
+            self._pending[episode_id] = (db, entry)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+
+        util.run_in_background(self._flush_later, True)
+
+    def load(self, db, episode_id):
+        """Get the entry of an episode (including changes not written yet)"""
+        with self._lock:
+            if episode_id in self._pending:
+                return self._pending[episode_id][1]
+
+        return db.load_download_task(episode_id)
+
+    def _flush_later(self):
+        time.sleep(self.FLUSH_DELAY)
+        with self._lock:
+            self._flush_scheduled = False
+        self.flush()
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, collections.OrderedDict()
+
+            changed = []
+            for episode_id, (db, entry) in pending.items():
+                try:
+                    if entry is None:
+                        db.delete_download_task(episode_id)
+                    else:
+                        db.save_download_task(entry)
+                except Exception as e:
+                    logger.warn('Cannot update download journal: %s', e)
+                    continue
+
+                if db not in changed:
+                    changed.append(db)
+
+            for db in changed:
+                try:
+                    db.commit()
+                except Exception as e:
+                    logger.warn('Cannot commit download journal: %s', e)
+
+
+# The journal shared by all download tasks
+_journal = DownloadJournal()
+
+flush_journal = _journal.flush
+
+
+class DiskSpaceAdmission(object):
+    """Only lets downloads start if they fit into the free disk space
+
+    The bytes that running downloads still need are reserved, so that
+    several downloads started at the same time can not fill up the disk
+    together. Tasks that do not fit are marked as "waiting_for_space"
+    and are checked again when other downloads finish, or every
+    RECHECK_INTERVAL seconds (space might be freed by the user).
+
+    Only the sizes already stored on the tasks are used, as admit() is
+    called while the download queue is locked. A task of unknown size is
+    held while its size is looked up in a background thread; then the
+    waiting worker is woken up and "recheck_callback" is called (to start
+    workers for the tasks that can run now). Tasks whose size cannot be
+    found out are admitted without reserving space.
+    """
+    RECHECK_INTERVAL = 30
+
+    def __init__(self, config, recheck_callback=None):
+        self._config = config
+        self.recheck_callback = recheck_callback
+        self.lock = threading.RLock()
+        self._recheck = threading.Condition(self.lock)
+        self.active = set()
+        self.waiting = set()
+        self._looking_up = set()
+        self._rechecking = False
+
+    def get_remaining_bytes(self, task):
+        """Number of bytes that a task still has to write to disk"""
+        if task.total_size <= 0:
+            return 0
+
+        return max(0, int(task.total_size * (1. - task.progress)))
+
+    def reserve(self, task):
+        """Count a task that has been started without asking (forced)"""
+        with self.lock:
+            self.waiting.discard(task)
+            task.waiting_for_space = False
+            self.active.add(task)
+
+    def admit(self, task):
+        """Returns True if the task can be started now"""
+        if task.activity != DownloadTask.ACTIVITY_DOWNLOAD:
+            # Device sync tasks do not write to the download folder
+            return True
+
+        if task.total_size <= 0 and not task.size_looked_up:
+            # Check again when the size is known
+            self.look_up_size(task)
+            return False
+
+        free_space = util.get_free_disk_space(gpodder.downloads)
+        if free_space == -1:
+            # Cannot determine free disk space
+            self.reserve(task)
+            return True
+
+        required = self.get_remaining_bytes(task)
+        floor = max(0, self._config.downloads.min_free_space) * 1024 * 1024
+
+        with self.lock:
+            self.active = set(t for t in self.active
+                    if t.status == DownloadTask.DOWNLOADING and t is not task)
+            reserved = sum(self.get_remaining_bytes(t) for t in self.active)
+
+            if required + reserved + floor > free_space:
+                if task not in self.waiting:
+                    logger.warn('Not enough disk space for %s: %s needed, '
+                            '%s free, %s reserved', task,
+                            util.format_filesize(required),
+                            util.format_filesize(free_space),
+                            util.format_filesize(reserved))
+                self.waiting.add(task)
+                task.waiting_for_space = True
+                return False
+
+            self.reserve(task)
+            return True
+
+    def look_up_size(self, task):
+        """Find out the size of a task in the background (see admit())"""
+        with self.lock:
+            if task in self._looking_up:
+                return
+            self._looking_up.add(task)
+            self.waiting.add(task)
+
+        def look_up_proc():
+            try:
+                task.look_up_size()
+            except Exception as e:
+                logger.warn('Cannot look up size of %s: %s', task, e)
+            finally:
+                with self.lock:
+                    task.size_looked_up = True
+                    self._looking_up.discard(task)
+                    self._recheck.notify_all()
+
+            if self.recheck_callback is not None:
+                self.recheck_callback()
+
+        util.run_in_background(look_up_proc, True)
+
+    def wait_for_space(self):
+        """Called by a worker when only waiting tasks are left
+
+        Returns True (after waiting RECHECK_INTERVAL seconds) if the
+        worker should look at the queue again, False if it should exit.
+        """
+        with self.lock:
+            self.waiting = set(t for t in self.waiting
+                    if t.status == DownloadTask.QUEUED)
+            if not self.waiting or self._rechecking:
+                return False
+            self._rechecking = True
+
+            try:
+                # Woken up early when the size of a task is known
+                self._recheck.wait(self.RECHECK_INTERVAL)
+            finally:
+                self._rechecking = False
+
+        return True
+
+
 class DownloadQueueWorker(object):
-    def __init__(self, queue, exit_callback, continue_check_callback):
+    def __init__(self, queue, exit_callback, continue_check_callback,
+            admission=None):
         self.queue = queue
         self.exit_callback = exit_callback
         self.continue_check_callback = continue_check_callback
+        self.admission = admission
 
     def __repr__(self):
         return threading.current_thread().getName()
@@ -363,11 +745,16 @@ class DownloadQueueWorker(object):
                 return
 
             try:
-                task = self.queue.get_next()
+                if self.admission is not None:
+                    task = self.queue.get_next(self.admission.admit)
+                else:
+                    task = self.queue.get_next()
                 logger.info('%s is processing: %s', self, task)
                 task.run()
                 task.recycle()
             except StopIteration as e:
+                if self.admission is not None and self.admission.wait_for_space():
+                    continue
                 logger.info('No more tasks for %s to carry out.', self)
                 break
         self.exit_callback(self)
@@ -386,14 +773,56 @@ class ForceDownloadWorker(object):
         self.task.run()
 
 
+class PostProcessingQueue(object):
+    """Runs the post-download stage of finished download tasks
+
+    Extensions (e.g. audio/video conversion, tagging) hook into
+    on_episode_downloaded and can take a long time. They are run
+    here, in a separate set of worker threads limited by the
+    "limit.postprocessing.concurrent" setting, so that the download
+    workers can start the next transfer as soon as a file is on disk.
+    """
+    def __init__(self, config):
+        self._config = config
+        self.tasks = collections.deque()
+
+        self.worker_threads_access = threading.RLock()
+        self.worker_count = 0
+
+    def __get_max_workers(self):
+        return max(1, int(self._config.limit.postprocessing.concurrent))
+
+    def submit(self, task):
+        with self.worker_threads_access:
+            self.tasks.append(task)
+            if self.worker_count < self.__get_max_workers():
+                self.worker_count += 1
+                util.run_in_background(self.__worker_proc)
+
+    def __worker_proc(self):
+        while True:
+            with self.worker_threads_access:
+                if not self.tasks or self.worker_count > self.__get_max_workers():
+                    self.worker_count -= 1
+                    return
+                task = self.tasks.popleft()
+
+            logger.info('Post-processing: %s', task)
+            task.postprocess()
+            task.recycle()
+
+
 class DownloadQueueManager(object):
     def __init__(self, config, queue):
         self._config = config
         self.tasks = queue
+        self.postprocessing_queue = PostProcessingQueue(config)
 
         self.worker_threads_access = threading.RLock()
         self.worker_threads = []
 
+        self.admission = DiskSpaceAdmission(config, self.__spawn_threads)
+
     def __exit_callback(self, worker_thread):
         with self.worker_threads_access:
             self.worker_threads.remove(worker_thread)
@@ -424,7 +853,7 @@ class DownloadQueueManager(object):
                 logger.info('Starting new worker thread.')
 
                 worker = DownloadQueueWorker(self.tasks, self.__exit_callback,
-                        self.__continue_check_callback)
+                        self.__continue_check_callback, self.admission)
                 self.worker_threads.append(worker)
                 util.run_in_background(worker.run)
 
@@ -433,13 +862,22 @@ class DownloadQueueManager(object):
 
     def force_start_task(self, task):
         if self.tasks.set_downloading(task):
+            task.postprocessing_queue = self.postprocessing_queue
+            self.admission.reserve(task)
             worker = ForceDownloadWorker(task)
             util.run_in_background(worker.run)
 
     def queue_task(self, task):
         """Marks a task as queued
         """
-        task.status = DownloadTask.QUEUED
+        self.queue_tasks([task])
+
+    def queue_tasks(self, tasks):
+        """Marks tasks as queued, starting workers only once"""
+        for task in tasks:
+            task.postprocessing_queue = self.postprocessing_queue
+            task.waiting_for_space = False
+            task.status = DownloadTask.QUEUED
         self.__spawn_threads()
 
 
@@ -515,6 +953,12 @@ class DownloadTask(object):
     it will always return False afterwards.
 
     The same thing works for failed downloads ("notify_as_failed()").
+
+    If "postprocessing_queue" is set (the DownloadQueueManager does this),
+    .run() returns as soon as the file has been downloaded, and the
+    task stays in the DOWNLOADING status with the ACTIVITY_POSTPROCESS
+    activity until extensions have handled the episode in the queue.
+    Otherwise, the extensions are called from .run() directly.
     """
     # Possible states this download task can be in
     STATUS_MESSAGE = (_('Added'), _('Queued'), _('Downloading'),
@@ -522,11 +966,19 @@ class DownloadTask(object):
     (INIT, QUEUED, DOWNLOADING, DONE, FAILED, CANCELLED, PAUSED) = list(range(7))
 
     # Wheter this task represents a file download or a device sync operation
-    ACTIVITY_DOWNLOAD, ACTIVITY_SYNCHRONIZE = list(range(2))
+    # (or a downloaded file that is being handled by extensions)
+    ACTIVITY_DOWNLOAD, ACTIVITY_SYNCHRONIZE, ACTIVITY_POSTPROCESS = list(range(3))
 
     # Minimum time between progress updates (in seconds)
     MIN_TIME_BETWEEN_UPDATES = 1.
 
+    # Exponential backoff between retries (in seconds)
+    RETRY_BACKOFF_BASE = 1.
+    RETRY_BACKOFF_MAX = 60.
+
+    # Priorities in the download queue journal
+    PRIORITY_AUTOMATIC, PRIORITY_MANUAL = list(range(2))
+
     def __str__(self):
         return self.__episode.title
 
@@ -537,6 +989,7 @@ class DownloadTask(object):
         if status != self.__status:
             self.__status_changed = True
             self.__status = status
+            self.__update_journal()
 
     status = property(fget=__get_status, fset=__set_status)
 
@@ -573,6 +1026,10 @@ class DownloadTask(object):
     episode = property(fget=__get_episode)
 
     def cancel(self):
+        if self.activity == self.ACTIVITY_POSTPROCESS:
+            # The file is already downloaded, nothing left to cancel
+            return
+
         if self.status in (self.DOWNLOADING, self.QUEUED):
             self.status = self.CANCELLED
 
@@ -580,7 +1037,7 @@ class DownloadTask(object):
         if self.status != self.DONE:
             util.delete_file(self.tempname)
 
-    def __init__(self, episode, config):
+    def __init__(self, episode, config, priority=None):
         assert episode.download_task is None
         self.__status = DownloadTask.INIT
         self.__activity = DownloadTask.ACTIVITY_DOWNLOAD
@@ -597,6 +1054,24 @@ class DownloadTask(object):
         self.progress = 0.0
         self.error_message = None
 
+        # ETag or Last-Modified of the partial file (for If-Range)
+        self.validator = None
+
+        # Bytes that had to be downloaded again after failed resumes
+        self.redownloaded_bytes = 0
+
+        # Where to hand off the finished download (see class docstring)
+        self.postprocessing_queue = None
+
+        # Tasks with a higher priority are restored first after a restart
+        # (manually started downloads before automatic ones)
+        self.priority = self.PRIORITY_MANUAL if priority is None else priority
+
+        # Set by DiskSpaceAdmission if the file does not fit on the disk
+        self.waiting_for_space = False
+        # Set by DiskSpaceAdmission when it has tried to find out the size
+        self.size_looked_up = False
+
         # Have we already shown this task in a notification?
         self._notification_shown = False
 
@@ -604,6 +1079,7 @@ class DownloadTask(object):
         self.__start_time = 0
         self.__start_blocks = 0
         self.__limit_rate_value = self._config.limit_rate_value
+        self.throughput = ThroughputEstimator()
         self.__limit_rate = self._config.limit_rate
 
         # Progress update functions
@@ -618,6 +1094,13 @@ class DownloadTask(object):
                     self.progress = max(0.0, min(1.0, already_downloaded / self.total_size))
             except OSError as os_error:
                 logger.error('Cannot get size for %s', os_error)
+
+            # Pick up the state of the download from a previous session
+            entry = self.__load_journal()
+            if entry is not None:
+                if priority is None:
+                    self.priority = entry['priority']
+                self.validator = entry['validator']
         else:
             # "touch self.tempname", so we also get partial
             # files for resuming when the file is queued
@@ -626,6 +1109,44 @@ class DownloadTask(object):
         # Store a reference to this task in the episode
         episode.download_task = self
 
+    def __load_journal(self):
+        try:
+            return _journal.load(self.__episode.db, self.__episode.id)
+        except Exception as e:
+            logger.warn('Cannot load download journal for %s: %s', self, e)
+            return None
+
+    def __update_journal(self, flush=False):
+        """Record the state of this task in the download queue journal
+
+        Unfinished tasks (queued, downloading, paused) are stored, so
+        that they can be restored after a restart. Entries of finished,
+        failed and cancelled tasks are removed. Changes are written in
+        batches (see DownloadJournal), unless "flush" is True.
+        """
+        try:
+            db = self.__episode.db
+        except Exception as e:
+            logger.warn('Cannot update download journal for %s: %s', self, e)
+            return
+
+        if self.status in (DownloadTask.QUEUED, DownloadTask.DOWNLOADING,
+                DownloadTask.PAUSED):
+            _journal.update(db, self.__episode.id, {
+                'episode_id': self.__episode.id,
+                'podcast_id': self.__episode.podcast_id,
+                'status': self.status,
+                'priority': self.priority,
+                'downloaded': int(self.progress * max(0, self.total_size)),
+                'total_size': self.total_size,
+                'validator': self.validator,
+            })
+        else:
+            _journal.update(db, self.__episode.id, None)
+
+        if flush:
+            _journal.flush()
+
     def notify_as_finished(self):
         if self.status == DownloadTask.DONE:
             if self._notification_shown:
@@ -677,6 +1198,9 @@ class DownloadTask(object):
             raise DownloadCancelledException()
 
     def calculate_speed(self, count, blockSize):
+        self.speed = self.throughput.update(count * blockSize)
+
+        # The rate limit is enforced on the average since the start
         if count % 5 == 0:
             now = time.time()
             if self.__start_time > 0:
@@ -705,8 +1229,6 @@ class DownloadTask(object):
                 passed = now - self.__start_time
                 speed = count * blockSize
 
-            self.speed = float(speed)
-
             if self._config.limit_rate and speed > self._config.limit_rate_value:
                 # calculate the time that should have passed to reach
                 # the desired download rate and wait if necessary
@@ -716,13 +1238,72 @@ class DownloadTask(object):
                     delay = min(10.0, float(should_have_passed - passed))
                     time.sleep(delay)
 
+    def wait_for_retry(self, delay):
+        """Sleep before a retry, but give up early when cancelled/paused"""
+        deadline = time.time() + delay
+        while time.time() < deadline:
+            if self.status in (DownloadTask.CANCELLED, DownloadTask.PAUSED):
+                raise DownloadCancelledException()
+            time.sleep(min(.1, max(0, deadline - time.time())))
+
     def recycle(self):
+        if self.activity == DownloadTask.ACTIVITY_POSTPROCESS:
+            # Still in use; the post-processing queue recycles it later
+            return
+
         self.episode.download_task = None
 
+    def postprocess(self):
+        """Finish the task by letting extensions handle the episode"""
+        try:
+            gpodder.user_extensions.on_episode_downloaded(self.__episode)
+        except Exception as e:
+            logger.error('Post-processing failed: %s', self, exc_info=True)
+        finally:
+            # Set the status first, so the task never shows up as a
+            # running download between the two changes
+            self.status = DownloadTask.DONE
+            self.activity = DownloadTask.ACTIVITY_DOWNLOAD
+
+    def look_up_size(self):
+        """Find out an unknown size with a HEAD request (see gpodder.resolver)"""
+        if self.total_size > 0 or resolver.is_video_link(self.url):
+            return
+
+        url = self.__episode.channel.authenticate_url(self.url)
+        size = resolver.resolve(url).size
+        if size > 0 and self.total_size <= 0:
+            logger.info('Size of %s is %s', self, util.format_filesize(size))
+            self.total_size = size
+
+    def link_duplicate(self):
+        """Use the file of another podcast's episode with the same enclosure
+
+        Returns True if the temporary file has been replaced with a
+        link to (or reflink of) an already downloaded file.
+        """
+        duplicate, filename = self.__episode.find_downloaded_duplicate()
+        if duplicate is None or not util.link_file(filename, self.tempname):
+            return False
+
+        logger.info('Using file of "%s" (%s) for %s', duplicate.title,
+                duplicate.channel.title, self)
+        self.total_size = os.path.getsize(self.tempname)
+        self.progress = 1.0
+        return True
+
+    def get_eta(self):
+        """Estimated number of seconds until the task is done (or None)"""
+        if self.total_size <= 0:
+            return None
+
+        return self.throughput.get_eta(self.total_size * (1. - self.progress))
+
     def run(self):
         # Speed calculation (re-)starts here
         self.__start_time = 0
         self.__start_blocks = 0
+        self.throughput.reset()
 
         # If the download has already been cancelled, skip it
         if self.status == DownloadTask.CANCELLED:
@@ -742,29 +1323,47 @@ class DownloadTask(object):
         try:
             # Resolve URL and start downloading the episode
             fmt_ids = youtube.get_fmt_ids(self._config.youtube)
-            url = youtube.get_real_download_url(self.__episode.url, fmt_ids)
-            url = vimeo.get_real_download_url(url, self._config.vimeo.fileformat)
-            url = escapist_videos.get_real_download_url(url)
-            url = url.strip()
+            media_url = resolver.get_media_url(self.__episode.url, fmt_ids,
+                    self._config.vimeo.fileformat)
+            media_url = util.iri_to_url(media_url.strip())
 
-            url = util.iri_to_url(url)
+            # Skip redirects that have already been followed for this URL
+            url = resolver.get_cached_url(media_url) or media_url
 
             logger.info("Downloading %s", url)
             downloader = DownloadURLOpener(self.__episode.channel)
 
-            # HTTP Status codes for which we retry the download
-            retry_codes = (408, 418, 504, 598, 599)
+            fsync_policy = self._config.downloads.fsync
+            if fsync_policy == 'periodic':
+                fsync_interval = max(1, self._config.downloads.fsync_interval) * 1024 * 1024
+            else:
+                fsync_interval = 0
+
+            # HTTP Status codes for which we retry the download (in
+            # addition to all 5xx server errors)
+            retry_codes = (408, 418, 429)
             max_retries = max(0, self._config.auto.retries)
 
+            if self._config.downloads.deduplicate and self.link_duplicate():
+                # No transfer needed, the file is already on disk
+                headers, real_url = {}, url
+                max_retries = -1
+
             # Retry the download on timeout (bug 1013)
             for retry in range(max_retries + 1):
                 if retry > 0:
-                    logger.info('Retrying download of %s (%d)', url, retry)
-                    time.sleep(1)
+                    delay = get_retry_delay(retry, self.RETRY_BACKOFF_BASE,
+                            self.RETRY_BACKOFF_MAX)
+                    logger.info('Retrying download of %s (%d) in %.1f s',
+                            url, retry, delay)
+                    self.wait_for_retry(delay)
 
                 try:
                     headers, real_url = downloader.retrieve_resume(url,
-                        self.tempname, reporthook=self.status_updated)
+                        self.tempname, reporthook=self.status_updated,
+                        validator=self.validator,
+                        preallocate=self._config.downloads.preallocate,
+                        fsync_interval=fsync_interval)
                     # If we arrive here, the download was successful
                     break
                 except urllib.error.ContentTooShortError as ctse:
@@ -779,11 +1378,30 @@ class DownloadTask(object):
                         continue
                     raise
                 except gPodderDownloadHTTPError as http:
-                    if retry < max_retries and http.error_code in retry_codes:
+                    if (retry < max_retries and url != media_url and
+                            http.error_code in (403, 404, 410)):
+                        # The cached redirect target might have expired
+                        logger.info('HTTP error %d: %s - will retry with %s.',
+                                http.error_code, url, media_url)
+                        resolver.invalidate(media_url)
+                        url = media_url
+                        continue
+                    if retry < max_retries and (http.error_code in retry_codes or
+                            500 <= http.error_code < 600):
                         logger.info('HTTP error %d: %s - will retry.',
                                 http.error_code, url)
                         continue
                     raise
+                finally:
+                    self.validator = getattr(downloader, 'last_validator',
+                            None) or self.validator
+                    redownloaded = getattr(downloader, 'redownloaded', 0)
+                    if redownloaded:
+                        self.redownloaded_bytes += redownloaded
+                        logger.info('Failed resume of %s: %d bytes '
+                                'downloaded again (%d total)', url,
+                                redownloaded, self.redownloaded_bytes)
+                        downloader.redownloaded = 0
 
             new_mimetype = headers.get('content-type', self.__episode.mime_type)
             old_mimetype = self.__episode.mime_type
@@ -838,7 +1456,16 @@ class DownloadTask(object):
             self.filename = self.__episode.local_filename(create=False)
             self.tempname = os.path.join(os.path.dirname(self.filename),
                     os.path.basename(self.tempname))
+            if fsync_policy != 'never':
+                # Make sure the data is on disk before the rename makes
+                # the file look complete (and the rename itself, too)
+                with open(self.tempname, 'rb+') as fp:
+                    util.fsync_file(fp)
             shutil.move(self.tempname, self.filename)
+            filecache.invalidate(self.tempname)
+            filecache.invalidate(self.filename)
+            if fsync_policy != 'never':
+                util.fsync_directory(os.path.dirname(self.filename))
 
             # Model- and database-related updates after a download has finished
             self.__episode.on_downloaded(self.filename)
@@ -871,15 +1498,30 @@ class DownloadTask(object):
 
         if self.status == DownloadTask.DOWNLOADING:
             # Everything went well - we're done
-            self.status = DownloadTask.DONE
             if self.total_size <= 0:
                 self.total_size = util.calculate_size(self.filename)
                 logger.info('Total size updated to %d', self.total_size)
             self.progress = 1.0
-            gpodder.user_extensions.on_episode_downloaded(self.__episode)
+            if self.postprocessing_queue is not None:
+                # Free the download slot while extensions are running
+                self.speed = 0.0
+                self.activity = DownloadTask.ACTIVITY_POSTPROCESS
+                self.postprocessing_queue.submit(self)
+            else:
+                self.postprocess()
             return True
 
         self.speed = 0.0
 
+        if self.status == DownloadTask.FAILED:
+            # Resolve the URL again on the next attempt
+            resolver.invalidate(self.__episode.url)
+            logger.debug('Throughput history of %s: %s', self,
+                    ', '.join('%s/s' % util.format_filesize(rate)
+                        for _time, _position, rate in self.throughput.history))
+
+        # Remember validator and progress for resuming after a restart
+        self.__update_journal(flush=True)
+
         # We finished, but not successfully (at least not really)
         return False
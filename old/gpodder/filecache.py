@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+#  gpodder.filecache - Cached existence and size of downloaded files
+#
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Folders that are not watched are checked for changes at most this often
+REVALIDATE_INTERVAL = 2
+
+# File systems on these platforms usually ignore case (and Unicode
+# normalization), so names that are not in the cache are checked again
+CASE_INSENSITIVE_PLATFORMS = ('win32', 'cygwin', 'darwin')
+
+
+class Inotify(object):
+    """Watches folders with inotify(7) (Linux only)
+
+    on_change(folder, name) is called from a background thread when
+    the file "name" in "folder" has been added, removed or written.
+    "name" is None if the whole folder has to be scanned again, and
+    "folder" is None if events have been lost. If a folder has been
+    watched under several names (e.g. through a symlink), on_change
+    is called for each of them.
+
+    Raises OSError if inotify is not available.
+    """
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+
+    # Changes while a file is being written are only reported when it is closed
+    MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, on_change):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        self._libc = libc
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'Cannot initialize inotify')
+
+        self._on_change = on_change
+        self._watches = {}
+        self._lock = threading.Lock()
+
+        thread = threading.Thread(target=self._read_events)
+        thread.daemon = True
+        thread.start()
+
+    def add_watch(self, folder):
+        """Returns True if the folder is being watched"""
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), self.MASK)
+        if wd < 0:
+            logger.debug('Cannot watch %s: %s', folder,
+                    os.strerror(ctypes.get_errno()))
+            return False
+
+        with self._lock:
+            self._watches.setdefault(wd, set()).add(folder)
+        return True
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                logger.warn('Stopped watching download folders: %s', e)
+                self._on_change(None, None)
+                return
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    self._on_change(None, None)
+                    continue
+
+                with self._lock:
+                    if mask & self.IN_IGNORED:
+                        folders = self._watches.pop(wd, ())
+                    else:
+                        folders = list(self._watches.get(wd, ()))
+
+                for folder in folders:
+                    if mask & (self.IN_IGNORED | self.IN_DELETE_SELF | self.IN_MOVE_SELF) or not name:
+                        self._on_change(folder, None)
+                    else:
+                        self._on_change(folder, os.fsdecode(name))
+
+
+class CachedFolder(object):
+    def __init__(self, folder, watched):
+        self.watched = watched
+        self.checked = time.time()
+        # Names of the entries, mapped to their size (None if not known yet)
+        self.entries = {}
+
+        try:
+            self.mtime = os.stat(folder).st_mtime
+            with os.scandir(folder) as it:
+                for entry in it:
+                    # Skip broken symlinks, like os.path.exists() does
+                    if not entry.is_symlink() or os.path.exists(entry.path):
+                        self.entries[entry.name] = None
+        except OSError:
+            # The folder does not exist (yet)
+            self.mtime = None
+
+        # A change within the same second as the scan might not change
+        # the modification time, so do not trust the scan in this case
+        self.racy = self.mtime is not None and self.checked - self.mtime < 1
+
+
+class FileStateCache(object):
+    """Knows which files exist in the download folders, and their size
+
+    Each folder is scanned once when a file in it is first looked up.
+    On Linux, folders are then watched with inotify, so changes show
+    up right away; elsewhere (or if a folder cannot be watched), the
+    modification time of the folder is checked at most every
+    REVALIDATE_INTERVAL seconds, and the folder is scanned again if
+    it has changed.
+
+    Sizes are only read (and then remembered) when asked for. Code that
+    changes a file in place should call invalidate() afterwards.
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> filename = os.path.join(folder, 'episode.mp3')
+    >>> cache = FileStateCache()
+    >>> cache.exists(filename)
+    False
+    >>> with open(filename, 'wb') as fp:
+    ...     _ = fp.write(b'12345')
+    >>> cache.invalidate(filename)
+    >>> cache.exists(filename), cache.getsize(filename)
+    (True, 5)
+    >>> os.remove(filename)
+    >>> os.rmdir(folder)
+    >>> cache.invalidate(filename)
+    >>> cache.exists(filename)
+    False
+    """
+
+    def __init__(self):
+        self._folders = {}
+        self._lock = threading.RLock()
+        self._inotify = None
+        self._inotify_failed = False
+
+    def _watch(self, folder):
+        if self._inotify is None and not self._inotify_failed:
+            try:
+                self._inotify = Inotify(self._on_change)
+            except (OSError, AttributeError) as e:
+                logger.info('Not using inotify for download folders: %s', e)
+                self._inotify_failed = True
+
+        return self._inotify is not None and self._inotify.add_watch(folder)
+
+    def _on_change(self, folder, name):
+        with self._lock:
+            if folder is None:
+                self._folders.clear()
+                return
+
+            cached = self._folders.get(folder)
+            if cached is None:
+                return
+            elif not name:
+                del self._folders[folder]
+                return
+
+            cached.entries.pop(name, None)
+            if os.path.exists(os.path.join(folder, name)):
+                cached.entries[name] = None
+
+    def _get_entries(self, folder):
+        with self._lock:
+            cached = self._folders.get(folder)
+            if cached is not None and not cached.watched:
+                now = time.time()
+                if now - cached.checked > REVALIDATE_INTERVAL:
+                    try:
+                        mtime = os.stat(folder).st_mtime
+                    except OSError:
+                        mtime = None
+
+                    if mtime != cached.mtime or cached.racy:
+                        cached = None
+                    else:
+                        cached.checked = now
+
+            if cached is None:
+                # Watch before scanning, so that no change gets lost
+                cached = CachedFolder(folder, os.path.isdir(folder) and self._watch(folder))
+                self._folders[folder] = cached
+
+            return cached.entries
+
+    def _split(self, filename):
+        # Different spellings of a folder (e.g. "a/./b") share one entry
+        folder, name = os.path.split(filename)
+        return os.path.normpath(folder) if folder else folder, name
+
+    def exists(self, filename):
+        """Like os.path.exists() for files in the download folders"""
+        folder, name = self._split(filename)
+        if not folder or not name:
+            return os.path.exists(filename)
+
+        if name in self._get_entries(folder):
+            return True
+
+        # The file system might know the file under another spelling
+        return sys.platform in CASE_INSENSITIVE_PLATFORMS and os.path.exists(filename)
+
+    def getsize(self, filename):
+        """Like os.path.getsize() for files in the download folders"""
+        folder, name = self._split(filename)
+        if not folder or not name:
+            return os.path.getsize(filename)
+
+        with self._lock:
+            entries = self._get_entries(folder)
+            if name not in entries:
+                if sys.platform in CASE_INSENSITIVE_PLATFORMS:
+                    return os.path.getsize(filename)
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+
+            size = entries[name]
+            if size is None:
+                size = os.path.getsize(filename)
+                entries[name] = size
+
+            return size
+
+    def invalidate(self, filename):
+        """Forget what is known about a file that has been changed"""
+        self._on_change(*self._split(filename))
+
+    def invalidate_folder(self, folder):
+        """Forget what is known about a folder that has been moved"""
+        self._on_change(os.path.normpath(folder), None)
+
+
+# The cache shared by everything that looks at downloaded files
+_cache = FileStateCache()
+
+exists = _cache.exists
+getsize = _cache.getsize
+invalidate = _cache.invalidate
+invalidate_folder = _cache.invalidate_folder
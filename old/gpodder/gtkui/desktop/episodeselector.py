@@ -20,7 +20,7 @@
 from gi.repository import Gtk, Pango
 
 import gpodder
-from gpodder import util
+from gpodder import query, util
 from gpodder.gtkui.interface.common import BuilderWidget, TreeViewHelper
 
 _ = gpodder.gettext
@@ -71,7 +71,9 @@ class gPodderEpisodeSelector(BuilderWidget):
                            the button is clicked, the callback will
                            be called for each episode and the return
                            value of the callback (True or False) will
-                           be the new selected state of the episode
+                           be the new selected state of the episode;
+                           instead of a callback, a query.EQL object
+                           can be used (answered by the database)
       - size_attribute: (optional) The name of an attribute of the
                         supplied episode objects that can be used to
                         calculate the size of an episode; set this to
@@ -346,6 +348,13 @@ class gPodderEpisodeSelector(BuilderWidget):
 
     def custom_selection_button_clicked(self, button, label):
         callback = self.selection_buttons[label]
+        if isinstance(callback, query.EQL):
+            if self.episodes:
+                matches = set(callback.find_episodes(self.episodes[0].db,
+                        self.episodes))
+            else:
+                matches = set()
+            callback = lambda episode: episode in matches
 
         for index, row in enumerate(self.model):
             new_value = callback(self.episodes[index])
@@ -47,6 +47,7 @@ class NewEpisodeActionList(Gtk.ListStore):
         self.append((_('Show episode list'), 'show'))
         self.append((_('Add to download list'), 'queue'))
         self.append((_('Download immediately'), 'download'))
+        self.append((_('Download the ones I am likely to play'), 'prefetch'))
 
     def get_index(self):
         for index, row in enumerate(self):
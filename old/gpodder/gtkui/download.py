@@ -46,6 +46,10 @@ class DownloadStatusModel(Gtk.ListStore):
 
         self.set_downloading_access = threading.RLock()
 
+        # Tasks by URL, including tasks that are not in the list yet
+        self._tasks_by_url = {}
+        self._tasks_by_url_lock = threading.Lock()
+
         # Set up stock icon IDs for tasks
         self._status_ids = collections.defaultdict(lambda: None)
         self._status_ids[download.DownloadTask.DOWNLOADING] = 'go-down'
@@ -73,11 +77,26 @@ class DownloadStatusModel(Gtk.ListStore):
             status_message = '%s: %s' % (
                     task.STATUS_MESSAGE[task.status],
                     task.error_message)
+        elif (task.status == task.DOWNLOADING and
+                task.activity == task.ACTIVITY_POSTPROCESS):
+            status_message = _('Post-processing')
+        elif task.status == task.QUEUED and getattr(task, 'waiting_for_space', False):
+            status_message = _('Waiting for free disk space')
         elif task.status == task.DOWNLOADING:
             status_message = '%s (%.0f%%, %s/s)' % (
                     task.STATUS_MESSAGE[task.status],
                     task.progress * 100,
                     util.format_filesize(task.speed))
+            eta = task.get_eta()
+            if eta is not None and eta < 24 * 60 * 60:
+                status_message = '%s, %s' % (status_message,
+                        _('%(time)s left') % {'time': util.format_time(eta)})
+            device_status = getattr(task, 'device_status', None)
+            if device_status and len(device_status) > 1:
+                status_message = '%s - %s' % (status_message, ', '.join(
+                    '%s %.0f%%' % (cgi.escape(path), value * 100) if isinstance(value, float)
+                    else '%s %s' % (cgi.escape(path), _('failed'))
+                    for path, value in device_status.items()))
         else:
             status_message = task.STATUS_MESSAGE[task.status]
 
@@ -104,14 +123,53 @@ class DownloadStatusModel(Gtk.ListStore):
                     status_message, task.episode.channel.title),
                 self.C_PROGRESS, 100. * task.progress,
                 self.C_PROGRESS_TEXT, progress_message,
-                self.C_ICON_NAME, self._status_ids[task.status])
+                self.C_ICON_NAME, self._get_icon_name(task))
+
+    def _get_icon_name(self, task):
+        if (task.status == task.DOWNLOADING and
+                task.activity == task.ACTIVITY_POSTPROCESS):
+            return 'system-run'
+
+        return self._status_ids[task.status]
+
+    def __add_new_tasks(self, tasks, callback):
+        for task in tasks:
+            iter = self.append()
+            self.request_update(iter, task)
 
-    def __add_new_task(self, task):
-        iter = self.append()
-        self.request_update(iter, task)
+        if callback is not None:
+            callback(tasks)
 
     def register_task(self, task):
-        util.idle_add(self.__add_new_task, task)
+        self.register_tasks([task])
+
+    def register_tasks(self, tasks, callback=None):
+        """Add tasks to the list with one call in the main loop
+
+        The tasks can be found with get_task_by_url() right away. After
+        they have been added, "callback" is called with the list of tasks
+        (in the main loop), e.g. to queue them.
+        """
+        tasks = list(tasks)
+        with self._tasks_by_url_lock:
+            for task in tasks:
+                if task.url:
+                    self._tasks_by_url[task.url] = task
+
+        util.idle_add(self.__add_new_tasks, tasks, callback)
+
+    def get_task_by_url(self, url):
+        with self._tasks_by_url_lock:
+            return self._tasks_by_url.get(url)
+
+    def remove(self, iter):
+        task = self.get_value(iter, self.C_TASK)
+        if task is not None and task.url:
+            with self._tasks_by_url_lock:
+                if self._tasks_by_url.get(task.url) is task:
+                    del self._tasks_by_url[task.url]
+
+        return Gtk.ListStore.remove(self, iter)
 
     def tell_all_tasks_to_quit(self):
         for row in self:
@@ -143,11 +201,21 @@ class DownloadStatusModel(Gtk.ListStore):
         return any(self._work_gen())
 
     def available_work_count(self):
-        return len(list(self._work_gen()))
+        return len([task for task in self._work_gen()
+                    if not getattr(task, 'waiting_for_space', False)])
+
+    def get_next(self, admit=None):
+        """Get the next queued task and set it to downloading
 
-    def get_next(self):
+        If "admit" is given, it is called for each queued task and
+        the first task for which it returns True is used.
+        """
         with self.set_downloading_access:
-            result = next(self._work_gen())
+            for result in self._work_gen():
+                if admit is None or admit(result):
+                    break
+            else:
+                raise StopIteration()
             self.set_downloading(result)
         return result
 
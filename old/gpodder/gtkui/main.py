@@ -32,7 +32,7 @@ import dbus.service
 
 import gpodder
 from gpodder import (common, download, extensions, feedcore, my, opml, player,
-                     util, youtube)
+                     prefetch, query, streamproxy, util, youtube)
 from gpodder.dbusproxy import DBusPodcastsProxy
 from gpodder.model import Model, PodcastEpisode
 from gpodder.syncui import gPodderSyncUI
@@ -128,6 +128,9 @@ class gPodder(BuilderWidget, dbus.service.Object):
 
         self.download_status_model = DownloadStatusModel()
         self.download_queue_manager = download.DownloadQueueManager(self.config, self.download_status_model)
+        self.prefetch_policy = prefetch.PrefetchPolicy(self.config)
+        self._prefetch_source_id = None
+        self._prefetch_pending = []
 
         self.config.connect_gtk_spinbutton('limit.downloads.concurrent', self.spinMaxDownloads,
                                            self.config.limit.downloads.concurrent_max)
@@ -175,6 +178,8 @@ class gPodder(BuilderWidget, dbus.service.Object):
         self.init_download_list_treeview()
 
         self.download_tasks_seen = set()
+        # URLs of episodes whose download tasks are being created
+        self.download_tasks_pending = set()
         self.download_list_update_enabled = False
         self.download_task_monitors = set()
 
@@ -845,11 +850,13 @@ class gPodder(BuilderWidget, dbus.service.Object):
         namecell.set_property('ellipsize', Pango.EllipsizeMode.END)
         namecolumn = Gtk.TreeViewColumn(_('Episode'))
         namecolumn.pack_start(iconcell, False)
-        namecolumn.add_attribute(iconcell, 'icon-name', EpisodeListModel.C_STATUS_ICON)
+        self.episode_list_model.set_cell_data_func(namecolumn, iconcell,
+                'icon-name', EpisodeListModel.C_STATUS_ICON)
         namecolumn.pack_start(namecell, True)
-        namecolumn.add_attribute(namecell, 'markup', EpisodeListModel.C_DESCRIPTION)
-        namecolumn.set_sort_column_id(EpisodeListModel.C_DESCRIPTION)
-        namecolumn.set_sizing(Gtk.TreeViewColumnSizing.AUTOSIZE)
+        self.episode_list_model.set_cell_data_func(namecolumn, namecell,
+                'markup', EpisodeListModel.C_DESCRIPTION)
+        namecolumn.set_sort_column_id(EpisodeListModel.C_TITLE)
+        namecolumn.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
         namecolumn.set_resizable(True)
         namecolumn.set_expand(True)
 
@@ -862,26 +869,51 @@ class gPodder(BuilderWidget, dbus.service.Object):
 
         sizecell = Gtk.CellRendererText()
         sizecell.set_property('xalign', 1)
-        sizecolumn = Gtk.TreeViewColumn(_('Size'), sizecell, text=EpisodeListModel.C_FILESIZE_TEXT)
+        sizecolumn = Gtk.TreeViewColumn(_('Size'), sizecell)
+        self.episode_list_model.set_cell_data_func(sizecolumn, sizecell,
+                'text', EpisodeListModel.C_FILESIZE_TEXT)
         sizecolumn.set_sort_column_id(EpisodeListModel.C_FILESIZE)
 
         timecell = Gtk.CellRendererText()
         timecell.set_property('xalign', 1)
-        timecolumn = Gtk.TreeViewColumn(_('Duration'), timecell, text=EpisodeListModel.C_TIME)
+        timecolumn = Gtk.TreeViewColumn(_('Duration'), timecell)
+        self.episode_list_model.set_cell_data_func(timecolumn, timecell,
+                'text', EpisodeListModel.C_TIME)
         timecolumn.set_sort_column_id(EpisodeListModel.C_TOTAL_TIME)
 
         releasecell = Gtk.CellRendererText()
-        releasecolumn = Gtk.TreeViewColumn(_('Released'), releasecell, text=EpisodeListModel.C_PUBLISHED_TEXT)
+        releasecolumn = Gtk.TreeViewColumn(_('Released'), releasecell)
+        self.episode_list_model.set_cell_data_func(releasecolumn, releasecell,
+                'text', EpisodeListModel.C_PUBLISHED_TEXT)
         releasecolumn.set_sort_column_id(EpisodeListModel.C_PUBLISHED)
 
         namecolumn.set_reorderable(True)
         self.treeAvailable.append_column(namecolumn)
 
-        for itemcolumn in (sizecolumn, timecolumn, releasecolumn):
+        # With fixed sizes, GTK does not have to measure (and so call the
+        # cell data functions for) every row of long episode lists
+        def text_width(text):
+            layout = self.treeAvailable.create_pango_layout(text)
+            return layout.get_pixel_size()[0] + 20
+
+        # "Today", "Yesterday", the weekday names and a date
+        release_samples = [util.format_date(time.time() - day * 24 * 60 * 60)
+                for day in range(8)]
+
+        for itemcolumn, samples in ((sizecolumn, ['9999.9 MiB']),
+                                    (timecolumn, ['99:99:99']),
+                                    (releasecolumn, release_samples)):
+            itemcolumn.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            itemcolumn.set_fixed_width(max(text_width(text) for text in
+                    samples + [itemcolumn.get_title()] if text))
+            itemcolumn.set_resizable(True)
             itemcolumn.set_reorderable(True)
             self.treeAvailable.append_column(itemcolumn)
             TreeViewHelper.register_column(self.treeAvailable, itemcolumn)
 
+        # All rows have the same height (all columns must be fixed-size)
+        self.treeAvailable.set_fixed_height_mode(True)
+
         # Add context menu to all tree view column headers
         for column in self.treeAvailable.get_columns():
             label = Gtk.Label(label=column.get_title())
@@ -1092,8 +1124,8 @@ class gPodder(BuilderWidget, dbus.service.Object):
         try:
             model = self.download_status_model
 
-            downloading, synchronizing, failed, finished, queued, paused, others = 0, 0, 0, 0, 0, 0, 0
-            total_speed, total_size, done_size = 0, 0, 0
+            downloading, synchronizing, postprocessing, failed, finished, queued, paused, others = 0, 0, 0, 0, 0, 0, 0, 0
+            total_speed, total_size, done_size, remaining_size = 0, 0, 0, 0
 
             # Keep a list of all download tasks that we've seen
             download_tasks_seen = set()
@@ -1121,9 +1153,13 @@ class gPodder(BuilderWidget, dbus.service.Object):
                         activity == download.DownloadTask.ACTIVITY_DOWNLOAD):
                     downloading += 1
                     total_speed += speed
+                    remaining_size += size * (1. - progress)
                 elif (status == download.DownloadTask.DOWNLOADING and
                         activity == download.DownloadTask.ACTIVITY_SYNCHRONIZE):
                     synchronizing += 1
+                elif (status == download.DownloadTask.DOWNLOADING and
+                        activity == download.DownloadTask.ACTIVITY_POSTPROCESS):
+                    postprocessing += 1
                 elif status == download.DownloadTask.FAILED:
                     failed += 1
                 elif status == download.DownloadTask.DONE:
@@ -1139,12 +1175,14 @@ class gPodder(BuilderWidget, dbus.service.Object):
             self.download_tasks_seen = download_tasks_seen
 
             text = [_('Progress')]
-            if downloading + failed + queued + synchronizing > 0:
+            if downloading + failed + queued + synchronizing + postprocessing > 0:
                 s = []
                 if downloading > 0:
                     s.append(N_('%(count)d active', '%(count)d active', downloading) % {'count': downloading})
                 if synchronizing > 0:
                     s.append(N_('%(count)d active', '%(count)d active', synchronizing) % {'count': synchronizing})
+                if postprocessing > 0:
+                    s.append(N_('%(count)d post-processing', '%(count)d post-processing', postprocessing) % {'count': postprocessing})
                 if failed > 0:
                     s.append(N_('%(count)d failed', '%(count)d failed', failed) % {'count': failed})
                 if queued > 0:
@@ -1170,17 +1208,27 @@ class gPodder(BuilderWidget, dbus.service.Object):
                 else:
                     percentage = 0.0
                 self.set_download_progress(percentage / 100)
-                total_speed = util.format_filesize(total_speed)
-                title[1] += ' (%d%%, %s/s)' % (percentage, total_speed)
+                if total_speed > 0 and remaining_size / total_speed < 24 * 60 * 60:
+                    eta = util.format_time(remaining_size / total_speed)
+                    title[1] += ' (%d%%, %s/s, %s)' % (percentage,
+                            util.format_filesize(total_speed),
+                            _('%(time)s left') % {'time': eta})
+                else:
+                    total_speed = util.format_filesize(total_speed)
+                    title[1] += ' (%d%%, %s/s)' % (percentage, total_speed)
             if synchronizing > 0:
                 title.append(N_('synchronizing %(count)d file',
                                 'synchronizing %(count)d files',
                                 synchronizing) % {'count': synchronizing})
+            if postprocessing > 0:
+                title.append(N_('post-processing %(count)d file',
+                                'post-processing %(count)d files',
+                                postprocessing) % {'count': postprocessing})
             if queued > 0:
                 title.append(N_('%(queued)d task queued',
                                 '%(queued)d tasks queued',
                                 queued) % {'queued': queued})
-            if (downloading + synchronizing + queued) == 0:
+            if (downloading + synchronizing + postprocessing + queued) == 0:
                 self.set_download_progress(1.)
                 self.downloads_finished(self.download_tasks_seen)
                 gpodder.user_extensions.on_all_episodes_downloaded()
@@ -1260,7 +1308,11 @@ class gPodder(BuilderWidget, dbus.service.Object):
             setattr(treeview, TreeViewHelper.LAST_TOOLTIP, id)
 
             if role == TreeViewHelper.ROLE_EPISODES:
-                description = model.get_value(iter, EpisodeListModel.C_TOOLTIP)
+                episode = model.get_value(iter, EpisodeListModel.C_EPISODE)
+                if episode is None:
+                    return False
+                description = self.episode_list_model.get_display_value(episode,
+                        EpisodeListModel.C_TOOLTIP)
                 if description:
                     tooltip.set_text(description)
                 else:
@@ -2017,6 +2069,16 @@ class gPodder(BuilderWidget, dbus.service.Object):
             allow_partial = (player != 'default')
             filename = episode.get_playback_url(fmt_ids, vimeo_fmt, allow_partial)
 
+            # Stream episodes that are being downloaded through the local
+            # proxy, so that players can seek in the growing partial file
+            task = episode.download_task
+            if (allow_partial and self.config.downloads.stream_proxy and
+                    task is not None and task.status in (task.QUEUED,
+                        task.DOWNLOADING, task.PAUSED)):
+                filename = streamproxy.get_url(task)
+                if task.status != task.DOWNLOADING:
+                    self.download_queue_manager.force_start_task(task)
+
             # Determine the playback resume position - if the file
             # was played 100%, we simply start from the beginning
             resume_position = episode.current_position
@@ -2487,24 +2549,48 @@ class gPodder(BuilderWidget, dbus.service.Object):
 
         return None
 
+    def get_episode_finder(self):
+        """Returns a faster find_episode() for looking up many episodes
+
+        The returned function uses dictionaries of podcasts and (built
+        when a podcast is first looked at) of their episodes by URL.
+        """
+        podcasts = dict((podcast.url, podcast) for podcast in self.channels)
+        episodes = {}
+
+        def find_episode(podcast_url, episode_url):
+            podcast = podcasts.get(podcast_url)
+            if podcast is None:
+                return None
+
+            if podcast_url not in episodes:
+                episodes[podcast_url] = dict((episode.url, episode)
+                        for episode in podcast.get_all_episodes())
+
+            return episodes[podcast_url].get(episode_url)
+
+        return find_episode
+
     def process_received_episode_actions(self):
         """Process/merge episode actions from gpodder.net
 
         This function will merge all changes received from
         the server to the local database and update the
         status of the affected episodes as necessary.
-        """
-        indicator = ProgressIndicator(_('Merging episode actions'),
-                _('Episode actions from gpodder.net are merged.'),
-                False, self.get_dialog_parent())
 
-        Gtk.main_iteration()
-
-        self.mygpo_client.process_episode_actions(self.find_episode)
+        It is called from a background thread, and commits all
+        changes to the database at once.
+        """
+        util.idle_add(self.pbFeedUpdate.set_text, _('Merging episode actions'))
 
-        indicator.on_finished()
+        updated_urls = []
+        self.mygpo_client.process_episode_actions(self.get_episode_finder(),
+                lambda episode: updated_urls.append(episode.url))
         self.db.commit()
 
+        if updated_urls:
+            util.idle_add(self.update_episode_list_icons, updated_urls)
+
     def _update_cover(self, channel):
         if channel is not None:
             self.cover_downloader.request_cover(channel)
@@ -2559,6 +2645,7 @@ class gPodder(BuilderWidget, dbus.service.Object):
         @util.run_in_background
         def update_feed_cache_proc():
             updated_channels = []
+            added_episodes = []
             for updated, channel in enumerate(channels):
                 if self.feed_cache_update_cancelled:
                     break
@@ -2571,7 +2658,8 @@ class gPodder(BuilderWidget, dbus.service.Object):
 
                 try:
                     util.idle_add(indicate_updating_podcast, channel)
-                    channel.update(max_episodes=self.config.max_episodes_per_feed)
+                    added_episodes.extend(channel.update(
+                        max_episodes=self.config.max_episodes_per_feed))
                     self._update_cover(channel)
                 except Exception as e:
                     d = {'url': cgi.escape(channel.url), 'message': cgi.escape(str(e))}
@@ -2597,10 +2685,10 @@ class gPodder(BuilderWidget, dbus.service.Object):
 
                 util.idle_add(update_progress, channel)
 
-            def update_feed_cache_finish_callback():
-                # Process received episode actions for all updated URLs
-                self.process_received_episode_actions()
+            # Process received episode actions for all updated URLs
+            self.process_received_episode_actions()
 
+            def update_feed_cache_finish_callback():
                 # If we are currently viewing "All episodes", update its episode list now
                 if self.active_channel is not None and \
                         getattr(self.active_channel, 'ALL_EPISODES_PROXY', False):
@@ -2633,7 +2721,7 @@ class gPodder(BuilderWidget, dbus.service.Object):
                     self.pbFeedUpdate.set_fraction(1.0)
 
                     if self.config.auto_download == 'download':
-                        self.download_episode_list(episodes)
+                        self.download_episode_list(episodes, automatic=True)
                         title = N_('Downloading %(count)d new episode.',
                                    'Downloading %(count)d new episodes.',
                                    count) % {'count': count}
@@ -2645,6 +2733,12 @@ class gPodder(BuilderWidget, dbus.service.Object):
                             '%(count)d new episodes added to download list.',
                             count) % {'count': count}
                         self.show_message(title, _('New episodes available'))
+                    elif self.config.auto_download == 'prefetch':
+                        self.prefetch_episodes(episodes)
+                        message = N_('%(count)d new episode available',
+                                     '%(count)d new episodes available',
+                                     count) % {'count': count}
+                        self.pbFeedUpdate.set_text(message)
                     else:
                         if (show_new_episodes_dialog and
                                 self.config.auto_download == 'show'):
@@ -2659,6 +2753,49 @@ class gPodder(BuilderWidget, dbus.service.Object):
 
             util.idle_add(update_feed_cache_finish_callback)
 
+            if self.config.downloads.preflight and added_episodes:
+                self.preflight_episodes(added_episodes)
+
+    def prefetch_episodes(self, episodes):
+        """Download the new episodes that are likely to be played
+
+        If other downloads are running, this waits until they are done.
+        """
+        if self._prefetch_source_id is not None:
+            GObject.source_remove(self._prefetch_source_id)
+            self._prefetch_source_id = None
+
+        # Episodes of earlier calls that are still waiting come first
+        pending, self._prefetch_pending = self._prefetch_pending, []
+        seen = set(pending)
+        episodes = pending + [e for e in episodes if e not in seen]
+
+        if self.download_status_model.are_downloads_in_progress():
+            def retry():
+                self._prefetch_source_id = None
+                self.prefetch_episodes([])
+                return False
+
+            self._prefetch_pending = episodes
+            self._prefetch_source_id = GObject.timeout_add(60 * 1000, retry)
+            return
+
+        episodes = [e for e in episodes if e.check_is_new()]
+        selected = self.prefetch_policy.select(episodes)
+        if selected:
+            self.download_episode_list(selected, automatic=True)
+
+    def preflight_episodes(self, episodes):
+        """Look up unknown sizes and types of episodes in the background"""
+        @util.run_in_background
+        def preflight_proc():
+            updated = common.preflight_episodes(episodes,
+                    self.config.limit.preflight.concurrent,
+                    self.config.limit.preflight.rate)
+            if updated:
+                util.idle_add(self.update_episode_list_icons,
+                        [episode.url for episode in updated])
+
     def on_gPodder_delete_event(self, *args):
         """Called when the GUI wants to close the window
         Displays a confirmation dialog (and closes/hides gPodder)
@@ -2709,6 +2846,7 @@ class gPodder(BuilderWidget, dbus.service.Object):
         while Gtk.events_pending():
             Gtk.main_iteration()
 
+        streamproxy.stop()
         self.core.shutdown()
 
         self.application.remove_window(self.gPodder)
@@ -2794,9 +2932,9 @@ class gPodder(BuilderWidget, dbus.service.Object):
 
         msg_older_than = N_('Select older than %(count)d day', 'Select older than %(count)d days', self.config.episode_old_age)
         selection_buttons = {
-                _('Select played'): lambda episode: not episode.is_new,
-                _('Select finished'): lambda episode: episode.is_finished(),
-                msg_older_than % {'count': self.config.episode_old_age}: lambda episode: episode.age_in_days() > self.config.episode_old_age,
+                _('Select played'): query.EQL('played'),
+                _('Select finished'): query.EQL('finished'),
+                msg_older_than % {'count': self.config.episode_old_age}: query.EQL('age > %d' % self.config.episode_old_age),
         }
 
         instructions = _('Select the episodes you want to delete:')
@@ -2914,56 +3052,41 @@ class gPodder(BuilderWidget, dbus.service.Object):
     def download_episode_list_paused(self, episodes):
         self.download_episode_list(episodes, True)
 
-    def download_episode_list(self, episodes, add_paused=False, force_start=False):
+    def download_episode_list(self, episodes, add_paused=False, force_start=False,
+            automatic=False):
         enable_update = False
 
         if self.config.downloads.chronological_order:
             # Download episodes in chronological order (older episodes first)
             episodes = list(Model.sort_episodes_by_pubdate(episodes))
 
+        new_episodes = []
+        requeue_tasks = []
         for episode in episodes:
             logger.debug('Downloading episode: %s', episode.title)
             if not episode.was_downloaded(and_exists=True):
-                task_exists = False
-                for task in self.download_tasks_seen:
-                    if episode.url == task.url:
-                        task_exists = True
-                        if task.status not in (task.DOWNLOADING, task.QUEUED):
-                            if force_start:
-                                self.download_queue_manager.force_start_task(task)
-                            else:
-                                self.download_queue_manager.queue_task(task)
-                            enable_update = True
-                            continue
-
-                if task_exists:
+                if episode.url in self.download_tasks_pending:
+                    # The task is being created already
                     continue
 
-                try:
-                    task = download.DownloadTask(episode, self.config)
-                except Exception as e:
-                    d = {'episode': episode.title, 'message': str(e)}
-                    message = _('Download error while downloading %(episode)s: %(message)s')
-                    self.show_message(message % d, _('Download error'), important=True)
-                    logger.error('While downloading %s', episode.title, exc_info=True)
-                    continue
-
-                # New Task, we must wait on the GTK Loop
-                self.download_status_model.register_task(task)
-
-                def queue_task(task):
-                    if add_paused:
-                        task.status = task.PAUSED
+                task = self.download_status_model.get_task_by_url(episode.url)
+                if task is None:
+                    new_episodes.append(episode)
+                elif task.status not in (task.DOWNLOADING, task.QUEUED):
+                    if force_start:
+                        self.download_queue_manager.force_start_task(task)
                     else:
-                        self.mygpo_client.on_download([task.episode])
-                        if force_start:
-                            self.download_queue_manager.force_start_task(task)
-                        else:
-                            self.download_queue_manager.queue_task(task)
-                # Executes after task has been registered
-                util.idle_add(queue_task, task)
+                        requeue_tasks.append(task)
+                    enable_update = True
+
+        if requeue_tasks:
+            self.download_queue_manager.queue_tasks(requeue_tasks)
 
-                enable_update = True
+        if new_episodes:
+            self.download_tasks_pending.update(e.url for e in new_episodes)
+            self.create_download_tasks(new_episodes, add_paused, force_start,
+                    automatic)
+            enable_update = True
 
         if enable_update:
             self.enable_download_list_update()
@@ -2972,6 +3095,54 @@ class gPodder(BuilderWidget, dbus.service.Object):
         if self.mygpo_client.can_access_webservice():
             self.mygpo_client.flush()
 
+    def create_download_tasks(self, episodes, add_paused, force_start,
+            automatic=False):
+        """Create download tasks in the background and add them all at once
+
+        Automatic downloads get a lower priority than manual ones when
+        the download queue is restored after a restart.
+        """
+        priority = download.DownloadTask.PRIORITY_AUTOMATIC if automatic else None
+
+        def queue_tasks(tasks):
+            self.download_tasks_pending.difference_update(e.url for e in episodes)
+
+            if add_paused:
+                for task in tasks:
+                    task.status = task.PAUSED
+            else:
+                self.mygpo_client.on_download([task.episode for task in tasks])
+                if force_start:
+                    for task in tasks:
+                        self.download_queue_manager.force_start_task(task)
+                else:
+                    self.download_queue_manager.queue_tasks(tasks)
+
+                if self.mygpo_client.can_access_webservice():
+                    self.mygpo_client.flush()
+
+            self.update_episode_list_icons([task.url for task in tasks])
+
+        def show_error(episode, error):
+            d = {'episode': episode.title, 'message': error}
+            message = _('Download error while downloading %(episode)s: %(message)s')
+            self.show_message(message % d, _('Download error'), important=True)
+
+        @util.run_in_background
+        def create_tasks_proc():
+            tasks = []
+            for episode in episodes:
+                try:
+                    tasks.append(download.DownloadTask(episode, self.config,
+                            priority))
+                except Exception as e:
+                    logger.error('While downloading %s', episode.title, exc_info=True)
+                    util.idle_add(show_error, episode, str(e))
+
+            # New Tasks, we must wait on the GTK Loop (once for all tasks);
+            # they are queued after they have been registered
+            self.download_status_model.register_tasks(tasks, queue_tasks)
+
     def cancel_task_list(self, tasks):
         if not tasks:
             return
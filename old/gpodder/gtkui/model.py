@@ -24,6 +24,7 @@
 #
 
 import cgi
+import collections
 import logging
 import os
 import re
@@ -32,7 +33,7 @@ import time
 from gi.repository import GdkPixbuf, GObject, Gtk
 
 import gpodder
-from gpodder import coverart, model, query, util
+from gpodder import coverart, model, searchindex, util
 from gpodder.gtkui import draw
 
 _ = gpodder.gettext
@@ -110,36 +111,44 @@ class SectionMarker(object): pass
 
 
 class BackgroundUpdate(object):
-    def __init__(self, model, episodes, include_description):
+    """Fills the rows of the episode list model in small steps
+
+    Rows that do not exist yet are appended, so a long list shows up
+    right away and grows while the user can already work with it.
+    """
+    def __init__(self, model, episodes):
         self.model = model
         self.episodes = episodes
-        self.include_description = include_description
         self.index = 0
 
+    @property
+    def remaining(self):
+        return self.episodes[self.index:]
+
     def update(self):
         model = self.model
-        include_description = self.include_description
 
         started = time.time()
-        while self.episodes:
-            episode = self.episodes.pop(0)
-            base_fields = (
-                (model.C_URL, episode.url),
-                (model.C_TITLE, episode.title),
-                (model.C_EPISODE, episode),
-                (model.C_PUBLISHED_TEXT, episode.cute_pubdate()),
-                (model.C_PUBLISHED, episode.published),
-            )
-            update_fields = model.get_update_fields(episode, include_description)
-            model.set(model.get_iter((self.index,)), *(x for fields in (base_fields, update_fields)
-                                                       for pair in fields for x in pair))
+        while self.index < len(self.episodes):
+            episode = self.episodes[self.index]
+            fields = ((model.C_URL, episode.url),
+                      (model.C_TITLE, episode.title),
+                      (model.C_EPISODE, episode),
+                      (model.C_PUBLISHED, episode.published)) + \
+                model.get_update_fields(episode)
+            model._index_episode(self.index, episode, fields)
+            columns, values = [list(x) for x in zip(*fields)]
+            if self.index < len(model):
+                model.set(model.get_iter((self.index,)), columns, values)
+            else:
+                model.insert_with_valuesv(-1, columns, values)
             self.index += 1
 
             # Check for the time limit of 20 ms after each 50 rows processed
             if self.index % 50 == 0 and (time.time() - started) > 0.02:
                 break
 
-        return bool(self.episodes)
+        return self.index < len(self.episodes)
 
 
 class EpisodeListModel(Gtk.ListStore):
@@ -154,12 +163,25 @@ class EpisodeListModel(Gtk.ListStore):
 
     VIEWS = ['VIEW_ALL', 'VIEW_UNDELETED', 'VIEW_DOWNLOADED', 'VIEW_UNPLAYED']
 
+    # Columns with the flags that decide if a row is shown in a view mode
+    VIEW_FLAGS = {
+        VIEW_UNDELETED: C_VIEW_SHOW_UNDELETED,
+        VIEW_DOWNLOADED: C_VIEW_SHOW_DOWNLOADED,
+        VIEW_UNPLAYED: C_VIEW_SHOW_UNPLAYED,
+    }
+
     # In which steps the UI is updated for "loading" animations
     _UI_UPDATE_STEP = .03
 
     # Steps for the "downloading" icon progress
     PROGRESS_STEPS = 20
 
+    # Columns that are not stored in the list, but computed when a row
+    # is displayed (see get_display_value()), and how many rows to cache
+    DISPLAY_COLUMNS = (C_STATUS_ICON, C_DESCRIPTION, C_TOOLTIP, C_TIME,
+                       C_FILESIZE_TEXT, C_PUBLISHED_TEXT)
+    ROW_CACHE_SIZE = 1000
+
     def __init__(self, config, on_filter_changed=lambda has_episodes: None):
         Gtk.ListStore.__init__(self, str, str, str, object, str, str, str,
                                str, bool, bool, bool, GObject.TYPE_INT64,
@@ -177,12 +199,16 @@ class EpisodeListModel(Gtk.ListStore):
         self._sorter = Gtk.TreeModelSort(self._filter)
         self._view_mode = self.VIEW_ALL
         self._search_term = None
-        self._search_term_eql = None
+        self._search_index = searchindex.SearchIndex()
         self._filter.set_visible_func(self._filter_visible_func)
 
         # Are we currently showing the "all episodes" view?
         self._all_episodes_view = False
 
+        # Display fields of recently shown episodes (see get_display_value)
+        self._include_description = False
+        self._row_cache = collections.OrderedDict()
+
         self.ICON_AUDIO_FILE = 'audio-x-generic'
         self.ICON_VIDEO_FILE = 'video-x-generic'
         self.ICON_IMAGE_FILE = 'image-x-generic'
@@ -206,27 +232,51 @@ class EpisodeListModel(Gtk.ListStore):
             return None
 
     def _filter_visible_func(self, model, iter, misc):
-        # If searching is active, set visibility based on search text
-        if self._search_term is not None:
-            episode = model.get_value(iter, self.C_EPISODE)
-            if episode is None:
-                return False
+        # The search results and view mode flags of all rows are kept in
+        # the search index, so there is no need to look at the row here
+        index = model.get_path(iter).get_indices()[0]
+        return self._search_index.is_visible(index,
+                self.VIEW_FLAGS.get(self._view_mode))
+
+    def _index_episode(self, index, episode, update_fields):
+        # Must be called before the row is set, so the filter sees the changes
+        flags = dict((column, value) for column, value in update_fields
+                if column in self.VIEW_FLAGS.values())
+        self._search_index.set_row(index, episode, flags)
+
+    def clear(self):
+        self._search_index.clear()
+        self._row_cache.clear()
+        Gtk.ListStore.clear(self)
+
+    def get_display_value(self, episode, column):
+        """Get the value of one of the DISPLAY_COLUMNS for an episode
+
+        These are expensive to compute (they need to look at the file
+        of the episode), so they are only computed for rows that are
+        displayed and kept in a cache until the episode is updated.
+        """
+        fields = self._row_cache.get(episode)
+        if fields is None:
+            fields = dict(self.get_display_fields(episode, self._include_description))
+            self._row_cache[episode] = fields
+            if len(self._row_cache) > self.ROW_CACHE_SIZE:
+                self._row_cache.popitem(last=False)
+        else:
+            self._row_cache.move_to_end(episode)
 
-            try:
-                return self._search_term_eql.match(episode)
-            except Exception as e:
-                return True
+        return fields[column]
 
-        if self._view_mode == self.VIEW_ALL:
-            return True
-        elif self._view_mode == self.VIEW_UNDELETED:
-            return model.get_value(iter, self.C_VIEW_SHOW_UNDELETED)
-        elif self._view_mode == self.VIEW_DOWNLOADED:
-            return model.get_value(iter, self.C_VIEW_SHOW_DOWNLOADED)
-        elif self._view_mode == self.VIEW_UNPLAYED:
-            return model.get_value(iter, self.C_VIEW_SHOW_UNPLAYED)
+    def set_cell_data_func(self, treecolumn, cell, attribute, column):
+        """Show one of the DISPLAY_COLUMNS as "attribute" of a cell"""
+        def cell_data_func(treecolumn, cell, model, iter, data):
+            episode = model.get_value(iter, self.C_EPISODE)
+            if episode is None:
+                cell.set_property(attribute, None)
+            else:
+                cell.set_property(attribute, self.get_display_value(episode, column))
 
-        return True
+        treecolumn.set_cell_data_func(cell, cell_data_func)
 
     def get_filtered_model(self):
         """Returns a filtered version of this episode model
@@ -262,7 +312,7 @@ class EpisodeListModel(Gtk.ListStore):
     def set_search_term(self, new_term):
         if self._search_term != new_term:
             self._search_term = new_term
-            self._search_term_eql = query.UserEQL(new_term)
+            self._search_index.set_search(new_term)
             self._filter.refilter()
             self._on_filter_changed(self.has_episodes())
 
@@ -311,17 +361,20 @@ class EpisodeListModel(Gtk.ListStore):
         # Always make a copy, so we can pass the episode list to BackgroundUpdate
         episodes = list(episodes)
 
-        for _ in range(len(episodes)):
-            self.append()
-
         self._update_from_episodes(episodes, include_description)
 
     def _update_from_episodes(self, episodes, include_description):
         if self.background_update_tag is not None:
             GObject.source_remove(self.background_update_tag)
 
-        self.background_update = BackgroundUpdate(self, episodes, include_description)
-        self.background_update_tag = GObject.idle_add(self._update_background)
+        self._include_description = include_description
+        self._row_cache.clear()
+
+        # Fill the first screen right away, the rest when idle
+        self.background_update = BackgroundUpdate(self, episodes)
+        self.background_update_tag = None
+        if self._update_background():
+            self.background_update_tag = GObject.idle_add(self._update_background)
 
     def _update_background(self):
         if self.background_update is not None:
@@ -341,7 +394,7 @@ class EpisodeListModel(Gtk.ListStore):
             # Update all episodes that have already been initialized...
             episodes = [row[self.C_EPISODE] for index, row in enumerate(self) if index < self.background_update.index]
             # ...and also include episodes that still need to be initialized
-            episodes.extend(self.background_update.episodes)
+            episodes.extend(self.background_update.remaining)
 
         self._update_from_episodes(episodes, include_description)
 
@@ -357,16 +410,41 @@ class EpisodeListModel(Gtk.ListStore):
         self.update_by_iter(self._filter.convert_iter_to_child_iter(iter),
                 include_description)
 
-    def get_update_fields(self, episode, include_description):
+    def get_update_fields(self, episode):
+        """Get the fields that are stored in the list for sorting and filtering"""
+        view_show_undeleted = True
+        view_show_downloaded = False
+        view_show_unplayed = False
+
+        if episode.downloading:
+            view_show_downloaded = True
+            view_show_unplayed = True
+        elif episode.state == gpodder.STATE_DELETED:
+            view_show_undeleted = False
+        elif episode.state == gpodder.STATE_NORMAL and episode.is_new:
+            view_show_downloaded = True
+            view_show_unplayed = True
+        elif episode.state == gpodder.STATE_DOWNLOADED:
+            view_show_downloaded = True
+            view_show_unplayed = episode.is_new
+
+        return (
+                (self.C_VIEW_SHOW_UNDELETED, view_show_undeleted),
+                (self.C_VIEW_SHOW_DOWNLOADED, view_show_downloaded),
+                (self.C_VIEW_SHOW_UNPLAYED, view_show_unplayed),
+                (self.C_TIME_VISIBLE, bool(episode.total_time)),
+                (self.C_TOTAL_TIME, episode.total_time),
+                (self.C_LOCKED, episode.archive),
+                (self.C_FILESIZE, episode.file_size),
+        )
+
+    def get_display_fields(self, episode, include_description):
+        """Get the fields of the DISPLAY_COLUMNS"""
         show_bullet = False
         show_padlock = False
         show_missing = False
         status_icon = None
         tooltip = []
-        view_show_undeleted = True
-        view_show_downloaded = False
-        view_show_unplayed = False
-        icon_theme = Gtk.IconTheme.get_default()
 
         if episode.downloading:
             tooltip.append('%s %d%%' % (_('Downloading'),
@@ -374,27 +452,18 @@ class EpisodeListModel(Gtk.ListStore):
 
             index = int(self.PROGRESS_STEPS * episode.download_task.progress)
             status_icon = 'gpodder-progress-%d' % index
-
-            view_show_downloaded = True
-            view_show_unplayed = True
         else:
             if episode.state == gpodder.STATE_DELETED:
                 tooltip.append(_('Deleted'))
                 status_icon = self.ICON_DELETED
-                view_show_undeleted = False
             elif episode.state == gpodder.STATE_NORMAL and \
                     episode.is_new:
                 tooltip.append(_('New episode'))
-                view_show_downloaded = True
-                view_show_unplayed = True
             elif episode.state == gpodder.STATE_DOWNLOADED:
                 tooltip = []
-                view_show_downloaded = True
-                view_show_unplayed = episode.is_new
                 show_bullet = episode.is_new
                 show_padlock = episode.archive
                 show_missing = not episode.file_exists()
-                filename = episode.local_filename(create=False, check_only=True)
 
                 file_type = episode.file_type()
                 if file_type == 'audio':
@@ -444,23 +513,25 @@ class EpisodeListModel(Gtk.ListStore):
         description = ''.join(self._format_description(episode, include_description))
         return (
                 (self.C_STATUS_ICON, status_icon),
-                (self.C_VIEW_SHOW_UNDELETED, view_show_undeleted),
-                (self.C_VIEW_SHOW_DOWNLOADED, view_show_downloaded),
-                (self.C_VIEW_SHOW_UNPLAYED, view_show_unplayed),
                 (self.C_DESCRIPTION, description),
                 (self.C_TOOLTIP, tooltip),
                 (self.C_TIME, episode.get_play_info_string()),
-                (self.C_TIME_VISIBLE, bool(episode.total_time)),
-                (self.C_TOTAL_TIME, episode.total_time),
-                (self.C_LOCKED, episode.archive),
                 (self.C_FILESIZE_TEXT, self._format_filesize(episode)),
-                (self.C_FILESIZE, episode.file_size),
+                (self.C_PUBLISHED_TEXT, episode.cute_pubdate()),
         )
 
     def update_by_iter(self, iter, include_description=False):
         episode = self.get_value(iter, self.C_EPISODE)
         if episode is not None:
-            self.set(iter, *(x for pair in self.get_update_fields(episode, include_description) for x in pair))
+            if include_description != self._include_description:
+                self._include_description = include_description
+                self._row_cache.clear()
+            else:
+                self._row_cache.pop(episode, None)
+
+            update_fields = self.get_update_fields(episode)
+            self._index_episode(self.get_path(iter).get_indices()[0], episode, update_fields)
+            self.set(iter, *(x for pair in update_fields for x in pair))
 
 
 class PodcastChannelProxy(object):
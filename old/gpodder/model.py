@@ -33,12 +33,13 @@ import os
 import re
 import shutil
 import string
+import threading
 import time
 
 import gpodder
 import podcastparser
-from gpodder import (coverart, escapist_videos, feedcore, schema, util, vimeo,
-                     youtube)
+from gpodder import (coverart, escapist_videos, feedcore, filecache, resolver,
+                     schema, util, vimeo, youtube)
 
 logger = logging.getLogger(__name__)
 
@@ -304,8 +305,17 @@ class PodcastEpisode(PodcastModelObject):
     def on_downloaded(self, filename):
         self.state = gpodder.STATE_DOWNLOADED
         self.is_new = True
-        self.file_size = os.path.getsize(filename)
+        filecache.invalidate(filename)
+        self.file_size = filecache.getsize(filename)
         self.save()
+        self.channel.model.add_to_content_index(self)
+
+    def find_downloaded_duplicate(self):
+        """Find a downloaded episode (in any podcast) with the same file
+
+        Returns a tuple (episode, filename) or (None, None).
+        """
+        return self.channel.model.find_in_content_index(self)
 
     def set_state(self, state):
         self.state = state
@@ -360,7 +370,10 @@ class PodcastEpisode(PodcastModelObject):
         filename = self.local_filename(create=False, check_only=True)
         if filename is not None:
             gpodder.user_extensions.on_episode_delete(self, filename)
+            # Files shared with other episodes (see link_duplicate() in
+            # DownloadTask) are links, so the others keep their copy
             util.delete_file(filename)
+            filecache.invalidate(filename)
 
         self.set_state(gpodder.STATE_DELETED)
 
@@ -376,14 +389,11 @@ class PodcastEpisode(PodcastModelObject):
         url = self.local_filename(create=False)
 
         if (allow_partial and url is not None and
-                os.path.exists(url + '.partial')):
+                filecache.exists(url + '.partial')):
             return url + '.partial'
 
-        if url is None or not os.path.exists(url):
-            url = self.url
-            url = youtube.get_real_download_url(url, fmt_ids)
-            url = vimeo.get_real_download_url(url, vimeo_fmt)
-            url = escapist_videos.get_real_download_url(url)
+        if url is None or not filecache.exists(url):
+            url = resolver.get_media_url(self.url, fmt_ids, vimeo_fmt)
 
         return url
 
@@ -451,7 +461,7 @@ class PodcastEpisode(PodcastModelObject):
             if 'redirect' in episode_filename and template is None:
                 # This looks like a redirection URL - force URL resolving!
                 logger.warn('Looks like a redirection to me: %s', self.url)
-                url = util.get_real_url(self.channel.authenticate_url(self.url))
+                url = resolver.resolve(self.channel.authenticate_url(self.url)).url
                 logger.info('Redirection resolved to: %s', url)
                 episode_filename, _ = util.filename_from_url(url)
 
@@ -487,10 +497,12 @@ class PodcastEpisode(PodcastModelObject):
                 # there might be an old download folder crawling around - move it!
                 new_file_name = os.path.join(self.channel.save_dir, wanted_filename)
                 old_file_name = os.path.join(self.channel.save_dir, self.download_filename)
-                if os.path.exists(old_file_name) and not os.path.exists(new_file_name):
+                if filecache.exists(old_file_name) and not filecache.exists(new_file_name):
                     logger.info('Renaming %s => %s', old_file_name, new_file_name)
                     os.rename(old_file_name, new_file_name)
-                elif force_update and not os.path.exists(old_file_name):
+                    filecache.invalidate(old_file_name)
+                    filecache.invalidate(new_file_name)
+                elif force_update and not filecache.exists(old_file_name):
                     # When we call force_update, the file might not yet exist when we
                     # call it from the downloading code before saving the file
                     logger.info('Choosing new filename: %s', new_file_name)
@@ -531,7 +543,7 @@ class PodcastEpisode(PodcastModelObject):
         if filename is None:
             return False
         else:
-            return os.path.exists(filename)
+            return filecache.exists(filename)
 
     def was_downloaded(self, and_exists=False):
         if self.state != gpodder.STATE_DOWNLOADED:
@@ -745,7 +757,9 @@ class PodcastChannel(PodcastModelObject):
                     # No filename has been determined for this episode
                     continue
 
-                if not os.path.exists(filename):
+                # Ask the file system, too: it might ignore case or
+                # Unicode normalization of the name (unlike the cache)
+                if not filecache.exists(filename) and not os.path.exists(filename):
                     # File has been deleted by the user - simulate a
                     # delete event (also marks the episode as deleted)
                     logger.debug('Episode deleted: %s', filename)
@@ -914,6 +928,8 @@ class PodcastChannel(PodcastModelObject):
 
         self.remove_unreachable_episodes(existing, seen_guids, max_episodes)
 
+        return new_episodes
+
     def _consume_updated_feed(self, feed, max_episodes=0):
         self._consume_metadata(feed.get('title', self.url),
                                feed.get('link', self.link),
@@ -957,6 +973,9 @@ class PodcastChannel(PodcastModelObject):
         # Number of new episodes found
         new_episodes = 0
 
+        # Episodes that have been added to the database
+        added_episodes = []
+
         # Search all entries for new episodes
         for entry in entries:
             episode = self.EpisodeClass.from_podcastparser_entry(entry, self)
@@ -989,9 +1008,12 @@ class PodcastChannel(PodcastModelObject):
 
             episode.save()
             self.children.append(episode)
+            added_episodes.append(episode)
 
         self.remove_unreachable_episodes(existing, seen_guids, max_episodes)
 
+        return added_episodes
+
     def remove_unreachable_episodes(self, existing, seen_guids, max_episodes):
         # Remove "unreachable" episodes - episodes that have not been
         # downloaded and that the feed does not list as downloadable anymore
@@ -1021,13 +1043,18 @@ class PodcastChannel(PodcastModelObject):
         self.children.sort(key=lambda e: e.published, reverse=True)
 
     def update(self, max_episodes=0):
+        """Update the podcast from its feed
+
+        Returns the list of episodes that have been added.
+        """
+        added_episodes = []
         try:
             result = self.feed_fetcher.fetch_channel(self)
 
             if result.status == feedcore.CUSTOM_FEED:
-                self._consume_custom_feed(result.feed, max_episodes)
+                added_episodes = self._consume_custom_feed(result.feed, max_episodes)
             elif result.status == feedcore.UPDATED_FEED:
-                self._consume_updated_feed(result.feed, max_episodes)
+                added_episodes = self._consume_updated_feed(result.feed, max_episodes)
             elif result.status == feedcore.NEW_LOCATION:
                 url = result.feed
                 logger.info('New feed location: %s => %s', self.url, url)
@@ -1035,8 +1062,7 @@ class PodcastChannel(PodcastModelObject):
                     raise Exception('Already subscribed to ' + url)
                 self.url = url
                 # With the updated URL, fetch the feed again
-                self.update(max_episodes)
-                return
+                return self.update(max_episodes)
             elif result.status == feedcore.NOT_MODIFIED:
                 pass
 
@@ -1064,6 +1090,8 @@ class PodcastChannel(PodcastModelObject):
 
         self.db.commit()
 
+        return added_episodes
+
     def delete(self):
         self.db.delete_podcast(self)
         self.model._remove_podcast(self)
@@ -1137,6 +1165,8 @@ class PodcastChannel(PodcastModelObject):
                         shutil.move(file, new_folder)
                     logger.info('Removing %s', old_folder)
                     shutil.rmtree(old_folder, ignore_errors=True)
+                filecache.invalidate_folder(old_folder)
+                filecache.invalidate_folder(new_folder)
             self.download_folder = new_folder_name
 
         self.title = new_title
@@ -1227,6 +1257,10 @@ class Model(object):
         self.db = db
         self.children = None
 
+        # Downloaded episodes by normalized enclosure URL (built on demand)
+        self._content_index = None
+        self._content_index_lock = threading.RLock()
+
     def _append_podcast(self, podcast):
         if podcast not in self.children:
             self.children.append(podcast)
@@ -1248,6 +1282,53 @@ class Model(object):
 
         return self.children
 
+    def _get_content_index(self):
+        with self._content_index_lock:
+            if self._content_index is None:
+                self._content_index = collections.defaultdict(list)
+                for podcast in self.get_podcasts():
+                    for episode in podcast.get_episodes(gpodder.STATE_DOWNLOADED):
+                        self.add_to_content_index(episode)
+
+            return self._content_index
+
+    def add_to_content_index(self, episode):
+        with self._content_index_lock:
+            if self._content_index is None:
+                # Will be picked up when the index is built
+                return
+
+            episodes = self._content_index[util.normalize_enclosure_url(episode.url)]
+            if episode not in episodes:
+                episodes.append(episode)
+
+    def find_in_content_index(self, episode):
+        """See PodcastEpisode.find_downloaded_duplicate()
+
+        Entries are checked when they are looked up, so episodes that
+        have been deleted since they were added are skipped (and removed).
+        """
+        with self._content_index_lock:
+            episodes = self._get_content_index().get(
+                    util.normalize_enclosure_url(episode.url), [])
+            for other in list(episodes):
+                if other is episode:
+                    continue
+
+                filename = other.local_filename(create=False, check_only=True)
+                if (other.state != gpodder.STATE_DOWNLOADED or filename is None or
+                        not filecache.exists(filename)):
+                    episodes.remove(other)
+                    continue
+
+                if episode.file_size > 0 and episode.file_size != filecache.getsize(filename):
+                    # Same URL, but the feeds disagree about the file
+                    continue
+
+                return other, filename
+
+        return None, None
+
     def get_podcast(self, url):
         for p in self.get_podcasts():
             if p.url == url:
@@ -26,10 +26,12 @@
 
 import atexit
 import calendar
+import collections
 import datetime
 import logging
 import os
 import sys
+import threading
 import time
 
 import gpodder
@@ -72,6 +74,15 @@ except ImportError:
 
 EPISODE_ACTIONS_BATCH_SIZE = 100
 
+# Upload at most this many batches per flush, the rest follows right after
+EPISODE_ACTIONS_MAX_BATCHES = 10
+
+# Play ranges that are at most this many seconds apart are merged
+PLAY_RANGE_GAP = 5
+
+# Actions that describe the state of the episode file
+EPISODE_STATE_ACTIONS = ('download', 'delete', 'new')
+
 
 # Database model classes
 class SinceValue(object):
@@ -166,6 +177,123 @@ class RewrittenUrl(object):
 # End Database model classes
 
 
+def compact_episode_actions(actions):
+    """Drop redundant episode actions before uploading them
+
+    The actions are grouped by episode and device. Within each group:
+
+     - A play range that continues the previous one (playback resumed
+       where it stopped, or the same range was sent again) is merged
+       into it, keeping the timestamp of the later action
+     - Play actions without a position are only kept if there is no
+       other play action (the ranged ones say "played", too)
+     - Of download, delete and new actions only the latest one is kept,
+       as it describes the current state of the episode file
+
+    Returns the list of actions to upload, in timestamp order. The
+    result contains new objects for merged play actions; the input
+    actions are not modified.
+    """
+    groups = collections.OrderedDict()
+    for action in sorted(actions, key=lambda a: a.timestamp):
+        key = (action.podcast_url, action.episode_url, action.device_id)
+        groups.setdefault(key, []).append(action)
+
+    result = []
+    for group in groups.values():
+        plays = []
+        bare_play = None
+        state = None
+
+        for action in group:
+            if action.action in EPISODE_STATE_ACTIONS:
+                state = action
+            elif action.action != 'play':
+                # Unknown action type, keep as-is
+                result.append(action)
+            elif action.position is None:
+                bare_play = action
+            elif (plays and plays[-1].total == action.total and
+                    plays[-1].started is not None and action.started is not None and
+                    plays[-1].started <= action.started <= plays[-1].position + PLAY_RANGE_GAP and
+                    action.position >= plays[-1].position):
+                last = plays[-1]
+                plays[-1] = EpisodeAction(last.podcast_url, last.episode_url,
+                        last.device_id, 'play', action.timestamp,
+                        last.started, action.position, action.total)
+            else:
+                plays.append(action)
+
+        result.extend(plays)
+        if bare_play is not None and not plays:
+            result.append(bare_play)
+        if state is not None:
+            result.append(state)
+
+    result.sort(key=lambda a: a.timestamp)
+    return result
+
+
+# Helper class for merging received episode actions
+class MergedEpisodeAction(object):
+    """The combined effect of all received actions for one episode
+
+    Applying it has the same result as applying the actions one by one
+    in the order they were received, but updates (and saves) the episode
+    only once for all play actions and once for all delete actions.
+    """
+    def __init__(self):
+        self.played = False
+        self.deleted = False
+        self.position = None
+        self.position_timestamp = None
+        self.total = None
+
+    def add(self, action):
+        if action.action == 'play':
+            self.played = True
+
+            if (action.position is not None and
+                    (self.position_timestamp is None or
+                     action.timestamp > self.position_timestamp)):
+                self.position = action.position
+                self.position_timestamp = action.timestamp
+
+            if action.total:
+                self.total = action.total
+        elif action.action == 'delete':
+            self.deleted = True
+
+    def apply(self, episode):
+        """Update the episode, returns True if it has been changed"""
+        changed = False
+
+        if self.played:
+            logger.debug('Play action for %s', episode.url)
+
+            if (self.position is not None and
+                    self.position_timestamp > episode.current_position_updated):
+                logger.debug('Updating position for %s', episode.url)
+                episode.current_position = self.position
+                episode.current_position_updated = self.position_timestamp
+
+            if self.total:
+                logger.debug('Updating total time for %s', episode.url)
+                episode.total_time = self.total
+
+            # This saves the episode, too
+            episode.mark(is_played=True)
+            changed = True
+
+        if self.deleted and not episode.was_downloaded(and_exists=True):
+            # Set the episode to a "deleted" state (this saves it, too)
+            logger.debug('Marking as deleted: %s', episode.url)
+            episode.delete_from_disk()
+            changed = True
+
+        return changed
+
+
 # Helper class for displaying changes in the UI
 class Change(object):
     def __init__(self, action, podcast=None):
@@ -182,8 +310,15 @@ class Change(object):
 
 class MygPoClient(object):
     STORE_FILE = 'gpodder.net'
-    FLUSH_TIMEOUT = 60
-    FLUSH_RETRIES = 3
+    # Wait for more changes this long before flushing...
+    FLUSH_DELAY = 10
+    # ...but never delay a requested flush longer than this
+    FLUSH_MAX_DELAY = 60
+    # Failed flushes are retried after 30 s, 60 s, 120 s, ... up to 1 h
+    RETRY_DELAY = 30
+    MAX_RETRY_DELAY = 60 * 60
+    # Seconds to wait for a running upload when quitting
+    SHUTDOWN_TIMEOUT = 5
 
     def __init__(self, config):
         self._store = minidb.Store(os.path.join(gpodder.home, self.STORE_FILE))
@@ -198,8 +333,19 @@ class MygPoClient(object):
         self._config.add_observer(self.on_config_changed)
 
         self._worker_thread = None
+        self._worker_cond = threading.Condition()
+        self._flush_due = None
+        self._flush_requested = None
+        self._failures = 0
+        self._stopping = False
+        # Set if the worker thread has to close the store when it exits
+        self._worker_closes_store = False
         atexit.register(self._at_exit)
 
+        # Upload what could not be uploaded in the previous session
+        if self.can_access_webservice() and self.has_pending_actions():
+            self.flush()
+
     def create_device(self):
         """Uploads the device changes to the server
 
@@ -237,44 +383,36 @@ class MygPoClient(object):
         The optional callback "on_updated" should accept a single
         parameter (the episode object) and will be called whenever
         the episode data is changed in some way.
+
+        The changed episodes are saved, but not committed to the
+        database, so that the caller can commit all changes at once.
         """
         logger.debug('Processing received episode actions...')
+
+        # Collapse all actions for the same episode, so that every
+        # episode is looked up and saved only once
+        merged_actions = collections.OrderedDict()
         for action in self._store.load(ReceivedEpisodeAction):
             if action.action not in ('play', 'delete'):
                 # Ignore all other action types for now
                 continue
 
-            episode = find_episode(action.podcast_url, action.episode_url)
+            key = (action.podcast_url, action.episode_url)
+            merged_action = merged_actions.get(key)
+            if merged_action is None:
+                merged_action = merged_actions[key] = MergedEpisodeAction()
+            merged_action.add(action)
+
+        logger.debug('Merging actions for %d episodes', len(merged_actions))
+        for (podcast_url, episode_url), merged_action in merged_actions.items():
+            episode = find_episode(podcast_url, episode_url)
 
             if episode is None:
                 # The episode does not exist on this client
                 continue
 
-            if action.action == 'play':
-                logger.debug('Play action for %s', episode.url)
-                episode.mark(is_played=True)
-
-                if (action.timestamp > episode.current_position_updated and
-                        action.position is not None):
-                    logger.debug('Updating position for %s', episode.url)
-                    episode.current_position = action.position
-                    episode.current_position_updated = action.timestamp
-
-                if action.total:
-                    logger.debug('Updating total time for %s', episode.url)
-                    episode.total_time = action.total
-
-                episode.save()
-                if on_updated is not None:
-                    on_updated(episode)
-            elif action.action == 'delete':
-                if not episode.was_downloaded(and_exists=True):
-                    # Set the episode to a "deleted" state
-                    logger.debug('Marking as deleted: %s', episode.url)
-                    episode.delete_from_disk()
-                    episode.save()
-                    if on_updated is not None:
-                        on_updated(episode)
+            if merged_action.apply(episode) and on_updated is not None:
+                on_updated(episode)
 
         # Remove all received episode actions
         self._store.delete(ReceivedEpisodeAction)
@@ -384,77 +522,165 @@ class MygPoClient(object):
 
         self.flush()
 
+    def has_pending_actions(self):
+        return any(self._store.load(klass) for klass in
+                (UpdateDeviceAction, SubscribeAction, EpisodeAction))
+
     def _at_exit(self):
-        self._worker_proc(forced=True)
+        with self._worker_cond:
+            if self._stopping:
+                return
+            self._stopping = True
+            self._worker_cond.notify_all()
+            worker_thread = self._worker_thread
+
+        if worker_thread is not None:
+            # Give a running upload the chance to finish its current batch,
+            # but never block on the network; the rest is uploaded next time
+            worker_thread.join(self.SHUTDOWN_TIMEOUT)
+
+        # Always keep the queued actions (the worker is a daemon thread,
+        # so it might not get the chance to commit them)
         self._store.commit()
-        self._store.close()
 
-    def _worker_proc(self, forced=False):
-        if not forced:
-            # Store the current contents of the queue database
+        if worker_thread is not None:
+            with self._worker_cond:
+                if self._worker_thread is not None:
+                    # The worker is still using the store, so leave
+                    # closing it to the worker when it has finished
+                    logger.info('Leaving pending uploads for the next session.')
+                    self._worker_closes_store = True
+                    return
+
+        self._close_store()
+
+    def _close_store(self):
+        with self._store.lock:
             self._store.commit()
+            self._store.close()
+
+    def _worker_proc(self):
+        while True:
+            with self._worker_cond:
+                while not self._stopping and (self._flush_due is None or
+                        self._flush_due > time.time()):
+                    if self._flush_due is None:
+                        self._worker_cond.wait()
+                    else:
+                        self._worker_cond.wait(self._flush_due - time.time())
 
-            logger.debug('Worker thread waiting for timeout')
-            time.sleep(self.FLUSH_TIMEOUT)
+                if self._stopping:
+                    self._worker_thread = None
+                    close_store = self._worker_closes_store
+                    break
 
-        # Only work when enabled, UID set and allowed to work
-        if self.can_access_webservice() and \
-                (self._worker_thread is not None or forced):
-            self._worker_thread = None
+                self._flush_due = None
+                self._flush_requested = None
+
+            # Only work when enabled and UID set
+            if not self.can_access_webservice():
+                logger.info('Worker thread may not execute (disabled).')
+                self._store.commit()
+                continue
 
             logger.debug('Worker thread starting to work...')
-            for retry in range(self.FLUSH_RETRIES):
-                must_retry = False
+            self._schedule_next_flush(*self._flush_queue())
+            logger.debug('Worker thread finished.')
 
-                if retry:
-                    logger.debug('Retrying flush queue...')
+        if close_store:
+            self._close_store()
+
+    def _schedule_next_flush(self, success, pending):
+        """Retry failed flushes with backoff, continue pending ones"""
+        with self._worker_cond:
+            if not success:
+                delay = min(self.RETRY_DELAY * 2 ** self._failures,
+                        self.MAX_RETRY_DELAY)
+                self._failures += 1
+                logger.info('Flush failed, retrying in %d seconds.', delay)
+                self._flush_due = time.time() + delay
+            else:
+                self._failures = 0
+                if pending:
+                    logger.debug('More actions pending, continuing.')
+                    self._flush_due = time.time()
+
+    def _flush_queue(self):
+        """Upload a bounded amount of the queued actions
+
+        Returns (success, pending), pending is True if there are episode
+        actions left over for the next run. Uploaded actions are removed
+        from the queue (and committed) batch by batch, so an interrupted
+        flush continues where it stopped.
+        """
+        success = True
 
-                # Update the device first, so it can be created if new
-                for action in self._store.load(UpdateDeviceAction):
-                    if self.update_device(action):
-                        self._store.remove(action)
-                    else:
-                        must_retry = True
-
-                # Upload podcast subscription actions
-                actions = self._store.load(SubscribeAction)
-                if self.synchronize_subscriptions(actions):
-                    self._store.remove(actions)
-                else:
-                    must_retry = True
-
-                # Upload episode actions
-                actions = self._store.load(EpisodeAction)
-                if self.synchronize_episodes(actions):
-                    self._store.remove(actions)
-                else:
-                    must_retry = True
-
-                if not must_retry or not self.can_access_webservice():
-                    # No more pending actions, or no longer enabled.
-                    # Ready to quit.
-                    break
+        # The store is not touched anymore once gPodder is quitting
+        if self._stopping:
+            return success, True
 
-            logger.debug('Worker thread finished.')
+        # Update the device first, so it can be created if new
+        for action in self._store.load(UpdateDeviceAction):
+            if self.update_device(action):
+                self._store.remove(action)
+            else:
+                success = False
+
+        if self._stopping:
+            self._store.commit()
+            return success, True
+
+        # Upload podcast subscription actions
+        actions = self._store.load(SubscribeAction)
+        if self.synchronize_subscriptions(actions):
+            self._store.remove(actions)
         else:
-            logger.info('Worker thread may not execute (disabled).')
+            success = False
+
+        if self._stopping:
+            self._store.commit()
+            return success, True
+
+        # Upload episode actions (synchronize_episodes removes them)
+        actions = self.load_episode_actions()
+        limit = EPISODE_ACTIONS_BATCH_SIZE * EPISODE_ACTIONS_MAX_BATCHES
+        if not self.synchronize_episodes(actions[:limit]):
+            success = False
 
         # Store the current contents of the queue database
         self._store.commit()
 
+        return success, len(actions) > limit
+
     def flush(self, now=False):
         if not self.can_access_webservice():
             logger.warn('Flush requested, but sync disabled.')
             return
 
-        if self._worker_thread is None or now:
+        with self._worker_cond:
+            if self._stopping:
+                return
+
+            current = time.time()
             if now:
                 logger.debug('Flushing NOW.')
+                due = current
             else:
                 logger.debug('Flush requested.')
-            self._worker_thread = util.run_in_background(lambda: self._worker_proc(now), True)
-        else:
-            logger.debug('Flush requested, already waiting.')
+                if self._flush_requested is None:
+                    self._flush_requested = current
+                due = min(current + self.FLUSH_DELAY,
+                        self._flush_requested + self.FLUSH_MAX_DELAY)
+                if self._failures and self._flush_due is not None:
+                    # Do not retry earlier than the backoff allows
+                    due = max(due, self._flush_due)
+
+            self._flush_due = due
+
+            if self._worker_thread is None:
+                self._worker_thread = util.run_in_background(self._worker_proc, True)
+            else:
+                self._worker_cond.notify_all()
 
     def on_config_changed(self, name=None, old_value=None, new_value=None):
         if name in ('mygpo.username', 'mygpo.password', 'mygpo.server') \
@@ -466,6 +692,25 @@ class MygPoClient(object):
             # Update or create the device
             self.create_device()
 
+    def load_episode_actions(self):
+        """Get the queued episode actions, compacting the queue if enabled"""
+        with self._store.lock:
+            actions = self._store.load(EpisodeAction)
+            if not self._config.mygpo.compact_actions:
+                return actions
+
+            compacted = compact_episode_actions(actions)
+            if len(compacted) < len(actions):
+                logger.debug('Compacted %d episode actions to %d',
+                        len(actions), len(compacted))
+                # Play actions without a position would act as wildcards
+                # when removed one by one, so rewrite the whole queue
+                self._store.delete(EpisodeAction)
+                self._store.save(compacted)
+                return compacted
+
+            return actions
+
     def synchronize_episodes(self, actions):
         logger.debug('Starting episode status sync.')
 
@@ -528,6 +773,11 @@ class MygPoClient(object):
 
                 # Actions have been uploaded to the server - remove them
                 self._store.remove(batch)
+                self._store.commit()
+
+                if self._stopping:
+                    logger.debug('Leaving remaining episode actions for later.')
+                    return False
 
             logger.debug('Episode actions have been uploaded to the server.')
             return True
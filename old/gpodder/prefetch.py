@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+#  gpodder.prefetch - Download the new episodes that are likely to be played
+#
+
+import collections
+import logging
+import threading
+import time
+
+import gpodder
+from gpodder import util
+
+logger = logging.getLogger(__name__)
+
+
+MiB = 1024 * 1024
+DAY = 60 * 60 * 24
+
+# Only the most recent decisions (played or skipped) of a podcast count
+HISTORY_SIZE = 25
+
+# Podcasts not listened to for this many days count half as much
+LISTEN_HALF_LIFE = 30
+
+# Episodes published this many days ago are worth half as much
+AGE_HALF_LIFE = 7
+
+# Episodes of this size are worth half as much as very small ones
+SIZE_SCALE = 200 * MiB
+
+# Assumed size of episodes that do not have a size in the feed
+DEFAULT_SIZE = 50 * MiB
+
+# Episodes with a lower score are never prefetched
+MIN_SCORE = .2
+
+
+def podcast_affinity(history, now):
+    """How likely the next episode of a podcast will be played (0..1)
+
+    "history" is a list of (played, last_playback) tuples of episodes
+    the user has already decided about, newest first. Podcasts without
+    any history get a neutral value of 0.5.
+
+    >>> podcast_affinity([], 0)
+    0.5
+    >>> round(podcast_affinity([(True, 0)] * 4, 0), 3)
+    0.833
+    >>> round(podcast_affinity([(False, 0)] * 4, 0), 3)
+    0.167
+    >>> round(podcast_affinity([(True, 0)] * 4, LISTEN_HALF_LIFE * DAY), 3)
+    0.417
+    """
+    history = history[:HISTORY_SIZE]
+    played = [last_playback for is_played, last_playback in history if is_played]
+
+    # Laplace smoothing, so that one skipped episode is not fatal
+    affinity = (len(played) + 1) / (len(history) + 2)
+
+    if played:
+        days = max(0, now - max(played)) / DAY
+        affinity *= 0.5 ** (days / LISTEN_HALF_LIFE)
+
+    return affinity
+
+
+def score_episode(affinity, published, size, now):
+    """Score a candidate episode for prefetching
+
+    >>> score_episode(.5, 0, 0, 0)
+    0.5
+    >>> score_episode(.5, 0, 0, AGE_HALF_LIFE * DAY)
+    0.25
+    >>> score_episode(.5, 0, SIZE_SCALE, 0)
+    0.25
+    """
+    days = max(0, now - published) / DAY
+    return affinity * 0.5 ** (days / AGE_HALF_LIFE) / (1. + max(0, size) / SIZE_SCALE)
+
+
+def get_history(channel):
+    """Get the (played, last_playback) history of a podcast, newest first"""
+    history = []
+    for episode in sorted(channel.get_all_episodes(),
+            key=lambda e: e.published, reverse=True):
+        if episode.last_playback > 0 or episode.current_position > 0:
+            history.append((True, episode.last_playback))
+        elif not episode.is_new:
+            # Marked as old or deleted without being played
+            history.append((False, 0))
+
+        if len(history) >= HISTORY_SIZE:
+            break
+
+    return history
+
+
+class PrefetchPolicy(object):
+    """Selects the new episodes to download ahead of time
+
+    Candidates are ranked by the play history of their podcast, their
+    age and their size. The best ones are selected until the number of
+    episodes, the size per run, the daily download volume or the free
+    disk space (above "downloads.min_free_space") runs out.
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._volume = collections.deque()
+        self._lock = threading.Lock()
+
+    def get_daily_remaining(self, now):
+        """Bytes that can still be prefetched in the last 24 hours"""
+        with self._lock:
+            while self._volume and self._volume[0][0] < now - DAY:
+                self._volume.popleft()
+            used = sum(size for timestamp, size in self._volume)
+
+        return max(0, self._config.limit.prefetch.daily * MiB - used)
+
+    def get_budget(self, now):
+        budget = min(self._config.limit.prefetch.size * MiB,
+                self.get_daily_remaining(now))
+
+        free_space = util.get_free_disk_space(gpodder.downloads)
+        if free_space != -1:
+            floor = max(0, self._config.downloads.min_free_space) * MiB
+            budget = min(budget, free_space - floor)
+
+        return max(0, budget)
+
+    def rank(self, episodes, now=None):
+        """Returns (score, episode) tuples of the candidates, best first"""
+        if now is None:
+            now = time.time()
+
+        affinities = {}
+        ranked = []
+        for episode in episodes:
+            channel = episode.channel
+            if channel not in affinities:
+                affinities[channel] = podcast_affinity(get_history(channel), now)
+
+            score = score_episode(affinities[channel], episode.published,
+                    episode.file_size, now)
+            ranked.append((score, episode))
+
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        return ranked
+
+    def select(self, episodes, now=None):
+        """Get the episodes that should be prefetched now"""
+        if now is None:
+            now = time.time()
+
+        budget = self.get_budget(now)
+        max_episodes = self._config.limit.prefetch.episodes
+
+        selected = []
+        used = 0
+        for score, episode in self.rank(episodes, now):
+            if len(selected) >= max_episodes or score < MIN_SCORE:
+                break
+
+            size = episode.file_size if episode.file_size > 0 else DEFAULT_SIZE
+            if used + size > budget:
+                continue
+
+            logger.debug('Prefetching %s (score %.3f)', episode.title, score)
+            selected.append(episode)
+            used += size
+
+        if selected:
+            with self._lock:
+                self._volume.append((now, used))
+
+        logger.info('Prefetching %d of %d new episodes (%s)', len(selected),
+                len(episodes), util.format_filesize(used))
+        return selected
@@ -22,17 +22,95 @@
 #  gpodder.query - Episode Query Language (EQL) implementation (2010-11-29)
 #
 
+import ast
 import datetime
+import logging
+import operator
 import re
 
 import gpodder
 
+logger = logging.getLogger(__name__)
+
+# How expensive a term is to evaluate; in "and" and "or" expressions,
+# cheap terms are evaluated first, so the expensive ones are often skipped
+CHEAP, COSTLY, EXPENSIVE, UNKNOWN = list(range(4))
+
+# Number of episodes that EQL.filter_batches() processes at a time
+FILTER_BATCH_SIZE = 500
+
+
+def _since(episode, now):
+    return (now - datetime.datetime.fromtimestamp(episode.published)).days
+
+
+# Adjectives (for direct usage) and nouns (for comparisons), each with the
+# cost and a function returning the value for (episode, now)
+TERMS = {
+    'new': (CHEAP, lambda e, now: e.state == gpodder.STATE_NORMAL and e.is_new),
+    'downloaded': (EXPENSIVE, lambda e, now: e.was_downloaded(and_exists=True)),
+    'deleted': (CHEAP, lambda e, now: e.state == gpodder.STATE_DELETED),
+    'played': (CHEAP, lambda e, now: not e.is_new),
+    'downloading': (CHEAP, lambda e, now: e.downloading),
+    'archive': (CHEAP, lambda e, now: e.archive),
+    'finished': (CHEAP, lambda e, now: e.is_finished()),
+    'video': (COSTLY, lambda e, now: e.file_type() == 'video'),
+    'audio': (COSTLY, lambda e, now: e.file_type() == 'audio'),
+    'torrent': (CHEAP, lambda e, now: e.url.endswith('.torrent') or 'torrent' in e.mime_type),
+
+    'megabytes': (CHEAP, lambda e, now: e.file_size / (1024 * 1024)),
+    'title': (CHEAP, lambda e, now: e.title),
+    'description': (CHEAP, lambda e, now: e.description),
+    'since': (COSTLY, _since),
+    'age': (EXPENSIVE, lambda e, now: e.age_in_days()),
+    'minutes': (CHEAP, lambda e, now: e.total_time / 60),
+    'remaining': (CHEAP, lambda e, now: e.total_time - e.current_position / 60),
+}
+
+# Short forms
+ALIASES = {
+    'dl': 'downloaded',
+    'rm': 'deleted',
+    'fin': 'finished',
+    'mb': 'megabytes',
+    'min': 'minutes',
+    'rem': 'remaining',
+}
+
+for alias, name in ALIASES.items():
+    TERMS[alias] = TERMS[name]
+
+OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Not: operator.not_,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
 
 class Matcher(object):
     """Match implementation for EQL
 
     This class implements the low-level matching of
-    EQL statements against episode objects.
+    EQL statements against episode objects by evaluating
+    them with eval(). It is only used for queries that
+    cannot be compiled by compile_expression().
     """
 
     def __init__(self, episode):
@@ -46,45 +124,248 @@ class Matcher(object):
             return False
 
     def __getitem__(self, k):
-        episode = self._episode
-
-        # Adjectives (for direct usage)
-        if k == 'new':
-            return (episode.state == gpodder.STATE_NORMAL and episode.is_new)
-        elif k in ('downloaded', 'dl'):
-            return episode.was_downloaded(and_exists=True)
-        elif k in ('deleted', 'rm'):
-            return episode.state == gpodder.STATE_DELETED
-        elif k == 'played':
-            return not episode.is_new
-        elif k == 'downloading':
-            return episode.downloading
-        elif k == 'archive':
-            return episode.archive
-        elif k in ('finished', 'fin'):
-            return episode.is_finished()
-        elif k in ('video', 'audio'):
-            return episode.file_type() == k
-        elif k == 'torrent':
-            return episode.url.endswith('.torrent') or 'torrent' in episode.mime_type
-
-        # Nouns (for comparisons)
-        if k in ('megabytes', 'mb'):
-            return episode.file_size / (1024 * 1024)
-        elif k == 'title':
-            return episode.title
-        elif k == 'description':
-            return episode.description
-        elif k == 'since':
-            return (datetime.datetime.now() - datetime.datetime.fromtimestamp(episode.published)).days
-        elif k == 'age':
-            return episode.age_in_days()
-        elif k in ('minutes', 'min'):
-            return episode.total_time / 60
-        elif k in ('remaining', 'rem'):
-            return episode.total_time - episode.current_position / 60
-
-        raise KeyError(k)
+        cost, get_value = TERMS[k]
+        return get_value(self._episode, datetime.datetime.now())
+
+
+def compile_expression(node, boolean=True):
+    """Compile an EQL syntax tree into a (cost, function) tuple
+
+    The function takes (episode, now) and returns the value of the
+    expression. If "boolean" is True, only the truth value of the
+    result matters, so the operands of "and" and "or" are reordered
+    to evaluate cheap terms first.
+
+    Raises ValueError for unsupported syntax.
+
+    >>> cost, f = compile_expression(ast.parse('2 * 3 > 5', mode='eval'))
+    >>> cost, f(None, None)
+    (0, True)
+    >>> cost, f = compile_expression(ast.parse('downloaded or new', mode='eval'))
+    >>> cost
+    2
+    >>> compile_expression(ast.parse('len(title)', mode='eval'))
+    Traceback (most recent call last):
+      ...
+    ValueError: Unsupported EQL syntax: Call
+    """
+    if isinstance(node, ast.Expression):
+        return compile_expression(node.body, boolean)
+
+    elif isinstance(node, ast.Constant):
+        value = node.value
+        return CHEAP, lambda episode, now: value
+
+    elif isinstance(node, ast.Name):
+        if node.id not in TERMS:
+            # Fail when evaluated (like eval() would), but as late as possible
+            def unknown(episode, now, name=node.id):
+                raise KeyError(name)
+            return UNKNOWN, unknown
+
+        return TERMS[node.id]
+
+    elif isinstance(node, ast.BoolOp):
+        operands = [compile_expression(value, boolean) for value in node.values]
+        if boolean:
+            operands.sort(key=lambda operand: operand[0])
+        cost = max(operand[0] for operand in operands)
+        functions = [function for _, function in operands]
+
+        if isinstance(node.op, ast.And):
+            def f(episode, now):
+                for function in functions:
+                    value = function(episode, now)
+                    if not value:
+                        return value
+                return value
+        else:
+            def f(episode, now):
+                for function in functions:
+                    value = function(episode, now)
+                    if value:
+                        return value
+                return value
+        return cost, f
+
+    elif isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+        op = OPERATORS[type(node.op)]
+        cost, operand = compile_expression(node.operand,
+                isinstance(node.op, ast.Not))
+        return cost, lambda episode, now: op(operand(episode, now))
+
+    elif isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+        op = OPERATORS[type(node.op)]
+        left_cost, left = compile_expression(node.left, False)
+        right_cost, right = compile_expression(node.right, False)
+        return (max(left_cost, right_cost),
+                lambda episode, now: op(left(episode, now), right(episode, now)))
+
+    elif isinstance(node, ast.Compare) and all(type(op) in OPERATORS for op in node.ops):
+        ops = [OPERATORS[type(op)] for op in node.ops]
+        operands = [compile_expression(operand, False)
+                for operand in [node.left] + node.comparators]
+        cost = max(operand[0] for operand in operands)
+        first = operands[0][1]
+        pairs = list(zip(ops, [function for _, function in operands[1:]]))
+
+        def f(episode, now):
+            left = first(episode, now)
+            for op, function in pairs:
+                right = function(episode, now)
+                if not op(left, right):
+                    return False
+                left = right
+            return True
+        return cost, f
+
+    raise ValueError('Unsupported EQL syntax: %s' % type(node).__name__)
+
+
+# SQL expressions of the terms that the episode table can answer, as
+# (type, sql, params, exact) tuples. Terms that are not exact select a
+# superset of the matching episodes, so they still have to be checked.
+SQL_TERMS = {
+    'new': ('bool', '(state = ? AND is_new)', [gpodder.STATE_NORMAL], True),
+    'downloaded': ('bool', 'state = ?', [gpodder.STATE_DOWNLOADED], False),
+    'deleted': ('bool', 'state = ?', [gpodder.STATE_DELETED], True),
+    'played': ('bool', '(NOT is_new)', [], True),
+    'archive': ('bool', 'archive', [], True),
+    'finished': ('bool', '(current_position > 0 AND total_time > 0 AND '
+                 '(current_position + 10 >= total_time OR '
+                 'current_position >= total_time * .99))', [], True),
+    'torrent': ('bool', "(substr(url, -8) = '.torrent' OR "
+                "instr(mime_type, 'torrent') > 0)", [], True),
+
+    'megabytes': ('num', '(file_size / 1048576.0)', [], True),
+    'title': ('text', 'title', [], True),
+    'description': ('text', 'description', [], True),
+    'minutes': ('num', '(total_time / 60.0)', [], True),
+    'remaining': ('num', '(total_time - current_position / 60.0)', [], True),
+}
+
+for alias, name in ALIASES.items():
+    SQL_TERMS[alias] = SQL_TERMS[name]
+del alias, name
+
+SQL_OPERATORS = {
+    ast.Add: '+',
+    ast.Sub: '-',
+    ast.Mult: '*',
+    ast.Eq: '=',
+    ast.NotEq: '<>',
+    ast.Lt: '<',
+    ast.LtE: '<=',
+    ast.Gt: '>',
+    ast.GtE: '>=',
+}
+
+
+def translate_expression(node, boolean=True, positive=True):
+    """Translate an EQL syntax tree into SQL for the episode table
+
+    Returns a (type, sql, params, exact) tuple like the entries of
+    SQL_TERMS. Inexact terms are only used where a superset of the
+    result does not hurt ("positive", i.e. not below a "not").
+
+    Raises ValueError if the expression (or a part of it) cannot be
+    answered by the episode table with the same result as in Python.
+
+    >>> translate_expression(ast.parse('new and mb > 100', mode='eval'))
+    ('bool', '((state = ? AND is_new) AND (file_size / 1048576.0) > ?)', [0, 100], True)
+    >>> translate_expression(ast.parse("'S04' in title", mode='eval'))
+    ('bool', 'instr(title, ?) > 0', ['S04'], True)
+    >>> translate_expression(ast.parse('not downloaded', mode='eval'))
+    Traceback (most recent call last):
+      ...
+    ValueError: Cannot translate downloaded
+    >>> translate_expression(ast.parse('title > 5', mode='eval'))
+    Traceback (most recent call last):
+      ...
+    ValueError: Cannot compare text with num
+    """
+    if isinstance(node, ast.Expression):
+        return translate_expression(node.body, boolean, positive)
+
+    elif isinstance(node, ast.Constant):
+        value = node.value
+        if isinstance(value, bool):
+            return 'bool', '?', [int(value)], True
+        elif isinstance(value, (int, float)):
+            return 'num', '?', [value], True
+        elif isinstance(value, str):
+            return 'text', '?', [value], True
+
+    elif isinstance(node, ast.Name):
+        if node.id in SQL_TERMS:
+            kind, sql, params, exact = SQL_TERMS[node.id]
+            if exact or (positive and boolean):
+                return kind, sql, list(params), exact
+
+        raise ValueError('Cannot translate %s' % node.id)
+
+    elif isinstance(node, ast.BoolOp) and boolean:
+        operands = [translate_expression(value, True, positive) for value in node.values]
+        if any(kind == 'text' for kind, _, _, _ in operands):
+            raise ValueError('Cannot use text as truth value')
+
+        op = ' AND ' if isinstance(node.op, ast.And) else ' OR '
+        return ('bool', '(%s)' % op.join(sql for _, sql, _, _ in operands),
+                sum((params for _, _, params, _ in operands), []),
+                all(exact for _, _, _, exact in operands))
+
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        kind, sql, params, exact = translate_expression(node.operand, True, False)
+        if kind == 'text':
+            raise ValueError('Cannot use text as truth value')
+        return 'bool', '(NOT %s)' % sql, params, exact
+
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        kind, sql, params, exact = translate_expression(node.operand, False, positive)
+        if kind != 'num':
+            raise ValueError('Cannot negate %s' % kind)
+        return 'num', '(-%s)' % sql, params, exact
+
+    elif isinstance(node, ast.BinOp) and type(node.op) in (ast.Add, ast.Sub,
+            ast.Mult, ast.Div):
+        left = translate_expression(node.left, False, positive)
+        right = translate_expression(node.right, False, positive)
+        if left[0] != 'num' or right[0] != 'num':
+            raise ValueError('Cannot calculate with %s and %s' % (left[0], right[0]))
+
+        if isinstance(node.op, ast.Div):
+            # Python 3 always divides without truncating
+            sql = '(CAST(%s AS REAL) / %s)' % (left[1], right[1])
+        else:
+            sql = '(%s %s %s)' % (left[1], SQL_OPERATORS[type(node.op)], right[1])
+        return 'num', sql, left[2] + right[2], left[3] and right[3]
+
+    elif isinstance(node, ast.Compare):
+        operands = [translate_expression(operand, False, positive)
+                for operand in [node.left] + node.comparators]
+        clauses = []
+        params = []
+        for op, left, right in zip(node.ops, operands, operands[1:]):
+            # Booleans compare like numbers in both Python and SQL
+            left_kind = 'num' if left[0] == 'bool' else left[0]
+            right_kind = 'num' if right[0] == 'bool' else right[0]
+            if left_kind != right_kind:
+                raise ValueError('Cannot compare %s with %s' % (left_kind, right_kind))
+
+            if type(op) in SQL_OPERATORS:
+                clauses.append('%s %s %s' % (left[1], SQL_OPERATORS[type(op)], right[1]))
+                params.extend(left[2] + right[2])
+            elif type(op) in (ast.In, ast.NotIn) and left_kind == 'text':
+                clauses.append('instr(%s, %s) %s 0' % (right[1], left[1],
+                        '>' if isinstance(op, ast.In) else '='))
+                params.extend(right[2] + left[2])
+            else:
+                raise ValueError('Cannot translate %s' % type(op).__name__)
+
+        sql = clauses[0] if len(clauses) == 1 else '(%s)' % ' AND '.join(clauses)
+        return 'bool', sql, params, all(operand[3] for operand in operands)
+
+    raise ValueError('Cannot translate %s' % type(node).__name__)
 
 
 class EQL(object):
@@ -117,10 +398,12 @@ class EQL(object):
     """
 
     def __init__(self, query):
+        self._source = query
         self._query = query
         self._flags = 0
         self._regex = False
         self._string = False
+        self._error_logged = False
 
         # Regular expression based query
         match = re.match(r'^/(.*)/(i?)$', query)
@@ -137,27 +420,186 @@ class EQL(object):
             a, query, b = match.groups()
             self._query = query.lower()
 
-        # For everything else, compile the expression
-        if not self._regex and not self._string:
+        # Compile the query into a predicate function
+        self._predicate = None
+        self._tree = None
+        if self._regex:
+            try:
+                regex = re.compile(self._query, self._flags)
+            except re.error as e:
+                print(e)
+                self._query = None
+                return
+            self._predicate = lambda episode, now: regex.search(episode.title) is not None
+        elif self._string:
+            string = self._query
+            self._predicate = lambda episode, now: (string in episode.title.lower() or
+                    string in episode.description.lower())
+        else:
             try:
-                self._query = compile(query, '<eql-string>', 'eval')
+                tree = ast.parse(query, '<eql-string>', 'eval')
             except Exception as e:
                 print(e)
                 self._query = None
+                return
+
+            self._tree = tree
+            try:
+                cost, self._predicate = compile_expression(tree)
+            except ValueError:
+                # Let eval() deal with the rest of the Python syntax
+                self._query = compile(tree, '<eql-string>', 'eval')
+
+    @property
+    def string(self):
+        """The (lowercase) text of a string query, None for other queries"""
+        return self._query if self._string else None
+
+    def _log_error(self, e):
+        # Queries are evaluated for each episode; only log the first error
+        if not self._error_logged:
+            self._error_logged = True
+            logger.warn('Cannot evaluate query "%s": %s', self._source, e)
+
+    def _match(self, episode, now):
+        if self._predicate is not None:
+            try:
+                return bool(self._predicate(episode, now))
+            except Exception as e:
+                self._log_error(e)
+                return False
+
+        return Matcher(episode).match(self._query)
 
     def match(self, episode):
         if self._query is None:
             return False
 
-        if self._regex:
-            return re.search(self._query, episode.title, self._flags) is not None
-        elif self._string:
-            return self._query in episode.title.lower() or self._query in episode.description.lower()
+        return self._match(episode, datetime.datetime.now())
 
-        return Matcher(episode).match(self._query)
+    def filter_batches(self, episodes, batch_size=FILTER_BATCH_SIZE):
+        """Filter episodes, yielding a list of matches for every batch
+
+        Callers can update the UI (or give up) between two batches.
+        """
+        if self._query is None:
+            return
+
+        episodes = iter(episodes)
+        while True:
+            batch = [episode for _, episode in zip(range(batch_size), episodes)]
+            if not batch:
+                break
+
+            now = datetime.datetime.now()
+            yield [episode for episode in batch if self._match(episode, now)]
 
     def filter(self, episodes):
-        return list(filter(self.match, episodes))
+        result = []
+        for matches in self.filter_batches(episodes):
+            result.extend(matches)
+        return result
+
+    def get_sql(self):
+        """Translate the query to a WHERE clause for the episode table
+
+        Returns (where, params, residual). The parts of an "and" query
+        that SQL cannot answer end up in residual, a function that
+        takes (episode, now) and that the episodes selected by the
+        WHERE clause still have to pass; it is None if SQL answers the
+        whole query.
+        """
+        if self._query is None:
+            return '0', [], None
+        elif self._regex:
+            flags = '(?i)' if self._flags & re.I else ''
+            return 'title REGEXP ?', [flags + self._query], None
+        elif self._string:
+            # SQLite's lower() only handles ASCII, UNICODE_LOWER() is str.lower()
+            return ('(instr(UNICODE_LOWER(title), ?) > 0 OR '
+                    'instr(UNICODE_LOWER(description), ?) > 0)',
+                    [self._query, self._query], None)
+        elif self._predicate is None:
+            # Evaluated by eval()
+            return '1', [], lambda episode, now: Matcher(episode).match(self._query)
+
+        body = self._tree.body
+        if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And):
+            operands = body.values
+        else:
+            operands = [body]
+
+        clauses = []
+        params = []
+        residual = []
+        for operand in operands:
+            try:
+                kind, sql, operand_params, exact = translate_expression(operand)
+            except ValueError:
+                residual.append(operand)
+                continue
+
+            if kind == 'text':
+                residual.append(operand)
+                continue
+
+            clauses.append(sql)
+            params.extend(operand_params)
+            if not exact:
+                residual.append(operand)
+
+        if not residual:
+            predicate = None
+        elif len(residual) == 1:
+            cost, predicate = compile_expression(residual[0])
+        else:
+            cost, predicate = compile_expression(ast.BoolOp(ast.And(), residual))
+
+        return ' AND '.join(clauses) or '1', params, predicate
+
+    def find_episode_ids(self, db, get_episode=None, podcast_id=None):
+        """Get the IDs of the matching episodes from the database
+
+        If parts of the query cannot be answered by the database,
+        get_episode(id) is called for the candidates selected by the
+        database, and the rest of the query is checked on the episode
+        it returns (candidates for which it returns None are skipped).
+        """
+        where, params, residual = self.get_sql()
+        ids = db.get_episode_ids(where, params, podcast_id)
+        if residual is None:
+            return ids
+
+        if get_episode is None:
+            raise ValueError('Cannot answer query without episodes: %s' % self._source)
+
+        now = datetime.datetime.now()
+        result = []
+        for id in ids:
+            episode = get_episode(id)
+            if episode is None:
+                continue
+
+            try:
+                if residual(episode, now):
+                    result.append(id)
+            except Exception as e:
+                self._log_error(e)
+
+        return result
+
+    def find_episodes(self, db, episodes, podcast_id=None):
+        """Filter loaded episodes, letting the database do most of the work
+
+        Returns the matching episodes in the order of "episodes". Only
+        the candidates selected by the database are checked in Python.
+        """
+        if self._query is None:
+            return []
+
+        by_id = {episode.id: episode for episode in episodes}
+        ids = set(self.find_episode_ids(db, by_id.get, podcast_id))
+        return [episode for episode in episodes if episode.id in ids]
 
 
 def UserEQL(query):
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+#  gpodder.resolver - Cached resolving of redirects and media URLs
+#
+
+import calendar
+import collections
+import logging
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import gpodder
+from gpodder import escapist_videos, util, vimeo, youtube
+
+logger = logging.getLogger(__name__)
+
+
+ResolvedURL = collections.namedtuple('ResolvedURL', 'url chain size mime_type')
+
+MAX_AGE_RE = re.compile(r'max-age=(\d+)', re.IGNORECASE)
+CONTENT_RANGE_RE = re.compile(r'bytes \d+-\d+/(\d+)', re.IGNORECASE)
+
+
+def get_size(headers):
+    """Get the size of a resource from HEAD or ranged GET response headers
+
+    Returns -1 if the size is not known.
+
+    >>> get_size({'content-length': '1234'})
+    1234
+    >>> get_size({'content-range': 'bytes 0-0/5678', 'content-length': '1'})
+    5678
+    >>> get_size({})
+    -1
+    """
+    match = CONTENT_RANGE_RE.match(headers.get('content-range', ''))
+    if match is not None:
+        return int(match.group(1))
+
+    try:
+        return int(headers.get('content-length', -1))
+    except ValueError:
+        return -1
+
+
+def get_expiry(url):
+    """Get the time (seconds since the epoch) at which a signed URL expires
+
+    Returns None if the URL does not look like a signed URL.
+
+    >>> get_expiry('http://example.com/a.mp3?Expires=1500000000&Signature=x')
+    1500000000
+    >>> get_expiry('https://r1.googlevideo.com/videoplayback?expire=1600000000')
+    1600000000
+    >>> get_expiry('https://s3.amazonaws.com/a.mp3?X-Amz-Date=20200101T000000Z&X-Amz-Expires=3600')
+    1577840400
+    >>> get_expiry('http://example.com/a.mp3?expires=soon') is None
+    True
+    >>> get_expiry('http://example.com/a.mp3') is None
+    True
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+    query = dict((key.lower(), values[-1]) for key, values in query.items())
+
+    try:
+        if 'x-amz-date' in query and 'x-amz-expires' in query:
+            signed = time.strptime(query['x-amz-date'], '%Y%m%dT%H%M%SZ')
+            return calendar.timegm(signed) + int(query['x-amz-expires'])
+
+        for key in ('expires', 'expire', 'exp'):
+            if key in query:
+                return int(query[key])
+    except ValueError:
+        pass
+
+    return None
+
+
+def is_video_link(url):
+    """Returns True for YouTube, Vimeo and Escapist video page URLs"""
+    return (youtube.is_video_link(url) or vimeo.is_video_link(url) or
+            escapist_videos.is_video_link(url))
+
+
+class RedirectRecorder(urllib.request.HTTPRedirectHandler):
+    """Follows redirects without changing the request method
+
+    Every hop is recorded in "chain" as a (status code, URL) tuple,
+    and the lowest Cache-Control max-age of the redirects in "max_age".
+    """
+    def __init__(self):
+        self.chain = []
+        self.max_age = None
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        request = urllib.request.HTTPRedirectHandler.redirect_request(self,
+                req, fp, code, msg, headers, newurl)
+        if request is not None:
+            request.method = req.get_method()
+            self.chain.append((code, request.full_url))
+
+            match = MAX_AGE_RE.search(headers.get('cache-control', ''))
+            if match is not None:
+                max_age = int(match.group(1))
+                if self.max_age is None or max_age < self.max_age:
+                    self.max_age = max_age
+            elif 'no-store' in headers.get('cache-control', ''):
+                self.max_age = 0
+
+        return request
+
+
+class URLResolver(object):
+    """Resolves redirects and video site URLs, caching the results
+
+    Redirects are resolved with a HEAD request, falling back to a GET
+    request for the first byte for servers that do not support HEAD.
+    Results are kept for DEFAULT_TTL seconds, but never longer than
+    signed URLs (and Cache-Control headers of redirects) allow. URLs
+    are cached without their authentication data, so the same entry is
+    found whether or not a caller added the credentials of the podcast.
+    """
+    DEFAULT_TTL = 60 * 60
+    # Stop using signed URLs this many seconds before they expire
+    EXPIRY_MARGIN = 60
+    MAX_ENTRIES = 256
+    TIMEOUT = 30
+
+    def __init__(self):
+        self._cache = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.time():
+                del self._cache[key]
+                return None
+
+            self._cache.move_to_end(key)
+            return value
+
+    def _put(self, key, value, url, max_age=None):
+        ttl = self.DEFAULT_TTL
+        if max_age is not None:
+            ttl = min(ttl, max_age)
+
+        expires = time.time() + ttl
+        expiry = get_expiry(url)
+        if expiry is not None:
+            expires = min(expires, expiry - self.EXPIRY_MARGIN)
+
+        if expires <= time.time():
+            return
+
+        with self._lock:
+            self._cache[key] = (expires, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.MAX_ENTRIES:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, url):
+        """Forget all cached results for a URL"""
+        url = util.url_strip_authentication(url)
+        with self._lock:
+            for key in [key for key in self._cache if key[1] == url]:
+                del self._cache[key]
+
+    def get_cached_url(self, url):
+        """Get the redirect target for a URL if it has been resolved before"""
+        resolved = self._get(('redirect', util.url_strip_authentication(url)))
+        if resolved is not None:
+            return resolved.url
+
+        return None
+
+    def _open(self, url, method, headers=None):
+        username, password = util.username_password_from_url(url)
+        recorder = RedirectRecorder()
+        handlers = [recorder]
+        if username is not None or password is not None:
+            url = util.url_strip_authentication(url)
+            password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+            password_mgr.add_password(None, url, username, password)
+            handlers.append(urllib.request.HTTPBasicAuthHandler(password_mgr))
+
+        headers = dict(headers or {})
+        headers['User-agent'] = gpodder.user_agent
+        request = urllib.request.Request(url, headers=headers, method=method)
+        response = urllib.request.build_opener(*handlers).open(request,
+                timeout=self.TIMEOUT)
+        response.close()
+        headers = dict((key.lower(), value) for key, value in response.info().items())
+        return response.geturl(), recorder, headers
+
+    def resolve(self, url):
+        """Follow the redirects of a URL and return a ResolvedURL
+
+        The "chain" attribute of the result contains (status code, URL)
+        tuples for every redirect, "size" and "mime_type" are taken from
+        the final response (-1 and None if unknown). If the URL cannot
+        be resolved, it is returned unchanged (and not cached).
+        """
+        key = ('redirect', util.url_strip_authentication(url))
+        resolved = self._get(key)
+        if resolved is not None:
+            return resolved
+
+        try:
+            try:
+                real_url, recorder, headers = self._open(url, 'HEAD')
+            except urllib.error.URLError as e:
+                logger.debug('HEAD failed for %s (%s), trying GET', url, e)
+                real_url, recorder, headers = self._open(url, 'GET', {'Range': 'bytes=0-0'})
+        except Exception as e:
+            logger.error('Getting real url for %s', url, exc_info=True)
+            return ResolvedURL(url, [], -1, None)
+
+        mime_type = headers.get('content-type')
+        if mime_type is not None:
+            mime_type = mime_type.split(';')[0].strip().lower()
+        resolved = ResolvedURL(real_url, recorder.chain, get_size(headers), mime_type)
+        self._put(key, resolved, real_url, recorder.max_age)
+        return resolved
+
+    def get_media_url(self, url, youtube_fmt_ids=None, vimeo_fileformat=None):
+        """Get the download URL for YouTube, Vimeo and Escapist videos
+
+        Other URLs are returned unchanged.
+        """
+        key = ('media', util.url_strip_authentication(url), tuple(youtube_fmt_ids or ()), vimeo_fileformat)
+        media_url = self._get(key)
+        if media_url is not None:
+            return media_url
+
+        media_url = youtube.get_real_download_url(url, youtube_fmt_ids)
+        media_url = vimeo.get_real_download_url(media_url, vimeo_fileformat)
+        media_url = escapist_videos.get_real_download_url(media_url)
+
+        if media_url != url:
+            self._put(key, media_url, media_url)
+
+        return media_url
+
+
+# The resolver instance shared by downloads and the episode model
+_resolver = URLResolver()
+
+resolve = _resolver.resolve
+get_media_url = _resolver.get_media_url
+get_cached_url = _resolver.get_cached_url
+invalidate = _resolver.invalidate
@@ -72,7 +72,17 @@ PodcastColumns = (
     'cover_thumb',
 )
 
-CURRENT_VERSION = 7
+DownloadQueueColumns = (
+    'episode_id',
+    'podcast_id',
+    'status',
+    'priority',
+    'downloaded',
+    'total_size',
+    'validator',
+)
+
+CURRENT_VERSION = 8
 
 
 # SQL commands to upgrade old database versions to new ones
@@ -114,6 +124,11 @@ UPGRADE_SQL = [
         UPDATE episode SET description=remove_html_tags(description_html) WHERE is_html(description)
         UPDATE podcast SET http_last_modified=NULL, http_etag=NULL
         """),
+
+        # Version 8: Persistent download queue journal
+        (7, 8, """
+        CREATE TABLE download_queue (episode_id INTEGER PRIMARY KEY NOT NULL, podcast_id INTEGER NOT NULL, status INTEGER NOT NULL DEFAULT 0, priority INTEGER NOT NULL DEFAULT 0, downloaded INTEGER NOT NULL DEFAULT 0, total_size INTEGER NOT NULL DEFAULT 0, validator TEXT NULL DEFAULT NULL)
+        """),
 ]
 
 
@@ -189,6 +204,19 @@ def initialize_database(db):
     for sql in INDEX_SQL.strip().split('\n'):
         db.execute(sql)
 
+    # Create table for the state of queued/paused/partial downloads
+    db.execute("""
+    CREATE TABLE download_queue (
+        episode_id INTEGER PRIMARY KEY NOT NULL,
+        podcast_id INTEGER NOT NULL,
+        status INTEGER NOT NULL DEFAULT 0,
+        priority INTEGER NOT NULL DEFAULT 0,
+        downloaded INTEGER NOT NULL DEFAULT 0,
+        total_size INTEGER NOT NULL DEFAULT 0,
+        validator TEXT NULL DEFAULT NULL
+    )
+    """)
+
     # Create table for version info / metadata + insert initial data
     db.execute("""CREATE TABLE version (version integer)""")
     db.execute("INSERT INTO version (version) VALUES (%d)" % CURRENT_VERSION)
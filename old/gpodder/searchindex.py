@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+#  gpodder.searchindex - Incremental search in episode lists
+#
+
+import unicodedata
+
+from gpodder import query
+
+
+def normalize(text):
+    """Casefold text, remove accents and collapse whitespace
+
+    >>> normalize('  Caf\\xe9   au LAIT ')
+    'cafe au lait'
+    >>> normalize('Stra\\xdfe')
+    'strasse'
+    """
+    text = unicodedata.normalize('NFKD', (text or '').casefold())
+    return ' '.join(''.join(c for c in text if not unicodedata.combining(c)).split())
+
+
+class SearchIndex(object):
+    """Search and view filter state for the rows of an episode list
+
+    Rows are identified by their index. There are sets of row indices
+    for every flag (e.g. "show in the downloaded view") and for the
+    rows matching the search term.
+
+    Title and description of each row are normalized once, when the
+    row is set. If a plain text search term is extended (e.g. while
+    typing), only the rows that matched before are searched again.
+    Other EQL queries are answered by the database where possible
+    (see query.EQL.find_episodes()).
+
+    >>> class Episode: pass
+    >>> a, b = Episode(), Episode()
+    >>> a.title, a.description = 'Caf\\xe9 Talk', ''
+    >>> b.title, b.description = 'News', 'From the cafeteria'
+    >>> index = SearchIndex()
+    >>> index.set_row(0, a, {'new': True})
+    >>> index.set_row(1, b, {'new': False})
+    >>> index.set_search('caf')
+    >>> [index.is_visible(i) for i in range(2)]
+    [True, True]
+    >>> index.set_search('cafe t')
+    >>> [index.is_visible(i) for i in range(2)]
+    [True, False]
+    >>> index.set_search(None)
+    >>> [index.is_visible(i, 'new') for i in range(2)]
+    [True, False]
+    """
+
+    def __init__(self):
+        self._text = None
+        self._eql = None
+        self.clear()
+
+    def clear(self):
+        """Remove all rows, but keep the search term"""
+        self._episodes = {}
+        self._texts = {}
+        self._flags = {}
+
+        if self._text is not None or self._eql is not None:
+            self._result = set()
+        else:
+            self._result = None
+
+    def set_row(self, index, episode, flags):
+        """Add or update a row, "flags" maps flag names to booleans"""
+        self._episodes[index] = episode
+        self._texts[index] = (normalize(episode.title),
+                normalize(episode.description))
+
+        for flag, value in flags.items():
+            rows = self._flags.setdefault(flag, set())
+            if value:
+                rows.add(index)
+            else:
+                rows.discard(index)
+
+        if self._result is not None:
+            if self._match(index):
+                self._result.add(index)
+            else:
+                self._result.discard(index)
+
+    def set_search(self, term):
+        """Set the search term (user input for query.UserEQL, or None)"""
+        if term is None:
+            self._result = None
+            self._text = None
+            self._eql = None
+            return
+
+        eql = query.UserEQL(term)
+        if eql.string is not None:
+            text = normalize(eql.string)
+            if self._text is not None and self._result is not None and self._text in text:
+                # The term has been extended, so only previous matches can match
+                candidates = self._result
+            else:
+                candidates = self._episodes
+            self._text = text
+            self._eql = None
+        else:
+            self._text = None
+            self._eql = eql
+            self._result = self._find_rows(eql)
+            return
+
+        self._result = set(index for index in candidates if self._match(index))
+
+    def _find_rows(self, eql):
+        if not self._episodes:
+            return set()
+
+        rows = {episode: index for index, episode in self._episodes.items()}
+        episodes = list(rows)
+        return set(rows[episode] for episode in
+                eql.find_episodes(episodes[0].db, episodes))
+
+    def _match(self, index):
+        if self._text is not None:
+            title, description = self._texts[index]
+            return self._text in title or self._text in description
+
+        return self._eql.match(self._episodes[index])
+
+    def is_visible(self, index, flag=None):
+        """Check if a row matches the search term and has "flag" set
+
+        Without search term and flag, rows that have not been set
+        yet are visible, too.
+        """
+        if self._result is not None and index not in self._result:
+            return False
+
+        if flag is not None and index not in self._flags.get(flag, ()):
+            return False
+
+        return True
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+#  gpodder.streamproxy - Play episodes while they are being downloaded
+#
+
+import collections
+import http.client
+import http.server
+import logging
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import uuid
+
+from gpodder import resolver, util
+
+logger = logging.getLogger(__name__)
+
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def parse_range(value, total):
+    """Parse the value of a "Range" header with a single byte range
+
+    Returns (start, end) with an inclusive end (None if the size of
+    the file is not known), or None if the range cannot be satisfied.
+
+    >>> parse_range(None, 1000)
+    (0, 999)
+    >>> parse_range('bytes=100-', 1000)
+    (100, 999)
+    >>> parse_range('bytes=100-199', 1000)
+    (100, 199)
+    >>> parse_range('bytes=-100', 1000)
+    (900, 999)
+    >>> parse_range('bytes=100-', None)
+    (100, None)
+    >>> parse_range('bytes=2000-', 1000) is None
+    True
+    >>> parse_range('bytes=0-1,5-6', 1000) is None
+    True
+    """
+    if value is None:
+        value = 'bytes=0-'
+
+    match = RANGE_RE.match(value.strip())
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if not start:
+        # Suffix range ("the last N bytes")
+        if total is None or not end:
+            return None
+        return max(0, total - int(end)), total - 1
+
+    start = int(start)
+    if total is None:
+        return start, int(end) if end else None
+
+    end = min(int(end), total - 1) if end else total - 1
+    if start > end:
+        return None
+
+    return start, end
+
+
+class StreamRequestHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self.server.proxy.serve(self, head_only=True)
+
+    def do_GET(self):
+        self.server.proxy.serve(self, head_only=False)
+
+
+class StreamProxy(object):
+    """Serves partial downloads to media players over loopback HTTP
+
+    Every download task gets a URL with a random token. Requests
+    (including range requests for seeking) are answered from the
+    partial file of the task; if the requested bytes have not been
+    downloaded yet, the response waits for them. This way, playback
+    can start right away while the download fills the local file.
+
+    If a player seeks more than SEEK_AHEAD bytes past the downloaded
+    part, that range is fetched from the server directly, so seeking
+    does not have to wait for the download to catch up.
+
+    Tasks are forgotten once they are finished, failed or cancelled.
+    The files of the last MAX_FINISHED finished downloads can still be
+    played under their URLs (e.g. if the player seeks afterwards).
+    """
+    CHUNK_SIZE = 64 * 1024
+    POLL_INTERVAL = .1
+    SEEK_AHEAD = 4 * 1024 * 1024
+    # Give up if no data has arrived for this many seconds
+    STALL_TIMEOUT = 60
+    MAX_FINISHED = 20
+
+    def __init__(self):
+        self._server = None
+        self._tasks = {}
+        self._tokens = {}
+        # Token -> (filename, MIME type) of finished downloads
+        self._finished = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def get_url(self, task):
+        """Get the loopback URL for playing a download task"""
+        with self._lock:
+            self._prune()
+
+            if self._server is None:
+                self._server = http.server.ThreadingHTTPServer(
+                        ('127.0.0.1', 0), StreamRequestHandler)
+                self._server.daemon_threads = True
+                self._server.proxy = self
+                util.run_in_background(self._server.serve_forever, True)
+                logger.info('Stream proxy listening on port %d',
+                        self._server.server_port)
+
+            token = self._tokens.get(task)
+            if token is None:
+                token = uuid.uuid4().hex
+                self._tokens[task] = token
+                self._tasks[token] = task
+
+            return 'http://127.0.0.1:%d/%s/%s' % (self._server.server_port,
+                    token, urllib.parse.quote(os.path.basename(task.filename)))
+
+    def _prune(self):
+        for token, task in list(self._tasks.items()):
+            if task.status == task.DONE and task.activity != task.ACTIVITY_POSTPROCESS:
+                self._finished[token] = (task.filename, task.episode.mime_type)
+                while len(self._finished) > self.MAX_FINISHED:
+                    self._finished.popitem(last=False)
+            elif task.status not in (task.FAILED, task.CANCELLED):
+                continue
+
+            del self._tasks[token]
+            del self._tokens[task]
+
+    def stop(self):
+        with self._lock:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+                self._server = None
+
+    def serve(self, handler, head_only):
+        token = handler.path.lstrip('/').split('/', 1)[0]
+        with self._lock:
+            self._prune()
+            task = self._tasks.get(token)
+            finished = self._finished.get(token)
+
+        if task is not None:
+            # The download might have finished in the meantime
+            filenames = (task.tempname, task.filename)
+            mime_type = task.episode.mime_type
+        elif finished is not None:
+            filename, mime_type = finished
+            filenames = (filename,)
+        else:
+            handler.send_error(404)
+            return
+
+        for filename in filenames:
+            try:
+                fp = open(filename, 'rb')
+                break
+            except IOError:
+                pass
+        else:
+            handler.send_error(404)
+            return
+
+        if task is not None and filename == task.filename:
+            task = None
+
+        response = None
+        try:
+            if task is None:
+                total = os.fstat(fp.fileno()).st_size
+            else:
+                total = int(task.total_size) if task.total_size > 0 else None
+            requested = handler.headers.get('Range')
+            byte_range = parse_range(requested, total)
+            if byte_range is None:
+                handler.send_response(416)
+                if total is not None:
+                    handler.send_header('Content-Range', 'bytes */%d' % total)
+                handler.end_headers()
+                return
+
+            start, end = byte_range
+            if (task is not None and
+                    start > os.fstat(fp.fileno()).st_size + self.SEEK_AHEAD and
+                    not resolver.is_video_link(task.url)):
+                # Open the request before sending headers, so that the
+                # player gets an error instead of a truncated response
+                response = self._open_remote(handler, task, start, end)
+                if response is None:
+                    return
+
+            if requested is not None and total is not None:
+                handler.send_response(206)
+                handler.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, total))
+            else:
+                handler.send_response(200)
+            if end is not None:
+                handler.send_header('Content-Length', str(end - start + 1))
+            handler.send_header('Accept-Ranges', 'bytes')
+            handler.send_header('Content-Type', mime_type)
+            handler.end_headers()
+
+            if head_only:
+                pass
+            elif response is not None:
+                self._send_remote_data(handler, response)
+            else:
+                self._send_data(handler, task, fp, start, end)
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug('Player closed connection for %s', task or filename)
+        finally:
+            if response is not None:
+                response.close()
+            fp.close()
+
+    def _send_data(self, handler, task, fp, position, end):
+        last_data = time.time()
+        while end is None or position <= end:
+            available = os.fstat(fp.fileno()).st_size
+            if position < available:
+                length = min(self.CHUNK_SIZE, available - position)
+                if end is not None:
+                    length = min(length, end - position + 1)
+                fp.seek(position)
+                data = fp.read(length)
+                handler.wfile.write(data)
+                position += len(data)
+                last_data = time.time()
+            elif (task is None or task.status == task.DONE or
+                    task.activity == task.ACTIVITY_POSTPROCESS):
+                # Everything that there is has been sent
+                break
+            elif task.status in (task.FAILED, task.CANCELLED):
+                break
+            elif time.time() - last_data > self.STALL_TIMEOUT:
+                logger.warn('No data for %s, giving up', task)
+                break
+            else:
+                time.sleep(self.POLL_INTERVAL)
+
+    def _open_remote(self, handler, task, position, end):
+        """Request a range from the server, or send an error and return None"""
+        logger.info('Fetching bytes from %d directly for %s', position, task)
+        url = resolver.get_cached_url(task.url) or task.url
+        url = task.episode.channel.authenticate_url(url)
+        headers = {'Range': 'bytes=%d-%s' % (position, '' if end is None else end)}
+        try:
+            response = util.urlopen(url, headers)
+        except urllib.error.HTTPError as e:
+            logger.warn('Cannot fetch range for %s: %s', task, e)
+            handler.send_error(416 if e.code == 416 else 502)
+            return None
+        except (IOError, http.client.HTTPException) as e:
+            logger.warn('Cannot fetch range for %s: %s', task, e)
+            handler.send_error(502)
+            return None
+
+        if response.getcode() != 206:
+            logger.warn('Server does not support ranges for %s', task)
+            response.close()
+            handler.send_error(502)
+            return None
+
+        return response
+
+    def _send_remote_data(self, handler, response):
+        data = response.read(self.CHUNK_SIZE)
+        while data:
+            handler.wfile.write(data)
+            data = response.read(self.CHUNK_SIZE)
+
+
+# The stream proxy shared by all playback requests (started on demand)
+_proxy = StreamProxy()
+
+get_url = _proxy.get_url
+stop = _proxy.stop
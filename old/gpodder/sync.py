@@ -24,18 +24,29 @@
 # Ported to gPodder 3 by Joseph Wickremasinghe in June 2012
 
 import calendar
+import collections
+import errno
 import glob
+import json
 import logging
 import os.path
+import queue
+import sys
+import threading
 import time
 
 import gpodder
-from gpodder import download, services, util
+from gpodder import download, filecache, services, util
 
 logger = logging.getLogger(__name__)
 
 
 _ = gpodder.gettext
+N_ = gpodder.ngettext
+
+# Errors of copy_file_range() and sendfile() if the files do not support it
+FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                   errno.EBADF)
 
 #
 # TODO: Re-enable iPod and MTP sync support
@@ -116,6 +127,11 @@ def open_device(gui):
                 gui.download_status_model,
                 gui.download_queue_manager)
     elif device_type == 'filesystem':
+        if config.device_sync.targets:
+            return FanOutDevice(config,
+                    gui.download_status_model,
+                    gui.download_queue_manager,
+                    [config.device_sync.device_folder] + list(config.device_sync.targets))
         return MP3PlayerDevice(config,
                 gui.download_status_model,
                 gui.download_queue_manager)
@@ -230,6 +246,48 @@ class Device(services.ObservableService):
         signals = ['progress', 'sub-progress', 'status', 'done', 'post-done']
         services.ObservableService.__init__(self, signals)
 
+    def __get_tracks_list(self):
+        return self._tracks_list
+
+    def __set_tracks_list(self, tracks):
+        self._tracks_list = tracks
+        self._tracks_by_title = {}
+        self._tracks_by_guid = {}
+        for track in tracks:
+            self._index_track(track)
+
+    tracks_list = property(fget=__get_tracks_list, fset=__set_tracks_list)
+
+    def _index_track(self, track):
+        # All tracks with a title/GUID in list order; like a linear
+        # search of tracks_list, the first track wins in lookups
+        self._tracks_by_title.setdefault(track.title, []).append(track)
+        guid = getattr(track, 'guid', None)
+        if guid:
+            self._tracks_by_guid.setdefault(guid, []).append(track)
+
+    def _unindex_track(self, track):
+        for index, key in ((self._tracks_by_title, track.title),
+                           (self._tracks_by_guid, getattr(track, 'guid', None))):
+            tracks = index.get(key)
+            if tracks and track in tracks:
+                tracks.remove(track)
+                if not tracks:
+                    del index[key]
+
+    def _get_indexed_track(self, index, key):
+        tracks = index.get(key)
+        return tracks[0] if tracks else None
+
+    def _add_to_tracks_list(self, track):
+        self._tracks_list.append(track)
+        self._index_track(track)
+
+    def _remove_from_tracks_list(self, track):
+        if track in self._tracks_list:
+            self._tracks_list.remove(track)
+            self._unindex_track(track)
+
     def open(self):
         pass
 
@@ -246,19 +304,14 @@ class Device(services.ObservableService):
         return True
 
     def add_sync_tasks(self, tracklist, force_played=False, done_callback=None):
-        for track in list(tracklist):
-            # Filter tracks that are not meant to be synchronized
-            does_not_exist = not track.was_downloaded(and_exists=True)
-            exclude_played = (not track.is_new and
-                    self._config.device_sync.skip_played_episodes)
-            wrong_type = track.file_type() not in self.allowed_types
-
-            if does_not_exist or exclude_played or wrong_type:
-                logger.info('Excluding %s from sync', track.title)
-                tracklist.remove(track)
+        plan = SyncPlanner(self._config, self).plan(tracklist, force_played)
+        return self.queue_sync_tasks(plan.get_episodes_to_add(), done_callback)
 
+    def queue_sync_tasks(self, tracklist, done_callback=None):
+        """Queue sync tasks for episodes selected by a SyncPlanner"""
         if tracklist:
-            for track in sorted(tracklist, key=lambda e: e.pubdate_prop):
+            sync_tasks = []
+            for track in tracklist:
                 if self.cancelled:
                     return False
 
@@ -267,10 +320,12 @@ class Device(services.ObservableService):
 
                 sync_task.status = sync_task.QUEUED
                 sync_task.device = self
-                # New Task, we must wait on the GTK Loop
-                self.download_status_model.register_task(sync_task)
-                # Executes after task has been registered
-                util.idle_add(self.download_queue_manager.queue_task, sync_task)
+                sync_tasks.append(sync_task)
+
+            # New Tasks, we must wait on the GTK Loop (once for all tasks);
+            # they are queued after they have been registered
+            self.download_status_model.register_tasks(sync_tasks,
+                    self.download_queue_manager.queue_tasks)
         else:
             logger.warning("No episodes to sync")
 
@@ -292,6 +347,9 @@ class Device(services.ObservableService):
     def add_track(self, track, reporthook=None):
         pass
 
+    def add_track_for_task(self, task):
+        return self.add_track(task.episode, reporthook=task.status_updated)
+
     def remove_track(self, track):
         pass
 
@@ -301,12 +359,15 @@ class Device(services.ObservableService):
     def episode_on_device(self, episode):
         return self._track_on_device(episode.title)
 
+    def track_is_up_to_date(self, track, from_file):
+        """Check if a track on the device is a complete copy of "from_file"
+
+        Devices that cannot check this assume that it is.
+        """
+        return True
+
     def _track_on_device(self, track_name):
-        for t in self.tracks_list:
-            title = t.title
-            if track_name == title:
-                return t
-        return None
+        return self._get_indexed_track(self._tracks_by_title, track_name)
 
 
 class iPodDevice(Device):
@@ -505,7 +566,7 @@ class iPodDevice(Device):
         track.podcastrss = str(episode.channel.url)
 
         track.tracklen = get_track_length(local_filename)
-        track.size = os.path.getsize(local_filename)
+        track.size = filecache.getsize(local_filename)
 
         if episode.file_type() == 'audio':
             track.filetype = 'mp3'
@@ -541,15 +602,36 @@ class iPodDevice(Device):
 
 
 class MP3PlayerDevice(Device):
+    # Written to the device after syncing, so that the next open() does
+    # not have to look at every file (the name is ignored by get_all_tracks)
+    MANIFEST_FILENAME = '.gpodder-sync.json'
+    MANIFEST_VERSION = 1
+
+    # Modification times on FAT file systems have a resolution of 2 seconds
+    MTIME_TOLERANCE = 2
+    # Size of the blocks compared when checking and resuming copies
+    SAMPLE_SIZE = 64 * 1024
+    RESUME_VERIFY_ATTEMPTS = 4
+
     def __init__(self, config,
             download_status_model,
-            download_queue_manager):
+            download_queue_manager,
+            destination=None):
         Device.__init__(self, config)
-        self.destination = self._config.device_sync.device_folder
+        if destination is None:
+            destination = self._config.device_sync.device_folder
+        self.destination = destination
+        self.manifest_lock = threading.RLock()
+        self.manifest_changed = False
         self.buffer_size = 1024 * 1024  # 1 MiB
+        # Copies done by the kernel are cheaper, so report progress less often
+        self.zero_copy_chunk_size = 8 * 1024 * 1024  # 8 MiB
         self.download_status_model = download_status_model
         self.download_queue_manager = download_queue_manager
 
+    def get_name(self):
+        return os.path.basename(os.path.normpath(self.destination))
+
     def get_free_space(self):
         return util.get_free_disk_space(self.destination)
 
@@ -559,11 +641,15 @@ class MP3PlayerDevice(Device):
 
         if util.directory_is_writable(self.destination):
             self.notify('status', _('MP3 player opened'))
-            self.tracks_list = self.get_all_tracks()
+            self.tracks_list = self.load_tracks()
             return True
 
         return False
 
+    def close(self):
+        self.write_manifest()
+        return Device.close(self)
+
     def get_episode_folder_on_device(self, episode):
         folder = episode_foldername_on_device(self._config, episode)
         if folder:
@@ -579,18 +665,42 @@ class MP3PlayerDevice(Device):
     def add_track(self, episode, reporthook=None):
         self.notify('status', _('Adding %s') % episode.title)
 
-        # get the folder on the device
-        folder = self.get_episode_folder_on_device(episode)
-
         filename = episode.local_filename(create=False)
         # The file has to exist, if we ought to transfer it, and therefore,
         # local_filename(create=False) must never return None as filename
         assert filename is not None
 
         from_file = filename
+        to_file = self.prepare_track(episode, from_file)
+        if to_file is None:
+            return False
+
+        if not self._is_up_to_date(from_file, to_file):
+            logger.info('Copying %s => %s',
+                    os.path.basename(from_file),
+                    to_file)
+            if not self.copy_file_progress(from_file, to_file, reporthook):
+                return True
+
+        self.finish_track(episode, to_file)
+        return True
 
-        # verify free space
-        needed = util.calculate_size(from_file)
+    def prepare_track(self, episode, from_file):
+        """Check the free space and create the folder for an episode
+
+        Returns the filename of the episode on the device, or None if
+        the folder cannot be created.
+        """
+        # get the folder on the device
+        folder = self.get_episode_folder_on_device(episode)
+
+        # get the filename that will be used on the device
+        to_file = self.get_episode_file_on_device(episode)
+        to_file = os.path.join(folder, to_file)
+
+        # verify free space (an interrupted copy only needs the rest)
+        needed = (util.calculate_size(from_file) -
+                max(0, util.calculate_size(self._get_partial_filename(to_file))))
         free = self.get_free_space()
         if free == -1:
             logger.warn('Cannot determine free disk space on device')
@@ -599,28 +709,114 @@ class MP3PlayerDevice(Device):
             message = _('Not enough space in %(path)s: %(free)s available, but need at least %(need)s')
             raise SyncFailedException(message % d)
 
-        # get the filename that will be used on the device
-        to_file = self.get_episode_file_on_device(episode)
-        to_file = os.path.join(folder, to_file)
-
         if not os.path.exists(folder):
             try:
                 os.makedirs(folder)
             except:
                 logger.error('Cannot create folder on MP3 player: %s', folder)
-                return False
+                return None
+
+        return to_file
+
+    def finish_track(self, episode, to_file):
+        """Record an episode that has been copied to the device"""
+        with self.manifest_lock:
+            track = self._track_on_device(os.path.splitext(os.path.basename(to_file))[0])
+            if track is not None and track.filename == to_file:
+                self._remove_from_tracks_list(track)
+            self._add_to_tracks_list(self._make_track(to_file, guid=episode.guid))
+            self.manifest_changed = True
+
+    def _get_partial_filename(self, to_file):
+        # Hidden, so that get_all_tracks() does not pick it up
+        folder, basename = os.path.split(to_file)
+        return os.path.join(folder, '.' + basename + '.partial')
+
+    def _is_up_to_date(self, from_file, to_file):
+        """Returns True if "to_file" is a complete copy of "from_file"
+
+        Copies made by copy_file_progress() have the modification time
+        of their source. A destination with a different size (e.g. one
+        truncated by a crash in older versions) or an older modification
+        time than the source is copied again. With "compare_samples",
+        a few blocks of both files are compared as well.
+        """
+        try:
+            src = os.stat(from_file)
+            dst = os.stat(to_file)
+        except OSError:
+            return False
 
-        if not os.path.exists(to_file):
-            logger.info('Copying %s => %s',
-                    os.path.basename(from_file),
-                    to_file)
-            self.copy_file_progress(from_file, to_file, reporthook)
+        if src.st_size != dst.st_size:
+            logger.info('Size of %s differs, copying again', to_file)
+            return False
+
+        if dst.st_mtime + self.MTIME_TOLERANCE < src.st_mtime:
+            logger.info('%s is older than %s, copying again', to_file, from_file)
+            return False
+
+        if self._config.device_sync.compare_samples:
+            try:
+                with open(from_file, 'rb') as in_file, open(to_file, 'rb') as out_file:
+                    for offset in (0, src.st_size // 2, src.st_size - self.SAMPLE_SIZE):
+                        offset = max(0, offset)
+                        in_file.seek(offset)
+                        out_file.seek(offset)
+                        if in_file.read(self.SAMPLE_SIZE) != out_file.read(self.SAMPLE_SIZE):
+                            logger.info('Content of %s differs, copying again', to_file)
+                            return False
+            except IOError as e:
+                logger.warn('Cannot compare %s and %s: %s', from_file, to_file, e)
+                return False
 
         return True
 
+    def _get_resume_offset(self, in_fd, out_fd, total_bytes):
+        """Find the part of an interrupted copy that can be kept
+
+        The end of a file written before a crash might not have reached
+        the disk, so blocks are compared from the end of the partial file
+        backwards until one matches the source.
+        """
+        offset = os.fstat(out_fd).st_size
+        if offset > total_bytes:
+            return 0
+
+        for attempt in range(self.RESUME_VERIFY_ATTEMPTS):
+            if offset <= 0:
+                break
+
+            start = max(0, offset - self.SAMPLE_SIZE)
+            os.lseek(in_fd, start, os.SEEK_SET)
+            os.lseek(out_fd, start, os.SEEK_SET)
+            if os.read(in_fd, offset - start) == os.read(out_fd, offset - start):
+                return offset
+
+            offset = start
+
+        return 0
+
     def copy_file_progress(self, from_file, to_file, reporthook=None):
+        if reporthook is None:
+            def reporthook(count, block_size, total_size):
+                pass
+
+        total_bytes = util.calculate_size(from_file)
+
+        # If the "device" is a folder on the same file system (e.g. a
+        # folder synced by another program), no data needs to be copied
+        if (self._same_file_system(from_file, to_file) and
+                util.link_file(from_file, to_file)):
+            logger.info('Linked %s to %s', from_file, to_file)
+            reporthook(total_bytes, 1, total_bytes)
+            return True
+
+        # Copy to a temporary file, which is renamed when it is complete,
+        # so that the destination is never a partial file. The temporary
+        # file is kept if the copy is cancelled, and continued next time.
+        partial_file = self._get_partial_filename(to_file)
         try:
-            out_file = open(to_file, 'wb')
+            out_file = open(partial_file, 'r+b' if os.path.exists(partial_file) else 'wb')
         except IOError as ioerror:
             d = {'filename': ioerror.filename, 'message': ioerror.strerror}
             self.errors.append(_('Error opening %(filename)s: %(message)s') % d)
@@ -630,78 +826,253 @@ class MP3PlayerDevice(Device):
         try:
             in_file = open(from_file, 'rb')
         except IOError as ioerror:
+            out_file.close()
             d = {'filename': ioerror.filename, 'message': ioerror.strerror}
             self.errors.append(_('Error opening %(filename)s: %(message)s') % d)
             self.cancel()
             return False
 
-        in_file.seek(0, os.SEEK_END)
-        total_bytes = in_file.tell()
-        in_file.seek(0)
+        try:
+            with in_file, out_file:
+                offset = self._get_resume_offset(in_file.fileno(),
+                        out_file.fileno(), total_bytes)
+                if offset > 0:
+                    logger.info('Resuming copy of %s at %d bytes', to_file, offset)
+                os.ftruncate(out_file.fileno(), offset)
+                self._copy_data(in_file.fileno(), out_file.fileno(),
+                        total_bytes, reporthook, offset)
+
+            mtime = os.stat(from_file).st_mtime
+            os.utime(partial_file, (mtime, mtime))
+            os.replace(partial_file, to_file)
+        except (IOError, OSError) as ioerror:
+            if ioerror.errno == errno.ENOSPC:
+                logger.info('Removing partially copied file: %s', partial_file)
+                util.delete_file(partial_file)
+            self.errors.append(ioerror.strerror)
+            self.cancel()
+            return False
+        except SyncCancelledException:
+            logger.info('Keeping partially copied file: %s', partial_file)
+            raise
+
+        return True
+
+    def _same_file_system(self, from_file, to_file):
+        try:
+            return (os.stat(from_file).st_dev ==
+                    os.stat(os.path.dirname(to_file)).st_dev)
+        except OSError:
+            return False
+
+    def _copy_data(self, in_fd, out_fd, total_bytes, reporthook, position=0):
+        """Copy the data, letting the kernel do it where possible
 
-        bytes_read = 0
-        s = in_file.read(self.buffer_size)
-        while s:
-            bytes_read += len(s)
+        copy_file_range() and sendfile() avoid copying the data through
+        user space. If they are not supported for the two files, the
+        next method is used, continuing where the previous one stopped.
+        """
+        methods = []
+        if hasattr(os, 'copy_file_range'):
+            methods.append(self._copy_file_range)
+        if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+            methods.append(self._sendfile)
+        methods.append(self._copy_buffered)
+
+        method = methods.pop(0)
+        while position < total_bytes:
             try:
-                out_file.write(s)
-            except IOError as ioerror:
-                self.errors.append(ioerror.strerror)
-                try:
-                    out_file.close()
-                except:
-                    pass
-                try:
-                    logger.info('Trying to remove partially copied file: %s' % to_file)
-                    os.unlink(to_file)
-                    logger.info('Yeah! Unlinked %s at least..' % to_file)
-                except:
-                    logger.error('Error while trying to unlink %s. OH MY!' % to_file)
-                self.cancel()
-                return False
-            reporthook(bytes_read, 1, total_bytes)
-            s = in_file.read(self.buffer_size)
-        out_file.close()
-        in_file.close()
+                copied = method(in_fd, out_fd, position, total_bytes - position)
+            except OSError as e:
+                if not methods or e.errno not in FALLBACK_ERRNOS:
+                    raise
+                logger.debug('%s not supported (%s), falling back',
+                        method.__name__, e)
+                method = methods.pop(0)
+                continue
 
-        return True
+            if copied == 0:
+                if not methods:
+                    # The source file is shorter than expected
+                    break
+                method = methods.pop(0)
+                continue
+
+            position += copied
+            reporthook(position, 1, total_bytes)
+
+    def _copy_file_range(self, in_fd, out_fd, position, count):
+        count = min(count, self.zero_copy_chunk_size)
+        return os.copy_file_range(in_fd, out_fd, count, position, position)
+
+    def _sendfile(self, in_fd, out_fd, position, count):
+        count = min(count, self.zero_copy_chunk_size)
+        os.lseek(out_fd, position, os.SEEK_SET)
+        return os.sendfile(out_fd, in_fd, position, count)
+
+    def _copy_buffered(self, in_fd, out_fd, position, count):
+        os.lseek(in_fd, position, os.SEEK_SET)
+        data = os.read(in_fd, min(count, self.buffer_size))
+        os.lseek(out_fd, position, os.SEEK_SET)
+        return os.write(out_fd, data)
 
     def get_all_tracks(self):
         tracks = []
+        for folder in self._get_track_folders():
+            tracks.extend(self._scan_folder(folder))
+        return tracks
 
+    def _get_track_folders(self):
         if self._config.one_folder_per_podcast:
-            files = glob.glob(os.path.join(self.destination, '*', '*'))
+            return [folder for folder in glob.glob(os.path.join(self.destination, '*'))
+                    if os.path.isdir(folder)]
         else:
-            files = glob.glob(os.path.join(self.destination, '*'))
+            return [self.destination]
 
-        for filename in files:
-            (title, extension) = os.path.splitext(os.path.basename(filename))
+    def _make_track(self, filename, guid=None, length=None, timestamp=None):
+        (title, extension) = os.path.splitext(os.path.basename(filename))
+        if length is None:
             length = util.calculate_size(filename)
-
+        if timestamp is None:
             timestamp = util.file_modification_timestamp(filename)
-            modified = util.format_date(timestamp)
-            if self._config.one_folder_per_podcast:
-                podcast_name = os.path.basename(os.path.dirname(filename))
+        modified = util.format_date(timestamp)
+        if self._config.one_folder_per_podcast:
+            podcast_name = os.path.basename(os.path.dirname(filename))
+        else:
+            podcast_name = None
+
+        return SyncTrack(title, length, modified,
+                modified_sort=timestamp,
+                filename=filename,
+                podcast=podcast_name,
+                guid=guid)
+
+    def _scan_folder(self, folder, guids=None):
+        guids = guids or {}
+        return [self._make_track(filename,
+                    guids.get(os.path.relpath(filename, self.destination)))
+                for filename in glob.glob(os.path.join(folder, '*'))]
+
+    def _get_manifest_filename(self):
+        return os.path.join(self.destination, self.MANIFEST_FILENAME)
+
+    def _read_manifest(self):
+        try:
+            with open(self._get_manifest_filename(), 'r') as fp:
+                manifest = json.load(fp)
+        except (IOError, OSError, ValueError) as e:
+            logger.debug('No usable sync manifest on device: %s', e)
+            return None
+
+        if (not isinstance(manifest, dict) or
+                manifest.get('version') != self.MANIFEST_VERSION or
+                manifest.get('one_folder_per_podcast') != self._config.one_folder_per_podcast):
+            return None
+
+        return manifest
+
+    def load_tracks(self):
+        """Get the tracks on the device, using the manifest if possible
+
+        Folders whose modification time is still the one recorded in the
+        manifest have not had files added or removed, so their tracks
+        are taken from the manifest. Only the other folders are scanned.
+        """
+        manifest = self._read_manifest()
+        if manifest is None:
+            logger.info('Scanning all files on device')
+            tracks = self.get_all_tracks()
+            self.manifest_changed = True
+            return tracks
+
+        folder_mtimes = manifest.get('folders', {})
+        by_folder = {}
+        guids = {}
+        for entry in manifest.get('tracks', []):
+            relative = os.path.dirname(entry['path']) or os.curdir
+            by_folder.setdefault(relative, []).append(entry)
+            guids[entry['path']] = entry.get('guid')
+
+        folders = self._get_track_folders()
+        if len(folders) != len(folder_mtimes):
+            self.manifest_changed = True
+
+        tracks = []
+        for folder in folders:
+            relative = os.path.relpath(folder, self.destination)
+            try:
+                mtime = os.stat(folder).st_mtime
+            except OSError:
+                continue
+
+            if folder_mtimes.get(relative) == mtime:
+                for entry in by_folder.get(relative, []):
+                    tracks.append(self._make_track(
+                        os.path.join(self.destination, entry['path']),
+                        entry.get('guid'), entry['size'], entry['mtime']))
             else:
-                podcast_name = None
+                logger.debug('Folder changed, scanning: %s', folder)
+                tracks.extend(self._scan_folder(folder, guids))
+                self.manifest_changed = True
 
-            t = SyncTrack(title, length, modified,
-                    modified_sort=timestamp,
-                    filename=filename,
-                    podcast=podcast_name)
-            tracks.append(t)
         return tracks
 
+    def write_manifest(self):
+        """Record the tracks on the device (if they have changed)"""
+        with self.manifest_lock:
+            if not self.manifest_changed:
+                return
+
+            filename = self._get_manifest_filename()
+            try:
+                # Create the file before the folder modification times are
+                # recorded, and rewrite it in place below, so that writing
+                # the manifest does not invalidate it
+                if not os.path.exists(filename):
+                    open(filename, 'w').close()
+
+                folders = {}
+                for folder in self._get_track_folders():
+                    folders[os.path.relpath(folder, self.destination)] = os.stat(folder).st_mtime
+
+                manifest = {
+                    'version': self.MANIFEST_VERSION,
+                    'one_folder_per_podcast': self._config.one_folder_per_podcast,
+                    'folders': folders,
+                    'tracks': [{
+                        'path': os.path.relpath(track.filename, self.destination),
+                        'guid': getattr(track, 'guid', None),
+                        'size': track.length,
+                        'mtime': track.modified_sort,
+                    } for track in self.tracks_list],
+                }
+
+                with open(filename, 'w') as fp:
+                    json.dump(manifest, fp)
+                self.manifest_changed = False
+            except (IOError, OSError) as e:
+                logger.warn('Cannot write sync manifest to device: %s', e)
+                util.delete_file(filename)
+
     def episode_on_device(self, episode):
         e = util.sanitize_filename(episode.sync_filename(
             self._config.device_sync.custom_sync_name_enabled,
             self._config.device_sync.custom_sync_name),
             self._config.device_sync.max_filename_length)
+        track = self._get_indexed_track(self._tracks_by_guid, episode.guid)
+        if track is not None:
+            return track
         return self._track_on_device(e)
 
+    def track_is_up_to_date(self, track, from_file):
+        return self._is_up_to_date(from_file, track.filename)
+
     def remove_track(self, track):
         self.notify('status', _('Removing %s') % track.title)
         util.delete_file(track.filename)
+        with self.manifest_lock:
+            self._remove_from_tracks_list(track)
+            self.manifest_changed = True
         directory = os.path.dirname(track.filename)
         if self.directory_is_empty(directory) and self._config.one_folder_per_podcast:
             try:
@@ -715,6 +1086,255 @@ class MP3PlayerDevice(Device):
         return len(files + dotfiles) == 0
 
 
+class FanOutWriter(object):
+    """Writes the chunks of one source file to one device (see FanOutDevice)"""
+    QUEUE_SIZE = 4
+
+    def __init__(self, device, to_file):
+        self.device = device
+        self.to_file = to_file
+        self.partial_file = device._get_partial_filename(to_file)
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.position = 0
+        self.error = None
+        self.fd = None
+        self.thread = None
+
+    def open(self, in_fd, total_bytes):
+        try:
+            self.fd = os.open(self.partial_file,
+                    os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o666)
+            self.position = self.device._get_resume_offset(in_fd, self.fd, total_bytes)
+            if self.position > 0:
+                logger.info('Resuming copy of %s at %d bytes', self.to_file, self.position)
+            os.ftruncate(self.fd, self.position)
+        except OSError as e:
+            self.error = e
+
+    def start(self):
+        self.thread = util.run_in_background(self.run, True)
+
+    def put(self, offset, data):
+        if self.error is None:
+            self.queue.put((offset, data))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            offset, data = item
+            if self.error is not None or offset + len(data) <= self.position:
+                # Failed (keep draining the queue) or already on the device
+                continue
+
+            try:
+                data = memoryview(data)[self.position - offset:]
+                os.lseek(self.fd, self.position, os.SEEK_SET)
+                while data:
+                    written = os.write(self.fd, data)
+                    data = data[written:]
+                    self.position += written
+            except OSError as e:
+                logger.warn('Writing to %s failed: %s', self.to_file, e)
+                self.error = e
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def finish(self, mtime):
+        """Rename the complete file into place (after stop())"""
+        if self.error is None:
+            try:
+                os.utime(self.partial_file, (mtime, mtime))
+                os.replace(self.partial_file, self.to_file)
+            except OSError as e:
+                self.error = e
+
+        if self.error is not None and self.error.errno == errno.ENOSPC:
+            logger.info('Removing partially copied file: %s', self.partial_file)
+            util.delete_file(self.partial_file)
+
+
+class FanOutDevice(Device):
+    """Synchronizes several MP3 players (folders) at the same time
+
+    Every episode file is read once and written to all devices that
+    need it, with one writer thread per device. Devices that cannot be
+    opened are left out, and a device that fails does not stop the
+    copies to the other devices. The sync task of an episode shows the
+    progress of every device and fails if any of them failed, so that
+    it can be retried (devices that are done are then skipped).
+    """
+    CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
+    def __init__(self, config,
+            download_status_model,
+            download_queue_manager,
+            folders):
+        Device.__init__(self, config)
+        self.download_status_model = download_status_model
+        self.download_queue_manager = download_queue_manager
+        self.devices = [MP3PlayerDevice(config, download_status_model,
+                download_queue_manager, folder) for folder in folders]
+
+    def open(self):
+        Device.open(self)
+        self.notify('status', _('Opening MP3 players'))
+
+        opened = []
+        for device in self.devices:
+            if device.open():
+                opened.append(device)
+            else:
+                logger.warn('Cannot open %s, leaving it out', device.destination)
+        self.devices = opened
+
+        return bool(opened)
+
+    def close(self):
+        for device in self.devices:
+            device.close()
+        return True
+
+    def cancel(self):
+        Device.cancel(self)
+        for device in self.devices:
+            device.cancel()
+
+    def get_free_space(self):
+        free_space = [device.get_free_space() for device in self.devices]
+        free_space = [free for free in free_space if free != -1]
+        return min(free_space) if free_space else -1
+
+    def episode_on_device(self, episode):
+        tracks = collections.OrderedDict()
+        for device in self.devices:
+            track = device.episode_on_device(episode)
+            if track is not None:
+                tracks[device] = track
+
+        if not tracks:
+            return None
+
+        track = next(iter(tracks.values()))
+        return SyncTrack(track.title, track.length, track.modified,
+                tracks=tracks, partial=(len(tracks) < len(self.devices)))
+
+    def track_is_up_to_date(self, track, from_file):
+        return all(device.track_is_up_to_date(device_track, from_file)
+                for device, device_track in track.tracks.items())
+
+    def remove_track(self, track):
+        for device, device_track in track.tracks.items():
+            device.remove_track(device_track)
+
+    def add_track(self, episode, reporthook=None):
+        task = SyncTask(episode)
+        task.status_updated = reporthook or (lambda *args: None)
+        return self.add_track_for_task(task)
+
+    def add_track_for_task(self, task):
+        episode = task.episode
+        self.notify('status', _('Adding %s') % episode.title)
+
+        from_file = episode.local_filename(create=False)
+        assert from_file is not None
+
+        # Keyed by the full path (the folder names might be the same)
+        status = task.device_status = collections.OrderedDict()
+        writers = []
+        for device in self.devices:
+            name = device.destination
+            try:
+                to_file = device.prepare_track(episode, from_file)
+                if to_file is None:
+                    status[name] = _('Cannot create folder')
+                    continue
+
+                if device._is_up_to_date(from_file, to_file):
+                    device.finish_track(episode, to_file)
+                    status[name] = 1.0
+                elif (device._same_file_system(from_file, to_file) and
+                        util.link_file(from_file, to_file)):
+                    device.finish_track(episode, to_file)
+                    status[name] = 1.0
+                else:
+                    writers.append(FanOutWriter(device, to_file))
+                    status[name] = 0.0
+            except Exception as e:
+                logger.warn('Cannot add %s to %s: %s', episode.title, name, e)
+                status[name] = str(e)
+
+        if writers:
+            self._copy(from_file, writers, task)
+
+        failed = ['%s: %s' % (name, value) for name, value in status.items()
+                if not isinstance(value, float)]
+        if failed:
+            raise SyncFailedException('; '.join(failed))
+
+        return True
+
+    def _copy(self, from_file, writers, task):
+        total_bytes = util.calculate_size(from_file)
+        status = task.device_status
+
+        def update_status():
+            for writer in writers:
+                name = writer.device.destination
+                if writer.error is not None:
+                    status[name] = writer.error.strerror or str(writer.error)
+                elif total_bytes > 0:
+                    status[name] = writer.position / total_bytes
+
+        with open(from_file, 'rb') as in_file:
+            for writer in writers:
+                writer.open(in_file.fileno(), total_bytes)
+
+            try:
+                for writer in writers:
+                    if writer.error is None:
+                        writer.start()
+
+                active = [writer for writer in writers if writer.error is None]
+                position = min([writer.position for writer in active] or [total_bytes])
+                while active and position < total_bytes:
+                    in_file.seek(position)
+                    data = in_file.read(self.CHUNK_SIZE)
+                    if not data:
+                        break
+
+                    for writer in active:
+                        writer.put(position, data)
+                    position += len(data)
+
+                    active = [writer for writer in active if writer.error is None]
+                    update_status()
+                    if active:
+                        # Raises SyncCancelledException if cancelled
+                        task.status_updated(min(writer.position for writer in active),
+                                1, total_bytes)
+            finally:
+                for writer in writers:
+                    writer.stop()
+
+        mtime = os.stat(from_file).st_mtime
+        for writer in writers:
+            writer.finish(mtime)
+            if writer.error is None:
+                writer.device.finish_track(task.episode, writer.to_file)
+        update_status()
+
+
 class MTPDevice(Device):
     def __init__(self, config):
         Device.__init__(self, config)
@@ -945,6 +1565,188 @@ class MTPDevice(Device):
             return 0
 
 
+class SyncPlan(object):
+    """The changes a sync will make to a device
+
+    "add" is a list of (episode, size) tuples in the order in which they
+    will be copied, "remove" a list of SyncTrack objects and "skip" a
+    list of (episode, reason) tuples with one of the SKIP_* reasons.
+    """
+    SKIP_ON_DEVICE, SKIP_NOT_DOWNLOADED, SKIP_PLAYED, SKIP_FILE_TYPE, SKIP_NO_SPACE = list(range(5))
+
+    def __init__(self):
+        self.add = []
+        self.remove = []
+        self.skip = []
+        self.free_space = -1
+
+    @property
+    def add_size(self):
+        return sum(size for episode, size in self.add)
+
+    @property
+    def remove_size(self):
+        return sum(track.length for track in self.remove)
+
+    def get_episodes_to_add(self):
+        return [episode for episode, size in self.add]
+
+    def get_skipped(self, reason):
+        return [episode for episode, skip_reason in self.skip if skip_reason == reason]
+
+    def format_report(self):
+        """A human-readable summary of the plan (for dry runs)"""
+        lines = [
+            N_('Copy %(count)d episode (%(size)s)',
+               'Copy %(count)d episodes (%(size)s)', len(self.add)) % {
+                'count': len(self.add), 'size': util.format_filesize(self.add_size)},
+            N_('Remove %(count)d episode (%(size)s)',
+               'Remove %(count)d episodes (%(size)s)', len(self.remove)) % {
+                'count': len(self.remove), 'size': util.format_filesize(self.remove_size)},
+        ]
+
+        if self.free_space >= 0:
+            lines.append(_('Free space on device: %(size)s') % {
+                'size': util.format_filesize(self.free_space)})
+
+        for reason, message in (
+                (self.SKIP_NO_SPACE, _('Skipped (not enough space)')),
+                (self.SKIP_ON_DEVICE, _('Already on device')),
+                (self.SKIP_PLAYED, _('Skipped (played)')),
+                (self.SKIP_NOT_DOWNLOADED, _('Skipped (not downloaded)')),
+                (self.SKIP_FILE_TYPE, _('Skipped (file type)'))):
+            count = len(self.get_skipped(reason))
+            if count:
+                lines.append('%s: %d' % (message, count))
+
+        lines.extend('+ %s' % episode.title for episode in self.get_episodes_to_add())
+        lines.extend('- %s' % track.title for track in self.remove)
+        return '\n'.join(lines)
+
+
+class SyncPlanner(object):
+    """Decides which episodes to copy to and remove from a device
+
+    Every episode is looked at once. Episodes that are on the device
+    already are copied again if the copy is incomplete or outdated (e.g.
+    after a crash, see Device.track_is_up_to_date()). Planning does not
+    change the device, so a plan can also be used as a dry run. If the
+    episodes to copy do not fit into the free space (after removing
+    tracks), the ones that fit are selected in the order given by
+    "device_sync.priority" ('newest' or 'oldest' first).
+    """
+
+    def __init__(self, config, device):
+        self._config = config
+        self.device = device
+
+    def _get_size(self, episode):
+        """Size of the downloaded file, or None if it does not exist"""
+        if episode.state != gpodder.STATE_DOWNLOADED:
+            return None
+
+        filename = episode.local_filename(create=False)
+        if filename is None:
+            return None
+
+        try:
+            return os.stat(filename).st_size
+        except OSError:
+            return None
+
+    def _is_up_to_date(self, episode, track):
+        """Check the track of an episode against its downloaded file"""
+        if episode.state != gpodder.STATE_DOWNLOADED:
+            # Nothing to compare with, keep the track
+            return True
+
+        filename = episode.local_filename(create=False)
+        if filename is None or not os.path.exists(filename):
+            return True
+
+        if self.device.track_is_up_to_date(track, filename):
+            return True
+
+        logger.info('Copy of %s on the device is incomplete or outdated',
+                episode.title)
+        return False
+
+    def plan(self, episodes, force_played=False, removable=None):
+        """Create a SyncPlan for copying "episodes" to the device
+
+        Deleted episodes from "episodes" (and "removable", if given) are
+        removed from the device if "device_sync.delete_played_episodes"
+        is set. If "force_played" is True, played episodes are copied.
+        """
+        plan = SyncPlan()
+        sync_config = self._config.device_sync
+        delete_deleted = (sync_config.delete_played_episodes and
+                sync_config.skip_played_episodes)
+
+        candidates = []
+        to_add = set(episodes)
+        for episode in list(episodes) + [e for e in removable or () if e not in to_add]:
+            track = self.device.episode_on_device(episode)
+            if (track is not None and delete_deleted and
+                    episode.state == gpodder.STATE_DELETED):
+                plan.remove.append(track)
+                continue
+
+            if episode not in to_add:
+                continue
+
+            # With several devices, the episode might be missing on some
+            if (track is not None and not getattr(track, 'partial', False) and
+                    self._is_up_to_date(episode, track)):
+                plan.skip.append((episode, SyncPlan.SKIP_ON_DEVICE))
+                continue
+
+            if (not force_played and not episode.is_new and
+                    sync_config.skip_played_episodes):
+                plan.skip.append((episode, SyncPlan.SKIP_PLAYED))
+                continue
+
+            if episode.file_type() not in self.device.allowed_types:
+                plan.skip.append((episode, SyncPlan.SKIP_FILE_TYPE))
+                continue
+
+            size = self._get_size(episode)
+            if size is None:
+                plan.skip.append((episode, SyncPlan.SKIP_NOT_DOWNLOADED))
+                continue
+
+            candidates.append((episode, size))
+
+        free_space = self.device.get_free_space()
+        plan.free_space = -1 if free_space is None else free_space
+        if plan.free_space >= 0:
+            available = plan.free_space + plan.remove_size
+            if sum(size for episode, size in candidates) > available:
+                candidates = self._select_fitting(plan, candidates, available)
+
+        plan.add = sorted(candidates, key=lambda item: item[0].published)
+        logger.info('Sync plan: %d to add (%s), %d to remove, %d skipped',
+                len(plan.add), util.format_filesize(plan.add_size),
+                len(plan.remove), len(plan.skip))
+        return plan
+
+    def _select_fitting(self, plan, candidates, available):
+        newest_first = (self._config.device_sync.priority != 'oldest')
+        candidates = sorted(candidates, key=lambda item: item[0].published,
+                reverse=newest_first)
+
+        selected = []
+        used = 0
+        for episode, size in candidates:
+            if used + size <= available:
+                selected.append((episode, size))
+                used += size
+            else:
+                plan.skip.append((episode, SyncPlan.SKIP_NO_SPACE))
+
+        return selected
+
+
 class SyncCancelledException(Exception): pass
 
 
@@ -1031,6 +1833,9 @@ class SyncTask(download.DownloadTask):
         self.progress = 0.0
         self.error_message = None
 
+        # Progress (or error message) per device name for FanOutDevice
+        self.device_status = None
+
         # Have we already shown this task in a notification?
         self._notification_shown = False
 
@@ -1039,6 +1844,7 @@ class SyncTask(download.DownloadTask):
         self.__start_blocks = 0
         self.__limit_rate_value = 999
         self.__limit_rate = 999
+        self.throughput = download.ThroughputEstimator()
 
         # Callbacks
         self._progress_updated = lambda x: None
@@ -1076,6 +1882,8 @@ class SyncTask(download.DownloadTask):
             self.progress = max(0.0, min(1.0, (count * blockSize) / self.total_size))
             self._progress_updated(self.progress)
 
+        self.speed = self.throughput.update(count * blockSize)
+
         if self.status == SyncTask.CANCELLED:
             raise SyncCancelledException()
 
@@ -1089,6 +1897,7 @@ class SyncTask(download.DownloadTask):
         # Speed calculation (re-)starts here
         self.__start_time = 0
         self.__start_blocks = 0
+        self.throughput.reset()
 
         # If the download has already been cancelled, skip it
         if self.status == SyncTask.CANCELLED:
@@ -1107,7 +1916,7 @@ class SyncTask(download.DownloadTask):
 
         try:
             logger.info('Starting SyncTask')
-            self.device.add_track(self.episode, reporthook=self.status_updated)
+            self.device.add_track_for_task(self)
         except Exception as e:
             self.status = SyncTask.FAILED
             logger.error('Sync failed: %s', str(e), exc_info=True)
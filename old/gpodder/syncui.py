@@ -29,6 +29,7 @@ from gpodder import sync, util
 from gpodder.deviceplaylist import gPodderDevicePlaylist
 
 _ = gpodder.gettext
+N_ = gpodder.ngettext
 
 
 logger = logging.getLogger(__name__)
@@ -105,39 +106,21 @@ class gPodderSyncUI(object):
 
         if episodes is None:
             force_played = False
+            removable = None
             episodes = self._filter_sync_episodes(channels)
+        else:
+            # Deleted episodes are removed from the device even if
+            # they are not part of the (explicitly selected) episodes
+            removable = self._filter_sync_episodes(channels)
 
-        def check_free_space():
-            # "Will we add this episode to the device?"
-            def will_add(episode):
-                # If already on-device, it won't take up any space
-                if device.episode_on_device(episode):
-                    return False
-
-                # Might not be synced if it's played already
-                if (not force_played and
-                        self._config.device_sync.skip_played_episodes):
-                    return False
-
-                # In all other cases, we expect the episode to be
-                # synchronized to the device, so "answer" positive
-                return True
-
-            # "What is the file size of this episode?"
-            def file_size(episode):
-                filename = episode.local_filename(create=False)
-                if filename is None:
-                    return 0
-                return util.calculate_size(str(filename))
-
-            # Calculate total size of sync and free space on device
-            total_size = sum(file_size(e) for e in episodes if will_add(e))
-            free_space = max(device.get_free_space(), 0)
-
-            if total_size > free_space:
+        def check_free_space(plan):
+            dropped = plan.get_skipped(plan.SKIP_NO_SPACE)
+            if dropped:
                 title = _('Not enough space left on device')
-                message = (_('Additional free space required: %(required_space)s\nDo you want to continue?') %
-               {'required_space': util.format_filesize(total_size - free_space)})
+                message = (N_('%(count)d episode does not fit on the device.',
+                              '%(count)d episodes do not fit on the device.',
+                              len(dropped)) % {'count': len(dropped)} + '\n' +
+                           _('Do you want to synchronize the other episodes?'))
                 if not self.show_confirmation(message, title):
                     device.cancel()
                     device.close()
@@ -205,8 +188,10 @@ class gPodderSyncUI(object):
                 # Finally start the synchronization process
                 @util.run_in_background
                 def sync_thread_func():
-                    device.add_sync_tasks(episodes, force_played=force_played,
-                                          done_callback=done_callback)
+                    # Episodes might have been deleted after planning
+                    device.queue_sync_tasks([e for e in plan.get_episodes_to_add()
+                                             if e.state == gpodder.STATE_DOWNLOADED],
+                                            done_callback=done_callback)
 
                 return
 
@@ -291,29 +276,31 @@ class gPodderSyncUI(object):
                 logger.info('Not creating playlists - starting sync')
                 resume_sync([], [], None)
 
-        # This function is used to remove files from the device
-        def cleanup_episodes():
-            # 'skip_played_episodes' must be used or else all the
-            # played tracks will be copied then immediately deleted
-            if (self._config.device_sync.delete_played_episodes and
-                    self._config.device_sync.skip_played_episodes):
-                all_episodes = self._filter_sync_episodes(
-                    channels, only_downloaded=False)
-                for local_episode in all_episodes:
-                    episode = device.episode_on_device(local_episode)
-                    if episode is None:
-                        continue
-
-                    if local_episode.state == gpodder.STATE_DELETED:
-                        logger.info('Removing episode from device: %s',
-                                    episode.title)
-                        device.remove_track(episode)
+        # This function decides what to do and removes files from the device
+        def plan_and_cleanup_episodes():
+            planner = sync.SyncPlanner(self._config, device)
+            plan = planner.plan(episodes, force_played, removable)
+
+            if self._config.device_sync.dry_run:
+                logger.info('Dry run, not changing the device:\n%s',
+                            plan.format_report())
+                util.idle_add(self.notification, plan.format_report(),
+                              _('Synchronization preview'))
+                device.close()
+                self.device = None
+                if done_callback:
+                    done_callback()
+                return
+
+            for track in plan.remove:
+                logger.info('Removing episode from device: %s', track.title)
+            device.remove_tracks(plan.remove)
 
             # When this is done, start the callback in the UI code
-            util.idle_add(check_free_space)
+            util.idle_add(check_free_space, plan)
 
         # This will run the following chain of actions:
-        #  1. Remove old episodes (in worker thread)
+        #  1. Plan the sync and remove old episodes (in worker thread)
         #  2. Check for free space (in UI thread)
         #  3. Sync the device (in UI thread)
-        util.run_in_background(cleanup_episodes)
+        util.run_in_background(plan_and_cleanup_episodes)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# gpodder.test.download - Unit tests for gpodder.download
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from gpodder import dbsqlite, download
+
+MB = 1024 * 1024
+
+
+class FakeConfig(object):
+    class downloads(object):
+        min_free_space = 0
+
+
+class FakeTask(object):
+    def __init__(self, total_size, progress=0.):
+        self.activity = download.DownloadTask.ACTIVITY_DOWNLOAD
+        self.status = download.DownloadTask.QUEUED
+        self.total_size = total_size
+        self.progress = progress
+        self.url = 'http://example.com/episode.mp3'
+        self.waiting_for_space = False
+        self.size_looked_up = False
+        self.size = total_size
+
+    def look_up_size(self):
+        self.total_size = self.size
+
+
+class TestDiskSpaceAdmission(unittest.TestCase):
+    def setUp(self):
+        self.rechecks = []
+        self.admission = download.DiskSpaceAdmission(FakeConfig(),
+                lambda: self.rechecks.append(True))
+        self.lookups = []
+        for target, value in (('gpodder.util.get_free_disk_space', 100 * MB),
+                              ('gpodder.util.run_in_background', None)):
+            patcher = mock.patch(target, return_value=value)
+            started = patcher.start()
+            self.addCleanup(patcher.stop)
+        # Size lookups are run by finish_lookups()
+        started.side_effect = lambda function, daemon=False: self.lookups.append(function)
+
+    def finish_lookups(self):
+        while self.lookups:
+            self.lookups.pop(0)()
+
+    def start(self, task):
+        self.assertTrue(self.admission.admit(task))
+        task.status = download.DownloadTask.DOWNLOADING
+
+    def test_admits_task_that_fits(self):
+        self.assertTrue(self.admission.admit(FakeTask(50 * MB)))
+
+    def test_holds_task_that_does_not_fit(self):
+        task = FakeTask(150 * MB)
+        self.assertFalse(self.admission.admit(task))
+        self.assertTrue(task.waiting_for_space)
+        self.assertIn(task, self.admission.waiting)
+
+    def test_running_downloads_are_reserved(self):
+        self.start(FakeTask(60 * MB))
+        self.assertFalse(self.admission.admit(FakeTask(60 * MB)))
+
+    def test_only_remaining_bytes_are_reserved(self):
+        self.start(FakeTask(60 * MB, progress=0.5))
+        self.assertTrue(self.admission.admit(FakeTask(60 * MB)))
+
+    def test_finished_downloads_release_space(self):
+        running = FakeTask(60 * MB)
+        self.start(running)
+        running.status = download.DownloadTask.DONE
+        self.assertTrue(self.admission.admit(FakeTask(60 * MB)))
+
+    def test_free_space_floor(self):
+        FakeConfig.downloads.min_free_space = 60
+        self.addCleanup(setattr, FakeConfig.downloads, 'min_free_space', 0)
+        self.assertFalse(self.admission.admit(FakeTask(50 * MB)))
+
+    def test_unknown_size_is_looked_up_later(self):
+        task = FakeTask(-1)
+        task.size = 150 * MB
+        self.assertFalse(self.admission.admit(task))
+        self.assertFalse(self.admission.admit(task))
+        self.assertIn(task, self.admission.waiting)
+        self.assertFalse(task.waiting_for_space)
+        self.assertEqual(len(self.lookups), 1)
+
+        self.finish_lookups()
+        self.assertEqual(self.rechecks, [True])
+        self.assertEqual(task.total_size, 150 * MB)
+        self.assertFalse(self.admission.admit(task))
+        self.assertTrue(task.waiting_for_space)
+
+    def test_size_that_cannot_be_looked_up(self):
+        task = FakeTask(-1)
+        self.assertFalse(self.admission.admit(task))
+        self.finish_lookups()
+        self.assertTrue(self.admission.admit(task))
+        self.assertNotIn(task, self.admission.waiting)
+
+    def test_admit_does_not_send_requests(self):
+        with mock.patch('gpodder.resolver.resolve') as resolve:
+            self.start(FakeTask(1))
+            self.assertFalse(self.admission.admit(FakeTask(-1)))
+        resolve.assert_not_called()
+
+    def test_size_lookup_wakes_up_waiting_worker(self):
+        task = FakeTask(-1)
+        task.status = download.DownloadTask.QUEUED
+        self.admission.admit(task)
+        self.admission.RECHECK_INTERVAL = 60
+        timer = threading.Timer(.1, self.finish_lookups)
+        timer.start()
+        self.addCleanup(timer.join)
+        started = time.time()
+        self.assertTrue(self.admission.wait_for_space())
+        self.assertLess(time.time() - started, 30)
+
+    def test_sync_tasks_are_always_admitted(self):
+        task = FakeTask(150 * MB)
+        task.activity = download.DownloadTask.ACTIVITY_SYNCHRONIZE
+        self.assertTrue(self.admission.admit(task))
+
+
+class FakeDatabase(object):
+    def __init__(self, db):
+        self.db = db
+        self.commits = 0
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def commit(self):
+        self.commits += 1
+        self.db.commit()
+
+
+class FakeEpisode(object):
+    def __init__(self, folder, db, episode_id):
+        self.id = episode_id
+        self.podcast_id = 1
+        self.title = 'Episode %d' % episode_id
+        self.file_size = 1000
+        self.download_task = None
+        self.db = db
+        self._filename = os.path.join(folder, '%d.mp3' % episode_id)
+
+    def local_filename(self, create, check_only=False):
+        return self._filename
+
+
+class FakeTaskConfig(object):
+    limit_rate = False
+    limit_rate_value = 0
+
+
+class TestDownloadJournal(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.db = FakeDatabase(dbsqlite.Database(os.path.join(self.folder,
+                'database.sqlite')))
+        self.addCleanup(self.db.close)
+
+        # Flush explicitly instead of in a background thread
+        self.journal = download.DownloadJournal()
+        for target, value in (('gpodder.download._journal', self.journal),
+                              ('gpodder.util.run_in_background', mock.Mock())):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def task(self, episode_id, priority=None):
+        episode = FakeEpisode(self.folder, self.db, episode_id)
+        return download.DownloadTask(episode, FakeTaskConfig(), priority)
+
+    def queued_ids(self):
+        return [entry['episode_id'] for entry in self.db.load_download_queue()]
+
+    def test_changes_are_written_in_one_batch(self):
+        tasks = [self.task(i) for i in range(5)]
+        for task in tasks:
+            task.status = task.QUEUED
+            task.status = task.DOWNLOADING
+        self.assertEqual(self.queued_ids(), [])
+        self.assertEqual(self.db.commits, 0)
+
+        self.journal.flush()
+        self.assertEqual(self.queued_ids(), list(range(5)))
+        self.assertEqual(self.db.commits, 1)
+
+    def test_pending_changes_are_loaded(self):
+        task = self.task(1)
+        task.validator = '"etag"'
+        task.status = task.PAUSED
+        self.assertEqual(self.journal.load(self.db, 1)['validator'], '"etag"')
+
+    def test_failed_and_finished_tasks_are_removed(self):
+        tasks = [self.task(i) for i in range(3)]
+        for task in tasks:
+            task.status = task.QUEUED
+        self.journal.flush()
+
+        tasks[0].status = tasks[0].FAILED
+        tasks[1].status = tasks[1].DONE
+        self.journal.flush()
+        self.assertEqual(self.queued_ids(), [2])
+
+    def test_manual_downloads_are_restored_first(self):
+        automatic = self.task(1, download.DownloadTask.PRIORITY_AUTOMATIC)
+        manual = self.task(2)
+        for task in (automatic, manual):
+            task.status = task.QUEUED
+        self.journal.flush()
+        self.assertEqual(self.queued_ids(), [2, 1])
+
+    def test_resume_restores_priority_and_validator(self):
+        task = self.task(1, download.DownloadTask.PRIORITY_AUTOMATIC)
+        task.validator = '"etag"'
+        task.status = task.PAUSED
+        self.journal.flush()
+
+        # The partial file is picked up again after a restart
+        task = self.task(1)
+        self.assertEqual(task.priority, download.DownloadTask.PRIORITY_AUTOMATIC)
+        self.assertEqual(task.validator, '"etag"')
+
+        # Without a partial file, the old entry is not used
+        os.remove(task.tempname)
+        task = self.task(1)
+        self.assertEqual(task.priority, download.DownloadTask.PRIORITY_MANUAL)
+        self.assertIsNone(task.validator)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# gpodder.test.filecache - Unit tests for gpodder.filecache
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from gpodder import filecache
+
+
+class FileStateCacheTestBase(object):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.cache = filecache.FileStateCache()
+        self.filename = os.path.join(self.folder, 'episode.mp3')
+
+    def write(self, filename, size):
+        with open(filename, 'wb') as fp:
+            fp.write(b'x' * size)
+
+    def create(self, filename, size):
+        # Like gPodder does after writing a file
+        self.write(filename, size)
+        self.cache.invalidate(filename)
+
+    def test_invalidate_new_file(self):
+        self.assertFalse(self.cache.exists(self.filename))
+        self.write(self.filename, 5)
+        self.cache.invalidate(self.filename)
+        self.assertTrue(self.cache.exists(self.filename))
+        self.assertEqual(self.cache.getsize(self.filename), 5)
+
+    def test_invalidate_changed_file(self):
+        self.create(self.filename, 5)
+        self.assertEqual(self.cache.getsize(self.filename), 5)
+        self.write(self.filename, 7)
+        self.cache.invalidate(self.filename)
+        self.assertEqual(self.cache.getsize(self.filename), 7)
+
+    def test_invalidate_deleted_file(self):
+        self.create(self.filename, 5)
+        self.assertTrue(self.cache.exists(self.filename))
+        os.remove(self.filename)
+        self.cache.invalidate(self.filename)
+        self.assertFalse(self.cache.exists(self.filename))
+        self.assertRaises(OSError, self.cache.getsize, self.filename)
+
+    def test_invalidate_folder(self):
+        self.create(self.filename, 5)
+        self.assertTrue(self.cache.exists(self.filename))
+        moved = self.folder + '-moved'
+        os.rename(self.folder, moved)
+        self.addCleanup(os.rename, moved, self.folder)
+        self.cache.invalidate_folder(self.folder + os.sep)
+        self.assertFalse(self.cache.exists(self.filename))
+
+    def test_folder_spellings_share_entry(self):
+        self.assertFalse(self.cache.exists(self.filename))
+        other = os.path.join(self.folder, '.', 'episode.mp3')
+        self.assertFalse(self.cache.exists(other))
+        self.write(self.filename, 5)
+        self.cache.invalidate(other)
+        self.assertTrue(self.cache.exists(self.filename))
+
+    def test_missing_folder(self):
+        filename = os.path.join(self.folder, 'missing', 'episode.mp3')
+        self.assertFalse(self.cache.exists(filename))
+
+    def test_case_insensitive_platforms(self):
+        self.create(self.filename, 5)
+        upper = os.path.join(self.folder, 'EPISODE.mp3')
+        self.assertFalse(self.cache.exists(upper))
+        with mock.patch('sys.platform', 'darwin'), \
+                mock.patch('os.path.exists', return_value=True), \
+                mock.patch('os.path.getsize', return_value=5):
+            self.assertTrue(self.cache.exists(upper))
+            self.assertEqual(self.cache.getsize(upper), 5)
+
+
+class TestFileStateCacheRevalidate(FileStateCacheTestBase, unittest.TestCase):
+    """Without inotify, folders are checked by modification time"""
+    def setUp(self):
+        FileStateCacheTestBase.setUp(self)
+        self.cache._inotify_failed = True
+
+    def test_revalidate_changed_folder(self):
+        self.assertFalse(self.cache.exists(self.filename))
+        self.write(self.filename, 5)
+        # Pretend the folder was scanned long ago
+        self.cache._folders[self.folder].checked -= 2 * filecache.REVALIDATE_INTERVAL
+        self.assertTrue(self.cache.exists(self.filename))
+
+
+class TestFileStateCacheInotify(FileStateCacheTestBase, unittest.TestCase):
+    def setUp(self):
+        FileStateCacheTestBase.setUp(self)
+        self.cache.exists(self.filename)
+        if self.cache._inotify is None:
+            self.skipTest('inotify is not available')
+
+    def wait_for(self, filename, exists):
+        deadline = time.time() + 5
+        while self.cache.exists(filename) != exists and time.time() < deadline:
+            time.sleep(.01)
+        return self.cache.exists(filename)
+
+    def test_external_changes(self):
+        self.write(self.filename, 5)
+        self.assertTrue(self.wait_for(self.filename, True))
+        os.remove(self.filename)
+        self.assertFalse(self.wait_for(self.filename, False))
+
+    def test_symlinked_folder(self):
+        link = self.folder + '-link'
+        os.symlink(self.folder, link)
+        self.addCleanup(os.remove, link)
+        linked_filename = os.path.join(link, 'episode.mp3')
+
+        self.assertFalse(self.cache.exists(linked_filename))
+        self.write(self.filename, 5)
+        self.assertTrue(self.wait_for(self.filename, True))
+        self.assertTrue(self.wait_for(linked_filename, True))
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# gpodder.test.my - Unit tests for gpodder.my
+
+
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import gpodder
+from gpodder import model, my
+
+
+class FakeConfig(object):
+    class mygpo(object):
+        enabled = True
+        username = 'user'
+        password = 'secret'
+        server = 'gpodder.net'
+        compact_actions = True
+
+        class device(object):
+            uid = 'device'
+            caption = 'Device'
+            type = 'desktop'
+
+    def add_observer(self, callback):
+        pass
+
+
+class MygPoClientTestBase(object):
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        for target, value in (('gpodder.home', folder),
+                              ('atexit.register', mock.Mock()),
+                              ('gpodder.util.run_in_background', mock.Mock()),
+                              ('time.time', mock.Mock(return_value=1000.))):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.client = my.MygPoClient(FakeConfig())
+        self.addCleanup(self.client._store.close)
+
+    def set_time(self, current):
+        my.time.time.return_value = current
+
+
+class TestFlushScheduling(MygPoClientTestBase, unittest.TestCase):
+    def test_flush_is_delayed(self):
+        self.client.flush()
+        self.assertEqual(self.client._flush_due, 1000 + my.MygPoClient.FLUSH_DELAY)
+
+        # Every change delays the flush again...
+        self.set_time(1005)
+        self.client.flush()
+        self.assertEqual(self.client._flush_due, 1005 + my.MygPoClient.FLUSH_DELAY)
+
+        # ...but not longer than FLUSH_MAX_DELAY after the first one
+        self.set_time(1000 + my.MygPoClient.FLUSH_MAX_DELAY - 1)
+        self.client.flush()
+        self.assertEqual(self.client._flush_due, 1000 + my.MygPoClient.FLUSH_MAX_DELAY)
+
+    def test_flush_now(self):
+        self.client.flush()
+        self.client.flush(now=True)
+        self.assertEqual(self.client._flush_due, 1000)
+
+    def test_failures_back_off(self):
+        delays = []
+        for attempt in range(10):
+            self.client._schedule_next_flush(False, False)
+            delays.append(self.client._flush_due - 1000)
+        self.assertEqual(delays[:4], [30, 60, 120, 240])
+        self.assertEqual(delays[-1], my.MygPoClient.MAX_RETRY_DELAY)
+
+        # New changes do not retry earlier than the backoff allows
+        self.client.flush()
+        self.assertEqual(self.client._flush_due, 1000 + my.MygPoClient.MAX_RETRY_DELAY)
+
+        self.client._schedule_next_flush(True, False)
+        self.assertEqual(self.client._failures, 0)
+
+    def test_pending_actions_are_flushed_right_away(self):
+        self.client._schedule_next_flush(True, True)
+        self.assertEqual(self.client._flush_due, 1000)
+
+    def test_flush_uploads_bounded_batches(self):
+        limit = my.EPISODE_ACTIONS_BATCH_SIZE * my.EPISODE_ACTIONS_MAX_BATCHES
+        actions = list(range(limit + 1))
+        with mock.patch.object(self.client, 'load_episode_actions', return_value=actions), \
+                mock.patch.object(self.client, 'synchronize_subscriptions', return_value=True), \
+                mock.patch.object(self.client, 'synchronize_episodes',
+                        return_value=True) as synchronize_episodes:
+            self.assertEqual(self.client._flush_queue(), (True, True))
+            synchronize_episodes.assert_called_once_with(actions[:limit])
+
+            del actions[limit:]
+            self.assertEqual(self.client._flush_queue(), (True, False))
+
+
+class TestShutdown(MygPoClientTestBase, unittest.TestCase):
+    def test_queued_actions_are_committed(self):
+        # The worker is still busy (and never exits)
+        self.client._worker_thread = mock.Mock()
+        self.client.SHUTDOWN_TIMEOUT = 0
+        with mock.patch.object(self.client._store, 'commit') as commit, \
+                mock.patch.object(self.client._store, 'close') as close:
+            self.client._at_exit()
+        commit.assert_called_with()
+        close.assert_not_called()
+        self.assertTrue(self.client._worker_closes_store)
+
+    def test_store_is_closed_without_worker(self):
+        with mock.patch.object(self.client._store, 'close') as close:
+            self.client._at_exit()
+        close.assert_called_with()
+
+
+def action(name, timestamp, started=None, position=None, total=None,
+        episode='http://example.com/1.mp3', device='device'):
+    return my.EpisodeAction('http://example.com/feed.xml', episode, device,
+            name, timestamp, started, position, total)
+
+
+def summary(actions):
+    return [(a.action, a.timestamp, a.started, a.position, a.device_id)
+            for a in actions]
+
+
+class TestCompactEpisodeActions(unittest.TestCase):
+    def compact(self, actions):
+        return summary(my.compact_episode_actions(actions))
+
+    def test_continuing_ranges_are_merged(self):
+        actions = [action('play', 1, 0, 100, 600),
+                   action('play', 2, 102, 200, 600),
+                   action('play', 3, 200, 300, 600)]
+        self.assertEqual(self.compact(actions), [('play', 3, 0, 300, 'device')])
+
+    def test_ranges_with_gap_are_kept(self):
+        gap = my.PLAY_RANGE_GAP + 1
+        actions = [action('play', 1, 0, 100, 600),
+                   action('play', 2, 100 + gap, 200, 600)]
+        self.assertEqual(len(self.compact(actions)), 2)
+
+    def test_same_range_is_merged(self):
+        actions = [action('play', 1, 100, 200, 600),
+                   action('play', 2, 100, 200, 600)]
+        self.assertEqual(self.compact(actions), [('play', 2, 100, 200, 'device')])
+
+    def test_seek_back_is_not_merged(self):
+        actions = [action('play', 1, 100, 200, 600),
+                   action('play', 2, 50, 150, 600)]
+        self.assertEqual(self.compact(actions), summary(actions))
+
+    def test_input_is_not_modified(self):
+        actions = [action('play', 1, 0, 100, 600), action('play', 2, 100, 200, 600)]
+        before = summary(actions)
+        my.compact_episode_actions(actions)
+        self.assertEqual(summary(actions), before)
+
+    def test_bare_play_is_dropped_only_with_ranged_play(self):
+        bare = action('play', 1)
+        self.assertEqual(self.compact([bare]), summary([bare]))
+
+        ranged = action('play', 2, 0, 100, 600)
+        self.assertEqual(self.compact([bare, ranged]), summary([ranged]))
+
+    def test_only_latest_state_action_is_kept(self):
+        actions = [action('download', 1), action('delete', 2),
+                   action('new', 3), action('download', 4)]
+        self.assertEqual(self.compact(actions), [('download', 4, None, None, 'device')])
+
+        # Also if the actions were queued out of order
+        self.assertEqual(self.compact(actions[::-1]), [('download', 4, None, None, 'device')])
+
+    def test_groups_per_episode_and_device(self):
+        actions = [action('play', 1, 0, 100, 600),
+                   action('play', 2, 100, 200, 600, device='other'),
+                   action('play', 3, 100, 200, 600, episode='http://example.com/2.mp3'),
+                   action('delete', 4, device='other'),
+                   action('delete', 5)]
+        self.assertEqual(self.compact(actions), summary(actions))
+
+    def test_result_is_sorted_by_timestamp(self):
+        actions = [action('download', 3), action('play', 1, 0, 100, 600),
+                   action('play', 2, 0, 10, 600, episode='http://example.com/2.mp3')]
+        self.assertEqual([a[1] for a in self.compact(actions)], [1, 2, 3])
+
+
+class TestLoadEpisodeActions(MygPoClientTestBase, unittest.TestCase):
+    def setUp(self):
+        MygPoClientTestBase.setUp(self)
+        self.actions = [action('play', 1, 0, 100, 600),
+                        action('play', 2, 100, 200, 600)]
+        self.client._store.save(self.actions)
+
+    def stored(self):
+        return summary(sorted(self.client._store.load(my.EpisodeAction),
+                key=lambda a: a.timestamp))
+
+    def test_queue_is_compacted(self):
+        expected = [('play', 2, 0, 200, 'device')]
+        self.assertEqual(summary(self.client.load_episode_actions()), expected)
+        self.assertEqual(self.stored(), expected)
+
+    def test_compacting_can_be_disabled(self):
+        with mock.patch.object(FakeConfig.mygpo, 'compact_actions', False):
+            self.assertEqual(len(self.client.load_episode_actions()), 2)
+        self.assertEqual(self.stored(), summary(self.actions))
+
+
+class FakeEpisode(model.PodcastEpisode):
+    def __init__(self, state=gpodder.STATE_NORMAL, file_exists=False):
+        model.PodcastEpisode.__init__(self, model.PodcastChannel(None))
+        self.url = 'http://example.com/1.mp3'
+        self.state = state
+        self._file_exists = file_exists
+        self.saved = 0
+
+    def local_filename(self, create, force_update=False, check_only=False,
+            template=None, return_wanted_filename=False):
+        return None
+
+    def file_exists(self):
+        return self._file_exists
+
+    def save(self):
+        self.saved += 1
+
+    def get_state(self):
+        return (self.state, self.is_new, self.current_position,
+                self.current_position_updated, self.total_time)
+
+
+def apply_in_order(episode, actions):
+    """Apply received actions one by one (like gPodder did before merging)"""
+    for action in actions:
+        if action.action == 'play':
+            episode.mark(is_played=True)
+            if (action.timestamp > episode.current_position_updated and
+                    action.position is not None):
+                episode.current_position = action.position
+                episode.current_position_updated = action.timestamp
+            if action.total:
+                episode.total_time = action.total
+            episode.save()
+        elif action.action == 'delete':
+            if not episode.was_downloaded(and_exists=True):
+                episode.delete_from_disk()
+                episode.save()
+
+
+class TestMergedEpisodeAction(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('gpodder.user_extensions', mock.Mock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertSameResult(self, actions, **kwargs):
+        expected = FakeEpisode(**kwargs)
+        expected.current_position_updated = 5
+        apply_in_order(expected, actions)
+
+        episode = FakeEpisode(**kwargs)
+        episode.current_position_updated = 5
+        merged = my.MergedEpisodeAction()
+        for action in actions:
+            merged.add(action)
+        self.assertTrue(merged.apply(episode))
+
+        self.assertEqual(episode.get_state(), expected.get_state())
+        self.assertGreater(episode.saved, 0)
+        return episode
+
+    def test_play_then_delete(self):
+        episode = self.assertSameResult([action('play', 10, 0, 100, 600),
+                action('delete', 11)])
+        self.assertEqual(episode.state, gpodder.STATE_DELETED)
+        self.assertFalse(episode.is_new)
+
+    def test_delete_then_play(self):
+        episode = self.assertSameResult([action('delete', 10),
+                action('play', 11, 0, 100, 600)])
+        self.assertEqual(episode.state, gpodder.STATE_DELETED)
+        self.assertEqual(episode.current_position, 100)
+
+    def test_positions_out_of_order(self):
+        episode = self.assertSameResult([action('play', 20, 0, 200, 600),
+                action('play', 30, 200, 300, 600),
+                action('play', 3, 0, 400, 600),
+                action('play', 25, 0, 250, 700)])
+        self.assertEqual((episode.current_position, episode.current_position_updated),
+                (300, 30))
+        self.assertEqual(episode.total_time, 700)
+
+    def test_older_positions_are_ignored(self):
+        episode = self.assertSameResult([action('play', 3, 0, 400, 600)])
+        self.assertEqual(episode.current_position, 0)
+        self.assertFalse(episode.is_new)
+
+    def test_delete_keeps_existing_file(self):
+        episode = self.assertSameResult([action('play', 10, 0, 100, 600),
+                action('delete', 11)], state=gpodder.STATE_DOWNLOADED,
+                file_exists=True)
+        self.assertEqual(episode.state, gpodder.STATE_DOWNLOADED)
+
+    def test_delete_of_missing_file(self):
+        episode = self.assertSameResult([action('delete', 10)],
+                state=gpodder.STATE_DOWNLOADED)
+        self.assertEqual(episode.state, gpodder.STATE_DELETED)
+
+    def test_other_actions_change_nothing(self):
+        merged = my.MergedEpisodeAction()
+        merged.add(action('download', 10))
+        episode = FakeEpisode()
+        self.assertFalse(merged.apply(episode))
+        self.assertEqual(episode.saved, 0)
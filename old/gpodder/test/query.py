@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# gpodder.test.query - Unit tests for gpodder.query (EQL to SQL)
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import gpodder
+from gpodder import dbsqlite, model, query
+
+
+class FakeEpisode(object):
+    """The episode attributes stored in the database and used by EQL"""
+    is_finished = model.PodcastEpisode.is_finished
+    downloading = False
+
+    def __init__(self, i):
+        self.id = None
+        self.podcast_id = 1 + i % 2
+        self.title = ('Linux news', 'S04E%02d' % i, 'Caf\xe9 talk', 'Other')[i % 4]
+        self.description = 'Episode %d' % i
+        self.url = 'http://example.com/%d%s' % (i, ('.mp3', '.torrent')[i % 5 == 0])
+        self.guid = str(i)
+        self.link = ''
+        self.published = i * 24 * 60 * 60
+        self.file_size = (i % 7) * 40 * 1024 * 1024
+        self.mime_type = 'audio/mpeg'
+        self.state = (gpodder.STATE_NORMAL, gpodder.STATE_DOWNLOADED,
+                gpodder.STATE_DELETED)[i % 3]
+        self.is_new = bool(i % 2)
+        self.archive = i % 4 == 1
+        self.download_filename = None
+        self.total_time = (i % 5) * 20 * 60
+        self.current_position = (0, 100, self.total_time)[i % 3]
+        self.current_position_updated = 0
+        self.last_playback = 0
+        self.payment_url = None
+        self.description_html = ''
+        self.exists = i % 6 != 1
+
+    def was_downloaded(self, and_exists=False):
+        return (self.state == gpodder.STATE_DOWNLOADED and
+                (not and_exists or self.exists))
+
+    def file_type(self):
+        return 'audio'
+
+    def age_in_days(self):
+        return 100 - self.published // (24 * 60 * 60)
+
+
+class TestEQLDatabase(unittest.TestCase):
+    QUERIES = [
+        'new', 'played', 'deleted', 'archive', 'finished', 'torrent',
+        'downloaded', 'dl and mb > 100', 'not (deleted or archive)',
+        "'S04' in title", "'Linux' not in title and minutes > 30",
+        '1 < mb / 2 < 50', 'rem > 10', 'new and age > 50',
+        'downloaded or new', '/^linux/i', "'caf\xe9'", "title[0] == 'L'",
+    ]
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.db = dbsqlite.Database(os.path.join(self.folder, 'database.sqlite'))
+        self.addCleanup(self.db.close)
+
+        self.episodes = [FakeEpisode(i) for i in range(60)]
+        for episode in self.episodes:
+            self.db.save_episode(episode)
+        self.by_id = {episode.id: episode for episode in self.episodes}
+
+    def expected_ids(self, eql, podcast_id=None):
+        newest_first = sorted(self.episodes, key=lambda e: -e.published)
+        return [e.id for e in newest_first if eql.match(e) and
+                podcast_id in (None, e.podcast_id)]
+
+    def test_same_result_as_python(self):
+        for q in self.QUERIES:
+            eql = query.EQL(q)
+            self.assertEqual(eql.find_episode_ids(self.db, self.by_id.get),
+                    self.expected_ids(eql), q)
+
+    def test_podcast_id(self):
+        eql = query.EQL('new and mb > 50')
+        self.assertEqual(eql.find_episode_ids(self.db, self.by_id.get, 2),
+                self.expected_ids(eql, 2))
+
+    def test_exact_queries_need_no_episodes(self):
+        for q in ('new and mb > 100', "'S04' in title", '/^linux/i', 'finished'):
+            where, params, residual = query.EQL(q).get_sql()
+            self.assertIsNone(residual, q)
+            self.assertEqual(query.EQL(q).find_episode_ids(self.db),
+                    self.expected_ids(query.EQL(q)), q)
+
+    def test_residual_needs_episodes(self):
+        self.assertRaises(ValueError, query.EQL('downloaded').find_episode_ids,
+                self.db)
+
+    def test_residual_only_checks_candidates(self):
+        checked = []
+
+        def get_episode(id):
+            checked.append(id)
+            return self.by_id[id]
+
+        eql = query.EQL('new and age > 50')
+        eql.find_episode_ids(self.db, get_episode)
+        self.assertEqual(sorted(checked), sorted(e.id for e in self.episodes
+                if e.state == gpodder.STATE_NORMAL and e.is_new))
+
+    def test_find_episodes_keeps_order(self):
+        episodes = self.episodes[::-1][:30]
+        eql = query.EQL('played or torrent')
+        self.assertEqual(eql.find_episodes(self.db, episodes),
+                [e for e in episodes if eql.match(e)])
+
+    def test_invalid_query(self):
+        self.assertEqual(query.EQL('/(/').find_episodes(self.db, self.episodes), [])
+
+    def test_errors_are_logged_once(self):
+        class BrokenEpisode(object):
+            def was_downloaded(self, and_exists=False):
+                raise IOError('cannot check')
+
+        eql = query.EQL('downloaded')
+        with self.assertLogs('gpodder.query', 'WARNING') as logs:
+            self.assertEqual(eql.find_episode_ids(self.db,
+                    lambda id: BrokenEpisode()), [])
+        self.assertEqual(len(logs.output), 1)
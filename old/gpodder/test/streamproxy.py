@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# gpodder.test.streamproxy - Unit tests for gpodder.streamproxy
+
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+
+from gpodder import download, streamproxy
+
+
+class FakeEpisode(object):
+    mime_type = 'audio/mpeg'
+
+    class channel(object):
+        @staticmethod
+        def authenticate_url(url):
+            return url
+
+
+class FakeTask(object):
+    DOWNLOADING = download.DownloadTask.DOWNLOADING
+    DONE = download.DownloadTask.DONE
+    FAILED = download.DownloadTask.FAILED
+    CANCELLED = download.DownloadTask.CANCELLED
+    ACTIVITY_DOWNLOAD = download.DownloadTask.ACTIVITY_DOWNLOAD
+    ACTIVITY_POSTPROCESS = download.DownloadTask.ACTIVITY_POSTPROCESS
+
+    def __init__(self, folder, total_size):
+        self.status = self.DOWNLOADING
+        self.activity = self.ACTIVITY_DOWNLOAD
+        self.filename = os.path.join(folder, 'episode.mp3')
+        self.tempname = self.filename + '.partial'
+        self.total_size = total_size
+        self.episode = FakeEpisode()
+        self.url = 'http://example.com/episode.mp3'
+
+
+class FakeResponse(io.BytesIO):
+    def __init__(self, code, data):
+        io.BytesIO.__init__(self, data)
+        self.code = code
+
+    def getcode(self):
+        return self.code
+
+
+class TestStreamProxy(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.proxy = streamproxy.StreamProxy()
+        self.addCleanup(self.proxy.stop)
+        self.proxy.STALL_TIMEOUT = 0
+
+        self.task = FakeTask(self.folder, 10 * 1024 * 1024)
+        with open(self.task.tempname, 'wb') as fp:
+            fp.write(b'a' * 1000)
+        self.url = self.proxy.get_url(self.task)
+
+    def get(self, byte_range=None):
+        headers = {} if byte_range is None else {'Range': byte_range}
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(self.url,
+                    headers=headers))
+        except urllib.error.HTTPError as e:
+            return e.code, None
+        with response:
+            return response.status, response.read()
+
+    def test_range_of_partial_file(self):
+        self.assertEqual(self.get('bytes=10-19'), (206, b'a' * 10))
+
+    def test_remote_range(self):
+        with mock.patch('gpodder.util.urlopen',
+                return_value=FakeResponse(206, b'remote')) as urlopen:
+            self.assertEqual(self.get('bytes=9000000-9000005'), (206, b'remote'))
+        self.assertEqual(urlopen.call_args[0][1], {'Range': 'bytes=9000000-9000005'})
+
+    def test_remote_range_not_supported(self):
+        with mock.patch('gpodder.util.urlopen',
+                return_value=FakeResponse(200, b'whole file')):
+            self.assertEqual(self.get('bytes=9000000-'), (502, None))
+
+    def test_remote_range_error(self):
+        error = urllib.error.HTTPError(self.task.url, 416, 'Range Not Satisfiable',
+                {}, None)
+        with mock.patch('gpodder.util.urlopen', side_effect=error):
+            self.assertEqual(self.get('bytes=9000000-'), (416, None))
+
+        with mock.patch('gpodder.util.urlopen', side_effect=IOError('offline')):
+            self.assertEqual(self.get('bytes=9000000-'), (502, None))
+
+    def test_finished_task_is_forgotten(self):
+        os.rename(self.task.tempname, self.task.filename)
+        self.task.status = self.task.DONE
+        self.assertEqual(self.get('bytes=0-3'), (206, b'aaaa'))
+        self.assertEqual(self.proxy._tasks, {})
+        self.assertEqual(self.proxy._tokens, {})
+
+        # The file can still be played
+        self.assertEqual(self.get(), (200, b'a' * 1000))
+
+    def test_cancelled_task_is_forgotten(self):
+        self.task.status = self.task.CANCELLED
+        self.assertEqual(self.get(), (404, None))
+        self.assertEqual(self.proxy._tasks, {})
+        self.assertEqual(self.proxy._tokens, {})
+
+    def test_number_of_finished_files_is_limited(self):
+        for i in range(self.proxy.MAX_FINISHED + 5):
+            task = FakeTask(self.folder, 1000)
+            self.proxy.get_url(task)
+            task.status = task.DONE
+        self.proxy.get_url(self.task)
+        self.assertEqual(len(self.proxy._finished), self.proxy.MAX_FINISHED)
+        self.assertEqual(list(self.proxy._tasks.values()), [self.task])
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# gpodder.test.sync - Unit tests for gpodder.sync
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import gpodder
+from gpodder import sync
+
+
+class FakeConfig(object):
+    one_folder_per_podcast = False
+
+    class device_sync(object):
+        delete_played_episodes = True
+        skip_played_episodes = True
+        priority = 'newest'
+        dry_run = False
+        compare_samples = False
+        one_folder_per_podcast = False
+        custom_sync_name_enabled = False
+        custom_sync_name = ''
+        max_filename_length = 120
+
+
+class FakeEpisode(object):
+    def __init__(self, folder, name, size, published, state=gpodder.STATE_DOWNLOADED,
+            is_new=True, file_type='audio'):
+        self.title = name
+        self.guid = name
+        self.published = published
+        self.state = state
+        self.is_new = is_new
+        self._file_type = file_type
+        self._filename = os.path.join(folder, name)
+        if state == gpodder.STATE_DOWNLOADED:
+            with open(self._filename, 'wb') as fp:
+                fp.write(b'x' * size)
+
+    def local_filename(self, create=False):
+        return self._filename
+
+    def sync_filename(self, custom_name_enabled, custom_name):
+        return self.title
+
+    def file_type(self):
+        return self._file_type
+
+
+class FakeTrack(object):
+    def __init__(self, title, length, partial=False, up_to_date=True):
+        self.title = title
+        self.length = length
+        self.partial = partial
+        self.up_to_date = up_to_date
+
+
+class FakeDevice(object):
+    allowed_types = ['audio', 'video']
+
+    def __init__(self, free_space=None):
+        self.free_space = free_space
+        self.tracks = {}
+
+    def episode_on_device(self, episode):
+        return self.tracks.get(episode)
+
+    def get_free_space(self):
+        return self.free_space
+
+    def track_is_up_to_date(self, track, from_file):
+        return track.up_to_date
+
+
+class TestSyncPlanner(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.config = FakeConfig()
+        self.device = FakeDevice()
+        self.planner = sync.SyncPlanner(self.config, self.device)
+
+    def episode(self, name, size=10, published=0, **kwargs):
+        return FakeEpisode(self.folder, name, size, published, **kwargs)
+
+    def test_copies_downloaded_episodes_oldest_first(self):
+        new, old = self.episode('new', published=2), self.episode('old', published=1)
+        plan = self.planner.plan([new, old])
+        self.assertEqual(plan.get_episodes_to_add(), [old, new])
+        self.assertEqual(plan.add_size, 20)
+
+    def test_skip_reasons(self):
+        on_device = self.episode('on-device')
+        self.device.tracks[on_device] = FakeTrack('on-device', 10)
+        played = self.episode('played', is_new=False)
+        image = self.episode('image', file_type='image')
+        missing = self.episode('missing', state=gpodder.STATE_NORMAL)
+
+        plan = self.planner.plan([on_device, played, image, missing])
+        self.assertEqual(plan.add, [])
+        self.assertEqual(plan.get_skipped(plan.SKIP_ON_DEVICE), [on_device])
+        self.assertEqual(plan.get_skipped(plan.SKIP_PLAYED), [played])
+        self.assertEqual(plan.get_skipped(plan.SKIP_FILE_TYPE), [image])
+        self.assertEqual(plan.get_skipped(plan.SKIP_NOT_DOWNLOADED), [missing])
+
+    def test_force_played(self):
+        played = self.episode('played', is_new=False)
+        plan = self.planner.plan([played], force_played=True)
+        self.assertEqual(plan.get_episodes_to_add(), [played])
+
+    def test_partial_track_is_copied_again(self):
+        episode = self.episode('partial')
+        self.device.tracks[episode] = FakeTrack('partial', 5, partial=True)
+        self.assertEqual(self.planner.plan([episode]).get_episodes_to_add(), [episode])
+
+    def test_outdated_track_is_copied_again(self):
+        episode = self.episode('truncated')
+        self.device.tracks[episode] = FakeTrack('truncated', 5, up_to_date=False)
+        plan = self.planner.plan([episode])
+        self.assertEqual(plan.get_episodes_to_add(), [episode])
+        self.assertEqual(plan.get_skipped(plan.SKIP_ON_DEVICE), [])
+
+    def test_removes_deleted_episodes(self):
+        kept = self.episode('kept')
+        deleted = self.episode('deleted', state=gpodder.STATE_DELETED)
+        track = FakeTrack('deleted', 30)
+        self.device.tracks[deleted] = track
+
+        plan = self.planner.plan([kept], removable=[kept, deleted])
+        self.assertEqual(plan.remove, [track])
+        self.assertEqual(plan.remove_size, 30)
+        self.assertEqual(plan.get_episodes_to_add(), [kept])
+
+    def test_selects_newest_episodes_that_fit(self):
+        episodes = [self.episode('e%d' % i, published=i) for i in range(4)]
+        self.device.free_space = 25
+        plan = self.planner.plan(episodes)
+        self.assertEqual(plan.get_episodes_to_add(), episodes[2:])
+        self.assertEqual(plan.get_skipped(plan.SKIP_NO_SPACE), episodes[1::-1])
+
+    def test_selects_oldest_episodes_that_fit(self):
+        self.config.device_sync.priority = 'oldest'
+        self.addCleanup(setattr, FakeConfig.device_sync, 'priority', 'newest')
+        episodes = [self.episode('e%d' % i, published=i) for i in range(4)]
+        self.device.free_space = 25
+        self.assertEqual(self.planner.plan(episodes).get_episodes_to_add(),
+                episodes[:2])
+
+    def test_removed_tracks_free_space(self):
+        deleted = self.episode('deleted', state=gpodder.STATE_DELETED)
+        self.device.tracks[deleted] = FakeTrack('deleted', 10)
+        episodes = [self.episode('e%d' % i, published=i) for i in range(2)]
+        self.device.free_space = 10
+        plan = self.planner.plan(episodes, removable=[deleted])
+        self.assertEqual(plan.get_episodes_to_add(), episodes)
+
+
+class TestDeviceTracksList(unittest.TestCase):
+    def setUp(self):
+        self.device = sync.Device(FakeConfig())
+        self.first = FakeTrack('episode', 10)
+        self.first.guid = 'guid-1'
+        self.second = FakeTrack('episode', 20)
+        self.second.guid = 'guid-2'
+        self.other = FakeTrack('other', 30)
+        self.device.tracks_list = [self.first, self.other]
+        self.device._add_to_tracks_list(self.second)
+
+    def test_first_track_wins(self):
+        self.assertIs(self.device._track_on_device('episode'), self.first)
+        self.assertIs(self.device._track_on_device('other'), self.other)
+        self.assertIsNone(self.device._track_on_device('missing'))
+
+    def test_remove_track(self):
+        self.device._remove_from_tracks_list(self.first)
+        self.assertEqual(self.device.tracks_list, [self.other, self.second])
+        self.assertIs(self.device._track_on_device('episode'), self.second)
+        self.assertEqual(self.device._tracks_by_guid, {'guid-2': [self.second]})
+
+        self.device._remove_from_tracks_list(self.second)
+        self.device._remove_from_tracks_list(self.second)
+        self.assertIsNone(self.device._track_on_device('episode'))
+        self.assertEqual(self.device._tracks_by_guid, {})
+
+
+class TestMP3PlayerDeviceCopies(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.config = FakeConfig()
+        self.addCleanup(setattr, FakeConfig.device_sync, 'compare_samples', False)
+        self.device = sync.MP3PlayerDevice(self.config, None, None,
+                os.path.join(self.folder, 'device'))
+        self.device.SAMPLE_SIZE = 4
+        os.mkdir(self.device.destination)
+
+        self.from_file = os.path.join(self.folder, 'episode.mp3')
+        self.to_file = os.path.join(self.device.destination, 'episode.mp3')
+        self.data = bytes(range(100))
+        self.write(self.from_file, self.data)
+
+    def write(self, filename, data, mtime=None):
+        with open(filename, 'wb') as fp:
+            fp.write(data)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+
+    def copy(self, data):
+        mtime = os.stat(self.from_file).st_mtime
+        self.write(self.to_file, data, mtime)
+
+    def test_complete_copy_is_up_to_date(self):
+        self.copy(self.data)
+        self.assertTrue(self.device._is_up_to_date(self.from_file, self.to_file))
+
+    def test_missing_copy(self):
+        self.assertFalse(self.device._is_up_to_date(self.from_file, self.to_file))
+
+    def test_size_mismatch(self):
+        self.copy(self.data[:50])
+        self.assertFalse(self.device._is_up_to_date(self.from_file, self.to_file))
+
+    def test_older_copy(self):
+        self.copy(self.data)
+        mtime = os.stat(self.from_file).st_mtime - 2 * self.device.MTIME_TOLERANCE
+        os.utime(self.to_file, (mtime, mtime))
+        self.assertFalse(self.device._is_up_to_date(self.from_file, self.to_file))
+
+    def test_compare_samples(self):
+        corrupt = bytearray(self.data)
+        corrupt[50] ^= 0xff
+        self.copy(bytes(corrupt))
+        self.assertTrue(self.device._is_up_to_date(self.from_file, self.to_file))
+
+        self.config.device_sync.compare_samples = True
+        self.assertFalse(self.device._is_up_to_date(self.from_file, self.to_file))
+
+        self.copy(self.data)
+        self.assertTrue(self.device._is_up_to_date(self.from_file, self.to_file))
+
+    def get_resume_offset(self, partial):
+        partial_file = self.device._get_partial_filename(self.to_file)
+        self.write(partial_file, partial)
+        with open(self.from_file, 'rb') as in_file, open(partial_file, 'rb') as out_file:
+            return self.device._get_resume_offset(in_file.fileno(),
+                    out_file.fileno(), len(self.data))
+
+    def test_resume_matching_partial_file(self):
+        self.assertEqual(self.get_resume_offset(self.data[:30]), 30)
+
+    def test_resume_before_corrupt_tail(self):
+        self.assertEqual(self.get_resume_offset(self.data[:26] + b'\0' * 4), 26)
+
+    def test_resume_corrupt_partial_file(self):
+        self.assertEqual(self.get_resume_offset(b'\0' * 30), 0)
+
+    def test_resume_partial_file_larger_than_source(self):
+        self.assertEqual(self.get_resume_offset(self.data + b'\0'), 0)
+
+    def test_truncated_copy_is_planned_again(self):
+        self.copy(self.data[:50])
+        track = self.device._make_track(self.to_file)
+        self.device.tracks_list = [track]
+        self.assertFalse(self.device.track_is_up_to_date(track, self.from_file))
+
+        episode = FakeEpisode(self.folder, 'episode', 0, 0)
+        episode._filename = self.from_file
+        device = FakeDevice()
+        device.tracks[episode] = track
+        device.track_is_up_to_date = self.device.track_is_up_to_date
+        plan = sync.SyncPlanner(self.config, device).plan([episode])
+        self.assertEqual(plan.get_episodes_to_add(), [episode])
+
+        self.copy(self.data)
+        plan = sync.SyncPlanner(self.config, device).plan([episode])
+        self.assertEqual(plan.get_skipped(plan.SKIP_ON_DEVICE), [episode])
+
+
+class FakeSyncTask(object):
+    def __init__(self, episode):
+        self.episode = episode
+        self.device_status = None
+        self.progress = []
+
+    def status_updated(self, count, block_size, total_size):
+        self.progress.append(count * block_size)
+
+
+class TestFanOutDevice(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+        # Two targets with the same folder name
+        self.targets = [os.path.join(self.folder, name, 'Podcasts') for name in 'AB']
+        for target in self.targets:
+            os.makedirs(target)
+
+        self.episode = FakeEpisode(self.folder, 'episode', 0, 0)
+        self.data = bytes(range(256)) * 4
+        with open(self.episode._filename, 'wb') as fp:
+            fp.write(self.data)
+        self.mtime = os.stat(self.episode._filename).st_mtime
+
+        # Copy data instead of linking the files on the same file system
+        patcher = mock.patch.object(sync.MP3PlayerDevice, '_same_file_system',
+                return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.device = sync.FanOutDevice(FakeConfig(), None, None, self.targets)
+        self.device.CHUNK_SIZE = 100
+        self.task = FakeSyncTask(self.episode)
+
+    def target_file(self, target):
+        return os.path.join(target, 'episode')
+
+    def partial_file(self, target):
+        return os.path.join(target, '.episode.partial')
+
+    def assertCopied(self, target):
+        filename = self.target_file(target)
+        with open(filename, 'rb') as fp:
+            self.assertEqual(fp.read(), self.data)
+        self.assertEqual(os.stat(filename).st_mtime, self.mtime)
+        self.assertFalse(os.path.exists(self.partial_file(target)))
+
+    def test_copies_to_all_targets(self):
+        self.assertTrue(self.device.add_track_for_task(self.task))
+        for target in self.targets:
+            self.assertCopied(target)
+        self.assertEqual(dict(self.task.device_status),
+                {target: 1.0 for target in self.targets})
+        self.assertTrue(self.task.progress)
+
+        track = self.device.episode_on_device(self.episode)
+        self.assertFalse(track.partial)
+        self.assertTrue(self.device.track_is_up_to_date(track, self.episode._filename))
+
+    def test_resumes_partial_copy(self):
+        with open(self.partial_file(self.targets[0]), 'wb') as fp:
+            fp.write(self.data[:500])
+        self.device.add_track_for_task(self.task)
+        for target in self.targets:
+            self.assertCopied(target)
+
+    def test_up_to_date_target_is_skipped(self):
+        shutil.copy2(self.episode._filename, self.target_file(self.targets[1]))
+        with mock.patch.object(sync, 'FanOutWriter', wraps=sync.FanOutWriter) as writer:
+            self.assertTrue(self.device.add_track_for_task(self.task))
+        # Only the first target has been written to
+        writer.assert_called_once_with(self.device.devices[0],
+                self.target_file(self.targets[0]))
+        for target in self.targets:
+            self.assertCopied(target)
+
+    def test_failed_target_does_not_stop_the_others(self):
+        # The temporary file of the second target cannot be opened
+        os.mkdir(self.partial_file(self.targets[1]))
+
+        with self.assertRaises(sync.SyncFailedException) as context:
+            self.device.add_track_for_task(self.task)
+
+        self.assertIn(self.targets[1], str(context.exception))
+        self.assertNotIn(self.targets[0], str(context.exception))
+        self.assertCopied(self.targets[0])
+        self.assertEqual(self.task.device_status[self.targets[0]], 1.0)
+        self.assertIsInstance(self.task.device_status[self.targets[1]], str)
+
+        # The episode is missing on one device, so it is copied again
+        self.assertTrue(self.device.episode_on_device(self.episode).partial)
+
+
+class TestFanOutWriter(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.device = sync.MP3PlayerDevice(FakeConfig(), None, None, self.folder)
+        self.device.SAMPLE_SIZE = 4
+        self.from_file = os.path.join(self.folder, 'source')
+        self.data = bytes(range(100))
+        with open(self.from_file, 'wb') as fp:
+            fp.write(self.data)
+        self.writer = sync.FanOutWriter(self.device, os.path.join(self.folder, 'copy'))
+
+    def write(self, chunks):
+        with open(self.from_file, 'rb') as in_file:
+            self.writer.open(in_file.fileno(), len(self.data))
+        position = self.writer.position
+        self.writer.start()
+        for offset, data in chunks:
+            self.writer.put(offset, data)
+        self.writer.stop()
+        self.writer.finish(0)
+        return position
+
+    def test_more_chunks_than_queue_size(self):
+        chunks = [(offset, self.data[offset:offset + 3])
+                for offset in range(0, len(self.data), 3)]
+        self.assertGreater(len(chunks), self.writer.QUEUE_SIZE)
+        self.write(chunks)
+        self.assertIsNone(self.writer.error)
+        with open(self.writer.to_file, 'rb') as fp:
+            self.assertEqual(fp.read(), self.data)
+
+    def test_chunks_before_resume_offset_are_skipped(self):
+        with open(self.writer.partial_file, 'wb') as fp:
+            fp.write(self.data[:30])
+        # All data is sent from the start of a chunk before the offset
+        self.assertEqual(self.write([(20, self.data[20:])]), 30)
+        with open(self.writer.to_file, 'rb') as fp:
+            self.assertEqual(fp.read(), self.data)
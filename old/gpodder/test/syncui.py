@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# gpodder.test.syncui - Unit tests for gpodder.syncui
+
+
+import unittest
+from unittest import mock
+
+from gpodder import syncui
+
+
+class FakeConfig(object):
+    class device_sync(object):
+        delete_played_episodes = False
+        skip_played_episodes = False
+        priority = 'newest'
+        dry_run = True
+
+
+class FakeDevice(object):
+    allowed_types = ['audio']
+
+    def __init__(self):
+        self.closed = False
+        self.removed = None
+
+    def open(self):
+        return True
+
+    def close(self):
+        self.closed = True
+
+    def episode_on_device(self, episode):
+        return None
+
+    def get_free_space(self):
+        return None
+
+    def remove_tracks(self, tracks):
+        self.removed = tracks
+
+
+class TestDryRun(unittest.TestCase):
+    def setUp(self):
+        self.notifications = []
+        self.done = []
+        self.device = FakeDevice()
+
+        self.ui = syncui.gPodderSyncUI(FakeConfig(),
+                lambda message, title, **kwargs: self.notifications.append(title),
+                None, None, None, [], None, None, None, None, None, None)
+
+        for name, value in (('run_in_background', lambda function: function()),
+                            ('idle_add', lambda function, *args: function(*args))):
+            patcher = mock.patch('gpodder.util.' + name, side_effect=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = mock.patch('gpodder.sync.open_device', return_value=self.device)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dry_run_finishes_sync(self):
+        self.ui.on_synchronize_episodes([], episodes=[],
+                done_callback=lambda: self.done.append(True))
+
+        self.assertEqual(self.notifications, ['Synchronization preview'])
+        self.assertTrue(self.device.closed)
+        self.assertIsNone(self.device.removed)
+        self.assertIsNone(self.ui.device)
+        self.assertEqual(self.done, [True])
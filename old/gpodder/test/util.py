@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# gpodder.test.util - Unit tests for gpodder.util
+
+
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from gpodder import util
+
+
+class TestLinkFile(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.src = os.path.join(self.folder, 'episode.mp3')
+        self.dst = os.path.join(self.folder, 'other.mp3.partial')
+        self.write(self.src, b'complete')
+        self.write(self.dst, b'part')
+
+    def write(self, filename, data):
+        with open(filename, 'wb') as fp:
+            fp.write(data)
+
+    def read(self, filename):
+        with open(filename, 'rb') as fp:
+            return fp.read()
+
+    def test_replaces_destination(self):
+        self.assertTrue(util.link_file(self.src, self.dst))
+        self.assertEqual(self.read(self.dst), b'complete')
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                ['episode.mp3', 'other.mp3.partial'])
+
+    def test_failure_keeps_partial_file(self):
+        with mock.patch('gpodder.util.reflink_file', return_value=False), \
+                mock.patch('os.link', side_effect=OSError('not supported')):
+            self.assertFalse(util.link_file(self.src, self.dst))
+        self.assertEqual(self.read(self.dst), b'part')
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                ['episode.mp3', 'other.mp3.partial'])
+
+    def test_missing_source(self):
+        os.remove(self.src)
+        self.assertFalse(util.link_file(self.src, self.dst))
+        self.assertEqual(self.read(self.dst), b'part')
+
+
+class TestPreallocateFile(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.filename = os.path.join(self.folder, 'episode.mp3.partial')
+        self.fp = open(self.filename, 'wb')
+        self.addCleanup(self.fp.close)
+
+    def fallocate_fails(self, error):
+        fallocate = mock.Mock(return_value=-1)
+        patcher = mock.patch('gpodder.util._libc_fallocate', fallocate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('ctypes.get_errno', return_value=error)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_disk_full_raises(self):
+        self.fallocate_fails(errno.ENOSPC)
+        with self.assertRaises(IOError) as cm:
+            util.preallocate_file(self.fp, 0, 1024)
+        self.assertEqual(cm.exception.errno, errno.ENOSPC)
+        self.assertEqual(cm.exception.filename, self.filename)
+
+    def test_unsupported_is_not_an_error(self):
+        self.fallocate_fails(errno.EOPNOTSUPP)
+        self.assertFalse(util.preallocate_file(self.fp, 0, 1024))
+
+    def test_nothing_to_reserve(self):
+        self.assertFalse(util.preallocate_file(self.fp, 0, 0))
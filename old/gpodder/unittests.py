@@ -47,7 +47,8 @@ coverage_modules = []
 
 # Modules (in gpodder) for which doctests exist
 # ex: Doctests embedded in "gpodder.util", coverage reported for "gpodder.util"
-doctest_modules = ['util', 'jsonconfig']
+doctest_modules = ['util', 'jsonconfig', 'download', 'resolver', 'streamproxy',
+                   'prefetch', 'query', 'searchindex', 'filecache']
 
 for module in doctest_modules:
     doctest_mod = __import__('.'.join((package, module)), fromlist=[module])
@@ -58,7 +59,8 @@ for module in doctest_modules:
 
 # Modules (in gpodder) for which unit tests (in gpodder.test) exist
 # ex: Tests are in "gpodder.test.model", coverage reported for "gpodder.model"
-test_modules = ['model']
+test_modules = ['model', 'download', 'util', 'query', 'sync', 'syncui',
+                'filecache', 'streamproxy', 'my']
 
 for module in test_modules:
     test_mod = __import__('.'.join((test_package, module)), fromlist=[module])
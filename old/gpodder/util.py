@@ -31,6 +31,7 @@ are not tied to any specific part of gPodder.
 """
 import collections
 import datetime
+import errno
 import glob
 import gzip
 import http.client
@@ -61,6 +62,7 @@ import xml.dom.minidom
 from html.entities import entitydefs
 
 import gpodder
+from gpodder import filecache
 
 logger = logging.getLogger(__name__)
 
@@ -1715,6 +1717,176 @@ def atomic_rename(old_name, new_name):
     os.rename(old_name, new_name)
 
 
+def preallocate_file(fileobj, offset, length):
+    """Reserve disk space for "length" bytes at "offset" of a file
+
+    This uses fallocate(2) with FALLOC_FL_KEEP_SIZE, so the apparent
+    size of the file does not change. That is important for partial
+    downloads, as their size is used as the offset for resuming (which
+    is why os.posix_fallocate(), which grows the file, is not used).
+
+    Returns True if the space has been reserved, False if this is not
+    supported by the platform or file system (which is not an error).
+    Raises IOError (ENOSPC) if there is not enough free space, so that
+    the download fails right away instead of when the disk is full.
+    """
+    global _libc_fallocate
+    if length <= 0:
+        return False
+
+    import ctypes
+    import ctypes.util
+
+    if _libc_fallocate is None:
+        _libc_fallocate = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                _libc_fallocate = libc.fallocate
+                _libc_fallocate.argtypes = (ctypes.c_int, ctypes.c_int,
+                        ctypes.c_longlong, ctypes.c_longlong)
+            except Exception as e:
+                logger.debug('fallocate() not available: %s', e)
+
+    if not _libc_fallocate:
+        return False
+
+    FALLOC_FL_KEEP_SIZE = 0x01
+    fileobj.flush()
+    if _libc_fallocate(fileobj.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        error = ctypes.get_errno()
+        if error == errno.ENOSPC:
+            raise IOError(error, os.strerror(error), fileobj.name)
+        logger.debug('Cannot preallocate %d bytes: %s', length,
+                os.strerror(error))
+        return False
+
+    return True
+
+
+_libc_fallocate = None
+
+
+def fsync_file(fileobj):
+    """Flush a file object and force its data to disk"""
+    fileobj.flush()
+    os.fsync(fileobj.fileno())
+
+
+def fsync_directory(path):
+    """Force a directory entry (e.g. after a rename) to disk
+
+    Errors are ignored, as not all platforms and file
+    systems support opening and syncing directories.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.debug('Cannot fsync directory %s: %s', path, e)
+
+
+# Prefixes of podcast analytics services that redirect to the real file
+TRACKING_PREFIX_RE = re.compile(r"""^(?:
+    (?:www\.)?podtrac\.com/pts/redirect\.[a-z0-9]+/ |
+    dts\.podtrac\.com/redirect\.[a-z0-9]+/ |
+    chtbl\.com/track/[^/]+/ |
+    pdst\.fm/e/ |
+    op3\.dev/e/ |
+    arttrk\.com/p/[^/]+/
+)""", re.IGNORECASE | re.VERBOSE)
+
+
+def normalize_enclosure_url(url):
+    """Normalize an enclosure URL for finding the same file in other feeds
+
+    The scheme, default ports, analytics redirect prefixes and "utm_"
+    query parameters are removed, and the host name is lowercased.
+
+    >>> normalize_enclosure_url('http://WWW.Example.com:80/Ep1.mp3')
+    'www.example.com/Ep1.mp3'
+    >>> normalize_enclosure_url('https://dts.podtrac.com/redirect.mp3/example.com/ep1.mp3')
+    'example.com/ep1.mp3'
+    >>> normalize_enclosure_url('https://chtbl.com/track/A1/pdst.fm/e/Example.com/ep1.mp3?utm_source=x&b=2&a=1')
+    'example.com/ep1.mp3?a=1&b=2'
+    """
+    parsed = urllib.parse.urlsplit(url)
+    rest = parsed.netloc + parsed.path
+    while True:
+        stripped = TRACKING_PREFIX_RE.sub('', rest, count=1)
+        if stripped == rest:
+            break
+        rest = stripped
+
+    host, _, path = rest.partition('/')
+    host = host.lower()
+    for default_port in (':80', ':443'):
+        if host.endswith(default_port):
+            host = host[:-len(default_port)]
+
+    query = sorted((key, value) for key, value in
+                   urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+                   if not key.startswith('utm_'))
+
+    result = host + '/' + path
+    if query:
+        result += '?' + urllib.parse.urlencode(query)
+
+    return result
+
+
+def reflink_file(src, dst):
+    """Create "dst" as a copy-on-write clone of "src" (Linux only)
+
+    Returns True on success, False if the file system does not support
+    reflinks (e.g. ext4) or the files are on different file systems.
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+
+    import fcntl
+    FICLONE = 0x40049409
+
+    try:
+        with open(src, 'rb') as in_file, open(dst, 'wb') as out_file:
+            fcntl.ioctl(out_file.fileno(), FICLONE, in_file.fileno())
+        return True
+    except (IOError, OSError) as e:
+        logger.debug('Cannot reflink %s to %s: %s', src, dst, e)
+        delete_file(dst)
+        return False
+
+
+def link_file(src, dst):
+    """Make the content of "src" available as "dst" without copying
+
+    A reflink (an independent copy-on-write copy) is preferred, and a
+    hard link is used if reflinks are not supported. The link is made
+    under a temporary name and then replaces an existing "dst", so
+    "dst" is left alone if neither is possible (returns False).
+    """
+    tmp = dst + '.link'
+    delete_file(tmp)
+
+    if not reflink_file(src, tmp):
+        try:
+            os.link(src, tmp)
+        except OSError as e:
+            logger.debug('Cannot link %s to %s: %s', src, dst, e)
+            return False
+
+    try:
+        os.replace(tmp, dst)
+        return True
+    except OSError as e:
+        logger.debug('Cannot replace %s: %s', dst, e)
+        delete_file(tmp)
+        return False
+
+
 def check_command(self, cmd):
     """Check if a command line command/program exists"""
     # Prior to Python 2.7.3, this module (shlex) did not support Unicode input.
@@ -1727,13 +1899,14 @@ def rename_episode_file(episode, filename):
 
     Useful after renaming/converting its download file.
     """
-    if not os.path.exists(filename):
+    filecache.invalidate(filename)
+    if not filecache.exists(filename):
         raise ValueError('Target filename does not exist.')
 
     basename, extension = os.path.splitext(filename)
 
     episode.download_filename = os.path.basename(filename)
-    episode.file_size = os.path.getsize(filename)
+    episode.file_size = filecache.getsize(filename)
     episode.mime_type = mimetype_from_extension(extension)
     episode.save()
     episode.db.commit()
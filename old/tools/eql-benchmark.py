@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Compare the compiled EQL predicates with the original EQL implementation,
+# which evaluated queries via eval() and looked terms up in an if/elif chain
+# Usage: PYTHONPATH=. python3 tools/eql-benchmark.py [episodes]
+
+import datetime
+import sys
+import time
+
+import gpodder
+from gpodder import query
+
+QUERIES = [
+    'new',
+    'downloaded and megabytes > 10',
+    '(new or played) and minutes > 30',
+    "'S04' in title or 'Linux' in description",
+    'not archive and since < 7 and megabytes < 100',
+]
+
+
+class FakeEpisode(object):
+    """Just the attributes and methods that EQL terms access"""
+    def __init__(self, i):
+        self.title = 'Episode %d: Linux and S0%d' % (i, i % 6)
+        self.description = 'Description of episode %d' % i
+        self.url = 'http://example.com/episode%d.mp3' % i
+        self.mime_type = 'audio/mpeg'
+        self.state = (gpodder.STATE_NORMAL, gpodder.STATE_DOWNLOADED,
+                gpodder.STATE_DELETED)[i % 3]
+        self.is_new = bool(i % 2)
+        self.archive = not i % 7
+        self.downloading = False
+        self.file_size = (i % 200) * 1024 * 1024
+        self.published = time.time() - i * 60 * 60 * 12
+        self.total_time = (i % 120) * 60
+        self.current_position = 0
+
+    def was_downloaded(self, and_exists=False):
+        # Stands in for the os.path.exists() call of the real episode
+        time.sleep(0.00001)
+        return self.state == gpodder.STATE_DOWNLOADED
+
+    def is_finished(self):
+        return False
+
+    def file_type(self):
+        return 'audio'
+
+    def age_in_days(self):
+        return 0
+
+
+class OriginalMatcher(object):
+    """query.Matcher before EQL queries were compiled (terms in an if/elif chain)"""
+    def __init__(self, episode):
+        self._episode = episode
+
+    def match(self, term):
+        try:
+            return bool(eval(term, {'__builtins__': None}, self))
+        except Exception as e:
+            print(e)
+            return False
+
+    def __getitem__(self, k):
+        episode = self._episode
+
+        # Adjectives (for direct usage)
+        if k == 'new':
+            return (episode.state == gpodder.STATE_NORMAL and episode.is_new)
+        elif k in ('downloaded', 'dl'):
+            return episode.was_downloaded(and_exists=True)
+        elif k in ('deleted', 'rm'):
+            return episode.state == gpodder.STATE_DELETED
+        elif k == 'played':
+            return not episode.is_new
+        elif k == 'downloading':
+            return episode.downloading
+        elif k == 'archive':
+            return episode.archive
+        elif k in ('finished', 'fin'):
+            return episode.is_finished()
+        elif k in ('video', 'audio'):
+            return episode.file_type() == k
+        elif k == 'torrent':
+            return episode.url.endswith('.torrent') or 'torrent' in episode.mime_type
+
+        # Nouns (for comparisons)
+        if k in ('megabytes', 'mb'):
+            return episode.file_size / (1024 * 1024)
+        elif k == 'title':
+            return episode.title
+        elif k == 'description':
+            return episode.description
+        elif k == 'since':
+            return (datetime.datetime.now() - datetime.datetime.fromtimestamp(episode.published)).days
+        elif k == 'age':
+            return episode.age_in_days()
+        elif k in ('minutes', 'min'):
+            return episode.total_time / 60
+        elif k in ('remaining', 'rem'):
+            return episode.total_time - episode.current_position / 60
+
+        raise KeyError(k)
+
+
+def evaluate(q, episodes):
+    """The way EQL used to match: eval() with an OriginalMatcher per episode"""
+    code = compile(q, '<eql-string>', 'eval')
+    return [e for e in episodes if OriginalMatcher(e).match(code)]
+
+
+def measure(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def main(count):
+    episodes = [FakeEpisode(i) for i in range(count)]
+    print('%-50s %10s %10s %8s' % ('Query (%d episodes)' % count, 'original',
+            'compiled', 'speedup'))
+    for q in QUERIES:
+        eql = query.EQL(q)
+        old_time, old = measure(evaluate, q, episodes)
+        new_time, new = measure(eql.filter, episodes)
+        assert old == new, 'Results differ for %s' % q
+        print('%-50s %9.3fs %9.3fs %7.1fx' % (q, old_time, new_time,
+                old_time / max(new_time, 1e-9)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)